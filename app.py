@@ -9,10 +9,18 @@ The HTTP response is handled by compiling messages from EWrappper Methods into J
 https://www.interactivebrokers.com/en/software/api/apiguide/java/java_ewrapper_methods.htm
 """
 # Flask imports
-from flask import Flask, request
+from flask import Flask, Response, g, make_response, request
 from flask_restful import Resource, Api, reqparse
 # IBREST imports
 import sync
+import fundamentals
+import gateways
+import pricing
+import serializers
+import tasks
+import tracing
+from ib.opt import metrics
+from parsers import scanner_parser, fundamentals_parser, option_chain_parser
 
 __author__ = 'Jason Haury'
 
@@ -20,6 +28,75 @@ app = Flask(__name__)
 api = Api(app)
 
 
+# ---------------------------------------------------------------------
+# TRACING
+# ---------------------------------------------------------------------
+@app.before_request
+def start_trace():
+    g.trace = tracing.start(request.method, request.path, request.endpoint)
+
+
+@app.after_request
+def finish_trace(response):
+    """ Adds the Server-Timing header, unless the response is still pending on serve.py's loop (which calls this again
+    once it is done)
+    """
+    trace = getattr(g, 'trace', None)
+    if trace is not None and getattr(response, 'pending', None) is None:
+        response.headers['Server-Timing'] = trace.server_timing()
+    tasks.set_context(None)
+    return response
+
+
+# ---------------------------------------------------------------------
+# REPRESENTATIONS
+# ---------------------------------------------------------------------
+# Flask-RESTful picks one by the request's Accept header, defaulting to JSON.  Each is timed as the serialize phase.
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+    """ Renders data as JSON with serializers.dumps.  Like Flask-RESTful's own representation, the debug server indents
+    and sorts keys.
+    """
+    with tracing.span('serialize'):
+        if app.debug:
+            dumped = serializers.dumps(data, indent=4, sort_keys=True)
+        else:
+            dumped = serializers.dumps(data)
+        resp = make_response(dumped + '\n', code)
+        resp.headers.extend(headers or {})
+        return resp
+
+
+def output_msgpack(data, code, headers=None):
+    """ Renders data as MessagePack, for Accept: application/msgpack
+    """
+    with tracing.span('serialize'):
+        resp = make_response(serializers.packb(data), code)
+        resp.headers.extend(headers or {})
+        return resp
+
+
+def output_arrow(data, code, headers=None):
+    """ Renders data as an Arrow IPC stream, for Accept: application/vnd.apache.arrow.stream.  Responses which are not
+    one table (ie open orders, with openOrder and orderStatus rows) are answered with a 406 and an error record instead.
+    """
+    with tracing.span('serialize'):
+        stream = serializers.arrow_stream(data)
+        if stream is None:
+            code = 406
+            stream = serializers.arrow_stream({'error': 'This response is not a single table; request it as JSON'})
+        resp = make_response(stream, code)
+        resp.headers.extend(headers or {})
+        return resp
+
+
+if serializers.msgpack is not None:
+    api.representations[serializers.MSGPACK] = output_msgpack
+    api.representations['application/x-msgpack'] = output_msgpack
+if serializers.pyarrow is not None:
+    api.representations[serializers.ARROW_STREAM] = output_arrow
+
+
 # ---------------------------------------------------------------------
 # RESOURCES
 # ---------------------------------------------------------------------
@@ -77,6 +154,8 @@ class Orders(Resource):
                             help='Must be BUY, SELL or SSHORT')
         parser.add_argument('tif', type=str, required=False,
                             help='Time in force', choices=['DAT', 'GTC', 'IOC', 'GTD'])
+        parser.add_argument('account', type=str, required=False,
+                            help='Account to place the order for; it is sent to the gateway managing that account')
 
         '''
         parser.add_argument('stopPrice', type=int, required=True,
@@ -112,12 +191,135 @@ class PortfolioPositions(Resource):
         return sync.get_portfolio()
 
 
+class Scanner(Resource):
+    """ Resource to handle requests for market scanners
+    """
+
+    def post(self):
+        """ Runs a market scanner with reqScannerSubscription().  Args are those of a ScannerSubscription:
+        https://www.interactivebrokers.com/en/software/api/apiguide/java/scannersubscription.htm
+
+        :return: JSON dict with scannerData rows ordered by rank.  Identical scans share cached results for
+        IBREST_SCANNER_TTL seconds.
+        """
+        args = scanner_parser.parse_args()
+        return sync.run_scanner(args)
+
+
+class ScannerParameters(Resource):
+    """ Resource to discover which scans TWS supports
+    """
+
+    @tasks.coroutine
+    def get(self):
+        """
+        :return: JSON dict of instruments, locations and scanCodes, as indexed from reqScannerParameters()
+        """
+        parameters = yield sync.get_scanner_parameters()
+        if parameters is None:
+            raise tasks.Return({'error': 'No scanner parameters received from TWS'})
+        raise tasks.Return(parameters.to_dict())
+
+
+class Fundamentals(Resource):
+    """ Resource to handle requests for fundamental data reports
+    """
+
+    @tasks.coroutine
+    def get(self, symbol, reportType):
+        """ Gets a report with reqFundamentalData(), or from the disk cache if it was already fetched today.  The report
+        is streamed as IB's XML, or as JSON with ?format=json, gzipped if the client accepts it.
+        """
+        if reportType not in fundamentals.REPORT_TYPES:
+            raise tasks.Return({'error': 'reportType must be one of {}'.format(', '.join(fundamentals.REPORT_TYPES))})
+        args = fundamentals_parser.parse_args()
+        # Read the request before waiting on TWS; under serve.py it is gone by the time we resume
+        compressed = 'gzip' in request.accept_encodings
+        path = yield sync.get_fundamentals(symbol, reportType, args)
+        if isinstance(path, dict):
+            raise tasks.Return(path)
+        mimetype = 'application/json' if args['format'] == 'json' else 'application/xml'
+        resp = Response(fundamentals.read_chunks(path, compressed), mimetype=mimetype)
+        if compressed:
+            resp.headers['Content-Encoding'] = 'gzip'
+        raise tasks.Return(resp)
+
+
+class OptionChain(Resource):
+    """ Resource to handle requests for option chains
+    """
+
+    def get(self, underlying):
+        """
+        :return: JSON dict with expiries, strikes and underPrice, plus calls and puts dicts holding an expiry x strike
+        grid for each tickOptionComputation value (impliedVol, delta, gamma, vega, theta, etc).  Cells which got no
+        computation before the timeout are null, and counted in missing.
+        """
+        args = option_chain_parser.parse_args()
+        return sync.get_option_chain(underlying, args)
+
+
+class OptionCompute(Resource):
+    """ Resource to compute option prices, implied volatilities and greeks locally
+    """
+
+    def post(self):
+        """ Takes a JSON body of per-contract lists (or single values to apply to every contract): right, strike,
+        underPrice, time (years) or expiry (YYYYMMDD), rate, dividendYield, and volatility or optionPrice.  model is bs
+        (default) or black76 for options on futures.  With "tws": true and conId for each contract, TWS'
+        calculateImpliedVolatility/calculateOptionPrice are used instead.
+
+        :return: JSON dict of lists: impliedVol, optPrice, delta, gamma, vega, theta and undPrice
+        """
+        data = request.get_json(force=True, silent=True)
+        if not isinstance(data, dict):
+            return {'error': 'Request body must be a JSON object'}
+        if data.get('tws') is True:
+            return sync.calculate_with_tws(data)
+        try:
+            return serializers.Columns(pricing.evaluate(data))
+        except ValueError as e:
+            return {'error': str(e)}
+
+
+class Gateways(Resource):
+    """ Resource to report on the TWS/IB Gateway endpoints requests are spread over
+    """
+
+    def get(self):
+        """
+        :return: JSON dict with each gateway's clientIds in use, waiting requests, accounts and health, and the routes
+        """
+        return gateways.router.to_dict()
+
+
+class Metrics(Resource):
+    """ Resource to expose metrics for Prometheus to scrape
+    """
+
+    def get(self):
+        """
+        :return: text/plain Prometheus exposition of REST request and phase times (see tracing.py), per message type
+        counts, bytes, decode and listener times (with IBREST_MESSAGE_METRICS=1), and the debug logging pool's queue
+        depths and listener times (see ib/opt/pool.py)
+        """
+        return Response(tracing.render() + metrics.render() + sync.debug_pool_metrics(),
+                        mimetype='text/plain; version=0.0.4')
+
+
 # ---------------------------------------------------------------------
 # ROUTING
 # ---------------------------------------------------------------------
 api.add_resource(Market, '/market/<string:symbol>')
 api.add_resource(Orders, '/order')
 api.add_resource(PortfolioPositions, '/portfolio/positions')
+api.add_resource(Scanner, '/scanner')
+api.add_resource(ScannerParameters, '/scanner/parameters')
+api.add_resource(Fundamentals, '/fundamentals/<string:symbol>/<string:reportType>')
+api.add_resource(OptionChain, '/options/<string:underlying>/chain')
+api.add_resource(OptionCompute, '/options/compute')
+api.add_resource(Gateways, '/gateways')
+api.add_resource(Metrics, '/metrics')
 
 if __name__ == '__main__':
     import os
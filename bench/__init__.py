@@ -0,0 +1,4 @@
+""" Offline benchmarks for IBREST and the IbPy layer it uses.  Each module is runnable on its own, ie:
+
+    python -m bench.encoder
+"""
@@ -0,0 +1,91 @@
+""" Benchmark of finding contracts by Contract.__eq__ and by ib.opt.contractkey.contractKey.
+
+A few thousand stock and option contracts without conIds (as clients build them) are subscribed, and then looked up
+again from equal copies, the way a market data subscription or a cache would be: by scanning the subscriptions with
+Contract.__eq__, the only way to compare ib.ext contracts, and by a dict keyed by contractKey.  Equal contracts (and
+only those) must get the same key, combo legs in any order included; that is checked before timing.
+
+    python -m bench.contracts [count]
+"""
+from __future__ import absolute_import
+
+import sys
+import time
+
+from ib.ext.ComboLeg import ComboLeg
+from ib.ext.Contract import Contract
+from ib.opt.contractkey import contractKey
+
+
+def make_contract(i):
+    """ :return: Contract for a stock, or (every other i) an option on one
+    """
+    contract = Contract()
+    contract.m_symbol = ('AAPL', 'MSFT', 'IBM', 'GOOG', 'SPY')[i % 5]
+    contract.m_exchange = 'SMART'
+    contract.m_currency = 'USD'
+    if i % 2:
+        contract.m_secType = 'OPT'
+        contract.m_expiry = '201612{:02d}'.format(1 + i // 10 % 28)
+        contract.m_strike = 50.0 + i // 280
+        contract.m_right = 'CP'[i // 5 % 2]
+        contract.m_multiplier = '100'
+    else:
+        contract.m_secType = 'STK'
+        contract.m_primaryExch = ('NASDAQ', 'NYSE', 'ARCA')[i // 10 % 3]
+        contract.m_localSymbol = '{}{}'.format(contract.m_symbol, i)
+    return contract
+
+
+def combo(legs):
+    contract = Contract()
+    contract.m_symbol, contract.m_secType, contract.m_exchange, contract.m_currency = 'SPY', 'BAG', 'SMART', 'USD'
+    contract.m_comboLegs = []
+    for conId, action in legs:
+        leg = ComboLeg()
+        leg.m_conId, leg.m_ratio, leg.m_action, leg.m_exchange = conId, 1, action, 'SMART'
+        contract.m_comboLegs.append(leg)
+    return contract
+
+
+def check(contracts):
+    for a in contracts[:200]:
+        for b in contracts[:200]:
+            assert (a == b) == (contractKey(a) == contractKey(b)), '{} and {} keys disagree'.format(a.m_symbol,
+                                                                                                 b.m_symbol)
+    assert contractKey(make_contract(7)) is contractKey(make_contract(7)), 'Equal keys are not interned'
+    # Contract.__eq__ does not terminate on these
+    assert contractKey(combo([(1, 'BUY'), (2, 'SELL')])) == contractKey(combo([(2, 'sell'), (1, 'BUY')]))
+    assert contractKey(combo([(1, 'BUY'), (2, 'SELL')])) != contractKey(combo([(1, 'BUY'), (2, 'BUY')]))
+    stock = make_contract(0)
+    stock.m_conId = 265598
+    assert contractKey(stock) == contractKey(Contract(265598, 'AAPL', 'STK', '', 0.0, '', '', 'SMART', 'USD', '', '',
+                                                      [], '', False, '', ''))
+
+
+def main(count=4000):
+    subscribed = [make_contract(i) for i in xrange(count)]
+    copies = [make_contract(i) for i in xrange(count)]
+    check(subscribed)
+
+    print 'Looking up {} subscribed contracts from copies'.format(count)
+    print '  {:24s} {:>14s}'.format('', 'lookups/sec')
+    scans = copies[::20]
+    start = time.time()
+    for i, contract in enumerate(scans):
+        found = next(n for n, s in enumerate(subscribed) if s == contract)
+        assert found == i * 20, 'Scan found the wrong contract'
+    print '  {:24s} {:14.0f}'.format('scan with Contract.__eq__', len(scans) / (time.time() - start))
+
+    start = time.time()
+    index = dict((contractKey(s), n) for n, s in enumerate(subscribed))
+    built = time.time() - start
+    start = time.time()
+    for i, contract in enumerate(copies):
+        assert index[contractKey(contract)] == i, 'Key found the wrong contract'
+    print '  {:24s} {:14.0f}   (keying all {} took {:.3f}s)'.format('dict by contractKey', count / (time.time() - start),
+                                                                   count, built)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,185 @@
+""" Replay benchmark of the table-driven DecodingReader against the generated EReader.
+
+A synthetic TWS byte stream (mostly ticks, plus order, position, execution, scanner and error traffic) is decoded by
+both readers.  The EWrapper calls each one makes are recorded and compared, including argument types, before the
+messages/sec figures are reported, the DecodingReader's also with ib.opt.metrics timing every message, and building
+ib.opt.slotted objects (whose fields must match the ext objects').  The calls of the event loop transport's
+TransportReader, which defers scanner and historical data rows until their message is decoded, must match too.
+
+    python -m bench.decoder [count]
+"""
+import random
+import sys
+import time
+
+from ib.ext.EClientSocket import EClientSocket
+from ib.ext.EReader import EReader
+from ib.lib import DataInputStream
+from ib.opt import metrics
+from ib.opt import slotted
+from ib.opt.decoder import DecodingReader
+from ib.opt.transport import TransportReader
+
+SERVER_VERSION = 76
+
+
+def message(*fields):
+    return '\0'.join(str(f) for f in fields) + '\0'
+
+
+def sample_messages():
+    """ One of each message kind we replay, with the relative weight it gets in the stream
+    """
+    R = EReader
+    return [
+        (50, message(R.TICK_PRICE, 6, 1, 1, '1.0845', 200, 1)),
+        (25, message(R.TICK_SIZE, 6, 1, 8, 12000)),
+        (5, message(R.TICK_OPTION_COMPUTATION, 6, 2, 13, '0.21', '0.55', '2.5', '0', '0.02', '0.11', '-0.03', '101.2')),
+        (5, message(R.TICK_GENERIC, 6, 1, 49, '0')),
+        (5, message(R.TICK_STRING, 6, 1, 45, '1445000000')),
+        (3, message(R.ORDER_STATUS, 6, 17, 'Submitted', 0, 100, '0', 123456, 0, '0', 3, '')),
+        (2, message(R.POSITION, 3, 'DU12345', 8314, 'IBM', 'STK', '', '0', '', '', 'NYSE', 'USD', 'IBM', 'IBM', 100,
+                    '150.25')),
+        (2, message(R.EXECUTION_DATA, 10, 7, 17, 8314, 'IBM', 'STK', '', '0', '', '', 'NYSE', 'USD', 'IBM', 'IBM',
+                    '0001.01', '20151020  10:00:00', 'DU12345', 'NYSE', 'BOT', 100, '150.25', 123456, 3, 0, 100,
+                    '150.25', '', '', '')),
+        (1, message(R.ACCOUNT_SUMMARY, 1, 9, 'DU12345', 'NetLiquidation', '100000.00', 'USD')),
+        (1, message(R.ERR_MSG, 2, -1, 2104, 'Market data farm connection is OK:usfarm')),
+        (1, message(R.NEXT_VALID_ID, 1, 18)),
+        (1, message(R.SCANNER_DATA, 3, 5, 3, *[f for rank in xrange(3) for f in (
+            rank, 8314 + rank, 'SYM{}'.format(rank), 'STK', '', '0', '', 'SMART', 'USD', 'SYM{}'.format(rank), 'NMS',
+            'SYM{}'.format(rank), '', '', '', '')])),
+        # decoded by the generated EReader branch in both readers
+        (1, message(R.HISTORICAL_DATA, 3, 4, '20151019 16:00:00', '20151020 16:00:00', 2,
+                    '20151019', '1.1', '1.2', '1.0', '1.15', 1000, '1.12', 'false', 10,
+                    '20151020', '1.15', '1.25', '1.1', '1.2', 1200, '1.18', 'false', 12)),
+    ]
+
+
+def build_stream(count, seed=0):
+    """ Builds a stream of count messages drawn from sample_messages by weight
+    """
+    rng = random.Random(seed)
+    weighted = [msg for weight, msg in sample_messages() for _ in xrange(weight)]
+    return ''.join(rng.choice(weighted) for _ in xrange(count))
+
+
+class ReplayStream(object):
+    """ Socket stand-in which serves a fixed byte string and then EOF
+    """
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def recv(self, size):
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += len(chunk)
+        return chunk
+
+
+def normalize(value):
+    """ :return: (type name, value), with IbPy objects (ext or slotted) as their m_ fields, nested ones included
+    """
+    if hasattr(value, '__dict__') or hasattr(value, '__slots__'):
+        return type(value).__name__, [(a, normalize(getattr(value, a))) for a in sorted(dir(value)) if a[:2] == 'm_']
+    if isinstance(value, list):
+        return 'list', [normalize(v) for v in value]
+    return type(value).__name__, value
+
+
+class RecordingWrapper(object):
+    """ EWrapper that records every call with its argument types, or just counts them
+    """
+    def __init__(self, record=True):
+        self.calls = []
+        self.count = 0
+        self.record = record
+
+    def __getattr__(self, name):
+        def method(*args):
+            self.count += 1
+            if self.record:
+                self.calls.append((name, [normalize(a) for a in args]))
+        return method
+
+
+def replay(reader_type, data, record=True):
+    """ Decodes all of data with a reader of the given type.
+
+    :return: (wrapper, messages decoded, seconds taken)
+    """
+    wrapper = RecordingWrapper(record)
+    parent = EClientSocket(wrapper)
+    parent.m_serverVersion = SERVER_VERSION
+    parent.m_connected = True
+    reader = reader_type(parent, DataInputStream(ReplayStream(data)))
+    messages = 0
+    start = time.time()
+    try:
+        while reader.processMsg(reader.readInt()):
+            messages += 1
+    except Exception:
+        pass  # end of stream
+    return wrapper, messages, time.time() - start
+
+
+def replay_transport(data):
+    """ Feeds all of data to a TransportReader, as a Channel would.
+
+    :return: wrapper
+    """
+    wrapper = RecordingWrapper()
+    parent = EClientSocket(wrapper)
+    parent.m_serverVersion = SERVER_VERSION
+    parent.m_connected = True
+    reader = TransportReader(parent)
+    reader.handshake.set()
+    reader.feed(data)
+    return wrapper
+
+
+def main(count=50000):
+    check = build_stream(2000, seed=1)
+    generated, _, _ = replay(EReader, check)
+    decoding, _, _ = replay(DecodingReader, check)
+    assert generated.calls == decoding.calls, 'EWrapper calls differ between readers'
+    slotted.enable()
+    try:
+        decoding, _, _ = replay(DecodingReader, check)
+    finally:
+        slotted.enable(False)
+    assert generated.calls == decoding.calls, 'EWrapper calls differ with slotted objects'
+    for enabled in (False, True):
+        slotted.enable(enabled)
+        try:
+            transport = replay_transport(check)
+        finally:
+            slotted.enable(False)
+        assert generated.calls == transport.calls, 'EWrapper calls differ with the loop transport'
+
+    data = build_stream(count)
+    print 'Replaying {} messages ({} bytes)'.format(count, len(data))
+    for reader_type in (EReader, DecodingReader):
+        wrapper, messages, seconds = replay(reader_type, data, record=False)
+        assert messages == count, '{} decoded {} of {} messages'.format(reader_type.__name__, messages, count)
+        print '  {:15s} {:10.0f} msgs/sec ({} EWrapper calls)'.format(
+            reader_type.__name__, messages / seconds, wrapper.count)
+    metrics.enable()
+    try:
+        wrapper, messages, seconds = replay(DecodingReader, data, record=False)
+    finally:
+        metrics.enable(False)
+    recorded = metrics.messageMetrics.decoded
+    assert sum(stats[0] for stats in recorded.values()) == count, 'Metrics missed messages'
+    assert sum(stats[1] for stats in recorded.values()) == len(data), 'Metrics miscounted bytes'
+    print '  {:15s} {:10.0f} msgs/sec'.format('+ metrics', messages / seconds)
+    slotted.enable()
+    try:
+        wrapper, messages, seconds = replay(DecodingReader, data, record=False)
+    finally:
+        slotted.enable(False)
+    print '  {:15s} {:10.0f} msgs/sec'.format('+ slotted', messages / seconds)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
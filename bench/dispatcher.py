@@ -0,0 +1,178 @@
+""" Benchmark of Dispatcher.__call__, and a check that it stays correct while listeners come and go on other threads.
+
+Messages are dispatched the way Receiver does it, by method name and keyword arguments, to two listeners: once through
+the lookup Dispatcher used to do on every message (type tuple, then the class' name, then its listeners), and once
+through the precomputed routes.  Then the same stream is dispatched while other threads keep registering and
+unregistering listeners, and a listener registered throughout must see every message exactly once.  Last, ticks for
+50 tickers are fed to Dispatcher.iterator consumers which sleep a millisecond per batch, once per overflow policy, and
+the batches, queue high water mark and dropped or conflated messages are reported.  Finally the same ticks go to a
+listener taking 0.1ms per call, directly, through a Conflator flushing every 50ms, and on a DispatchPool of 4 workers,
+reporting how long the dispatching thread (EReader in a real connection) was held up.
+
+    python -m bench.dispatcher [count] [threads]
+"""
+import sys
+import threading
+import time
+
+from ib.lib import maybeName
+from ib.opt.conflator import Conflator
+from ib.opt.dispatcher import Dispatcher, MessageQueue
+from ib.opt.pool import DispatchPool
+
+ARGS = dict(tickerId=1, field=1, price=1.0845, canAutoExecute=1)
+
+
+class LookupDispatcher(Dispatcher):
+    """ Dispatcher with the per message lookup it had before routes were precomputed
+    """
+    def __call__(self, name, args):
+        results = []
+        try:
+            messageType = self.messageTypes[name]
+            listeners = self.listeners[maybeName(messageType[0])]
+        except (KeyError, ):
+            return results
+        message = messageType[0](**args)
+        for listener in listeners:
+            try:
+                results.append(listener(message))
+            except (Exception, ):
+                self.logger.exception('Exception in message dispatch')
+                results.append(None)
+        return results
+
+
+class Counter(object):
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, message):
+        self.count += 1
+
+
+def dispatch(dispatcher, count, repeat=3):
+    """ :return: messages/sec, best of repeat runs
+    """
+    best = 0
+    for _ in xrange(repeat):
+        start = time.time()
+        for _ in xrange(count):
+            dispatcher('tickPrice', ARGS)
+        best = max(best, count / (time.time() - start))
+    return best
+
+
+def churn(dispatcher, count, threads):
+    """ Dispatches count messages while threads threads register and unregister listeners.
+
+    :return: messages the listener registered throughout received
+    """
+    steady = Counter()
+    dispatcher.register(steady, 'TickPrice')
+    done = threading.Event()
+
+    def flap():
+        listener = Counter()
+        while not done.isSet():
+            dispatcher.register(listener, 'TickPrice', 'TickSize')
+            dispatcher.unregister(listener, 'TickPrice', 'TickSize')
+
+    workers = [threading.Thread(target=flap) for _ in xrange(threads)]
+    for t in workers:
+        t.start()
+    try:
+        for _ in xrange(count):
+            dispatcher('tickPrice', ARGS)
+    finally:
+        done.set()
+        for t in workers:
+            t.join()
+    return steady.count
+
+
+def iterate(policy, count, maxsize=1000):
+    """ Dispatches count ticks to a slow iterator with the given overflow policy.
+
+    :return: (messages received, batches, seconds, MessageQueue)
+    """
+    dispatcher = Dispatcher()
+    messages = dispatcher.iterator('TickPrice', maxsize=maxsize, policy=policy)
+    received = []
+
+    def consume():
+        for batch in messages():
+            received.append(len(batch))
+            time.sleep(0.001)
+
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    start = time.time()
+    for i in xrange(count):
+        dispatcher('tickPrice', dict(tickerId=i % 50, field=1 + i % 2, price=i, canAutoExecute=0))
+    dispatcher('connectionClosed', {})
+    consumer.join()
+    return sum(received), len(received), time.time() - start, messages.queue
+
+
+def slow_listener(count, wrap=None):
+    """ Dispatches count ticks to a slow listener, wrapped by wrap if given.
+
+    :return: (listener calls, seconds dispatching, seconds until the last tick reached the listener)
+    """
+    dispatcher = Dispatcher()
+    calls = []
+
+    def slow(message):
+        calls.append(message.price)
+        time.sleep(0.0001)
+
+    listener = slow if wrap is None else wrap(slow)
+    dispatcher.register(listener, 'TickPrice')
+    start = time.time()
+    for i in xrange(count):
+        dispatcher('tickPrice', dict(tickerId=i % 50, field=1 + i % 2, price=i, canAutoExecute=0))
+    dispatched = time.time() - start
+    if isinstance(listener, Conflator):
+        listener.close()
+        listener.thread.join()
+    elif wrap is not None:
+        listener.pool.close()
+        listener.pool.join()
+    assert count - 1 in calls, 'Listener missed the last tick'
+    return len(calls), dispatched, time.time() - start
+
+
+def main(count=200000, threads=4):
+    print 'Dispatching {} tickPrice messages to 2 listeners'.format(count)
+    for dispatcher_type in (LookupDispatcher, Dispatcher):
+        dispatcher = dispatcher_type()
+        dispatcher.register(Counter(), 'TickPrice')
+        dispatcher.register(Counter(), 'TickPrice')
+        print '  {:17s} {:10.0f} msgs/sec'.format(dispatcher_type.__name__, dispatch(dispatcher, count))
+    received = churn(Dispatcher(), count // 4, threads)
+    assert received == count // 4, 'Listener got {} of {} messages while {} threads registered'.format(
+        received, count // 4, threads)
+    print '  {} messages dispatched while {} threads registered and unregistered listeners'.format(received, threads)
+
+    print 'Iterating {} ticks for 50 tickers with a consumer sleeping 1ms per batch'.format(count // 4)
+    print '  {:12s} {:>10s} {:>10s} {:>10s} {:>10s} {:>10s} {:>10s}'.format(
+        'policy', 'received', 'batches', 'seconds', 'high water', 'dropped', 'conflated')
+    for policy in MessageQueue.policies:
+        received, batches, seconds, queue = iterate(policy, count // 4)
+        stats = queue.toDict()
+        print '  {:12s} {:10d} {:10d} {:10.2f} {:10d} {:10d} {:10d}'.format(
+            policy, received, batches, seconds, stats['highWater'], stats['dropped'], stats['conflated'])
+        assert received + stats['dropped'] + stats['conflated'] == count // 4, 'Messages went missing'
+
+    print 'Dispatching {} ticks for 50 tickers to a listener taking 0.1ms per call'.format(count // 4)
+    print '  {:17s} {:>10s} {:>12s} {:>12s}'.format('listener', 'calls', 'dispatching', 'handled')
+    wraps = (('direct', None), ('conflated 50ms', lambda l: Conflator(l, 0.05)),
+             ('pool of 4', DispatchPool(4).wrap))
+    for name, wrap in wraps:
+        calls, dispatched, seconds = slow_listener(count // 4, wrap)
+        print '  {:17s} {:10d} {:11.2f}s {:11.2f}s'.format(name, calls, dispatched, seconds)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,103 @@
+""" Benchmark of the precompiled placeOrder/reqMktData encoders against the generated EClientSocket code.
+
+Both clients write into an in-memory stream, so this measures serialization only.  Payloads are compared byte for byte
+before timing so a regression in the encoder shows up as a failure rather than a speedup.
+
+    python -m bench.encoder [count] [serverVersion]
+"""
+import sys
+import time
+
+from ib.ext.Contract import Contract
+from ib.ext.EClientSocket import EClientSocket
+from ib.ext.Order import Order
+from ib.lib import DataOutputStream
+from ib.opt.encoder import EncodingClientSocket
+
+
+class MemoryStream(object):
+    """ Socket stand-in which records everything written to it
+    """
+    def __init__(self):
+        self.chunks = []
+        self.calls = 0
+
+    def send(self, data):
+        self.calls += 1
+        self.chunks.append(data)
+        return len(data)
+
+    sendall = send
+
+    def getvalue(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class NullWrapper(object):
+    """ Swallows EWrapper calls; errors are raised so a failing check cannot pass silently
+    """
+    def error(self, *args):
+        raise AssertionError('Unexpected error from client: {}'.format(args))
+
+
+def make_client(client_type, server_version):
+    stream = MemoryStream()
+    client = client_type(NullWrapper())
+    client.m_dos = DataOutputStream(stream)
+    client.m_serverVersion = server_version
+    client.m_connected = True
+    return client, stream
+
+
+def make_orders(count):
+    for i in xrange(count):
+        contract = Contract()
+        contract.m_symbol = ('AAPL', 'MSFT', 'EUR', 'IBM')[i % 4]
+        contract.m_secType = 'CASH' if contract.m_symbol == 'EUR' else 'STK'
+        contract.m_exchange = 'SMART'
+        contract.m_currency = 'USD'
+        order = Order()
+        order.m_action = 'BUY' if i % 2 else 'SELL'
+        order.m_totalQuantity = 100 + i
+        order.m_orderType = 'LMT'
+        order.m_lmtPrice = 100.25 + i
+        order.m_tif = 'DAY'
+        yield i + 1, contract, order
+
+
+def run(client, orders):
+    start = time.time()
+    for order_id, contract, order in orders:
+        client.placeOrder(order_id, contract, order)
+    return time.time() - start
+
+
+def main(count=10000, server_version=76):
+    orders = list(make_orders(count))
+    generated, generated_stream = make_client(EClientSocket, server_version)
+    encoding, encoding_stream = make_client(EncodingClientSocket, server_version)
+
+    # Sanity check: identical bytes on the wire for every order and for a market data request
+    for order_id, contract, order in orders[:100]:
+        generated.placeOrder(order_id, contract, order)
+        encoding.placeOrder(order_id, contract, order)
+        assert generated_stream.getvalue() == encoding_stream.getvalue(), 'placeOrder payload mismatch'
+    generated.reqMktData(1, orders[0][1], '100,101', False)
+    encoding.reqMktData(1, orders[0][1], '100,101', False)
+    assert generated_stream.getvalue() == encoding_stream.getvalue(), 'reqMktData payload mismatch'
+
+    generated_stream.calls = encoding_stream.calls = 0
+    generated_time = run(generated, orders)
+    encoding_time = run(encoding, orders)
+    print 'placeOrder x {} (server version {})'.format(count, server_version)
+    print '  generated:  {:8.2f} us/order, {:6.1f} writes/order'.format(
+        generated_time / count * 1e6, float(generated_stream.calls) / count)
+    print '  compiled:   {:8.2f} us/order, {:6.1f} writes/order'.format(
+        encoding_time / count * 1e6, float(encoding_stream.calls) / count)
+    print '  speedup:    {:8.1f}x'.format(generated_time / encoding_time)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,148 @@
+""" Benchmark of the memory held by decoded open orders and positions, as ib.ext objects and as ib.opt.slotted ones.
+
+A synthetic stream of openOrder messages (a stock limit order each) and as many position messages is decoded by a
+DecodingReader into a wrapper keeping every Contract, Order and OrderState, the way a service caching its open orders
+and positions would.  Each kind of object is decoded in a fresh interpreter, which reports how much its resident set
+grew, how many bytes the objects themselves (and their __dict__s) take, and how long decoding took.  The objects of
+both kinds are checked to have the same fields before.
+
+    python -m bench.memory [count]
+"""
+from __future__ import absolute_import
+
+import gc
+import json
+import resource
+import subprocess
+import sys
+import time
+
+from ib.ext.EClientSocket import EClientSocket
+from ib.ext.EReader import EReader
+from ib.lib import DataInputStream
+from ib.opt import slotted
+from ib.opt.decoder import DecodingReader
+from bench.decoder import SERVER_VERSION, ReplayStream, message, replay
+
+
+def open_order(i):
+    """ :return: openOrder message (version 32) for a stock limit order
+    """
+    symbol = ('AAPL', 'MSFT', 'IBM', 'GOOG')[i % 4]
+    return message(
+        EReader.OPEN_ORDER, 32, i + 1,
+        # contract
+        8314 + i, symbol, 'STK', '', '0', '', '', 'SMART', 'USD', symbol, 'NMS',
+        # order
+        'BUY' if i % 2 else 'SELL', 100 * (1 + i % 5), 'LMT', 100.0 + i % 50 / 4.0, '', 'GTC', '', 'DU12345', 'O', 0,
+        '', 3, 1000000 + i, 0, 0, '0', '', '', '', '', '', '', '', '', '', '', 0, '', -1, 0, '', '', '', '', '', 0, 0,
+        0, 0, '', 0, 0, 0, '', 0, 0, '', 0, '', 0, 0, '', '', '', '', '', 0, 0, 0, '', '', '', '', 0, '', 0, '', '', 0,
+        0, '',
+        # order state
+        0, 'Submitted', '1.7976931348623157E308', '1.7976931348623157E308', '1.7976931348623157E308',
+        '1.7976931348623157E308', '1.7976931348623157E308', '1.7976931348623157E308', '', '')
+
+
+def position(i):
+    symbol = ('AAPL', 'MSFT', 'IBM', 'GOOG')[i % 4]
+    return message(EReader.POSITION, 3, 'DU12345', 8314 + i, symbol, 'STK', '', '0', '', '', 'NYSE', 'USD', symbol,
+                   'NMS', 100 * (1 + i % 5), '150.25')
+
+
+def build_stream(count):
+    return ''.join(open_order(i) for i in xrange(count)) + ''.join(position(i) for i in xrange(count))
+
+
+class Holder(object):
+    """ EWrapper keeping the objects of every openOrder and position
+    """
+    def __init__(self):
+        self.orders = []
+        self.positions = []
+
+    def openOrder(self, orderId, contract, order, orderState):
+        self.orders.append((contract, order, orderState))
+
+    def position(self, account, contract, pos, avgCost):
+        self.positions.append((contract, pos, avgCost))
+
+    def __getattr__(self, name):
+        return lambda *args: None
+
+
+def rss():
+    """ :return: bytes resident, or the peak if the current size is not available
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def object_bytes(objects):
+    return sum(sys.getsizeof(obj) + (sys.getsizeof(obj.__dict__) if hasattr(obj, '__dict__') else 0)
+               for obj in objects)
+
+
+def decode(data, holder):
+    parent = EClientSocket(holder)
+    parent.m_serverVersion = SERVER_VERSION
+    parent.m_connected = True
+    reader = DecodingReader(parent, DataInputStream(ReplayStream(data)))
+    try:
+        while reader.processMsg(reader.readInt()):
+            pass
+    except EOFError:
+        pass  # end of stream
+
+
+def child(kind, count):
+    """ Decodes count open orders and positions into kind ('ext' or 'slotted') objects, printing the results as JSON
+    """
+    slotted.enable(kind == 'slotted')
+    data = build_stream(count)
+    decode(build_stream(1), Holder())
+    gc.collect()
+    before = rss()
+    holder = Holder()
+    start = time.time()
+    decode(data, holder)
+    seconds = time.time() - start
+    gc.collect()
+    grown = rss() - before
+    objects = [obj for row in holder.orders for obj in row] + [row[0] for row in holder.positions]
+    assert len(holder.orders) == len(holder.positions) == count, 'Messages went missing'
+    assert isinstance(holder.orders[0][1], slotted.Slotted) == (kind == 'slotted'), 'Decoded the wrong objects'
+    print json.dumps(dict(rss=grown, objects=object_bytes(objects), seconds=seconds))
+
+
+def check(count=100):
+    data = build_stream(count)
+    ext, _, _ = replay(DecodingReader, data)
+    slotted.enable()
+    try:
+        slots, _, _ = replay(DecodingReader, data)
+    finally:
+        slotted.enable(False)
+    assert len(ext.calls) == 2 * count, 'Messages went missing'
+    assert ext.calls == slots.calls, 'Slotted objects differ from ext objects'
+
+
+def main(count=100000):
+    check()
+    print 'Holding {} open orders and {} positions'.format(count, count)
+    print '  {:10s} {:>12s} {:>12s} {:>14s} {:>10s}'.format('objects', 'RSS growth', 'object bytes', 'RSS per order',
+                                                            'decoding')
+    for kind in ('ext', 'slotted'):
+        output = subprocess.check_output([sys.executable, '-m', 'bench.memory', kind, str(count)])
+        stats = json.loads(output.splitlines()[-1])
+        print '  {:10s} {:10.1f}MB {:10.1f}MB {:14.0f} {:9.2f}s'.format(
+            kind, stats['rss'] / 1e6, stats['objects'] / 1e6, stats['rss'] / float(count), stats['seconds'])
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] in (['ext'], ['slotted']):
+        child(sys.argv[1], int(sys.argv[2]))
+    else:
+        main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,154 @@
+""" Benchmark of tapping every dispatched message into ib.opt.messagelog, against logging them as text.
+
+The synthetic stream of bench.decoder (ticks, order, position, execution, scanner and error traffic), plus open orders,
+is decoded by a DecodingReader into a Receiver and a Dispatcher with one listener, as a connection does: without a tap,
+with Dispatcher.logMessage writing text lines to a log file, and with a MessageLog tap.  The messages read back from
+the log must equal those dispatched, and with small segments only the newest are kept.  Then a tenth of the log is
+queried by time range, and one message type out of all of it.
+
+    python -m bench.messagelog [count]
+"""
+from __future__ import absolute_import
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from ib.ext.EClientSocket import EClientSocket
+from ib.lib import DataInputStream
+from ib.opt.decoder import DecodingReader
+from ib.opt.dispatcher import Dispatcher
+from ib.opt.messagelog import MessageLog, MessageLogReader, SEGMENT_SUFFIX
+from ib.opt.receiver import Receiver
+from bench.decoder import SERVER_VERSION, ReplayStream, build_stream, normalize
+from bench.memory import open_order
+
+
+class Collector(object):
+    """ Listener keeping every message, or with record its items as they arrive (the decoder reuses the
+    ContractDetails of scanner rows)
+    """
+    def __init__(self, record=False):
+        self.messages = []
+        self.record = record
+
+    def __call__(self, message):
+        self.messages.append(as_items(message) if self.record else message)
+
+
+def make_stream(count):
+    """ :return: count messages of bench.decoder's stream, with an open order every 50
+    """
+    return build_stream(count - count // 50) + ''.join(open_order(i) for i in xrange(count // 50))
+
+
+def dispatch(data, setup=None, record=False):
+    """ Decodes data into a Dispatcher, set up by setup(dispatcher) if given.
+
+    :return: (messages dispatched, or their items with record, seconds)
+    """
+    dispatcher = Dispatcher()
+    collector = Collector(record)
+    dispatcher.registerAll(collector)
+    if setup is not None:
+        setup(dispatcher)
+    parent = EClientSocket(Receiver(dispatcher))
+    parent.m_serverVersion = SERVER_VERSION
+    parent.m_connected = True
+    reader = DecodingReader(parent, DataInputStream(ReplayStream(data)))
+    start = time.time()
+    try:
+        while reader.processMsg(reader.readInt()):
+            pass
+    except EOFError:
+        pass  # end of stream
+    return collector.messages, time.time() - start
+
+
+def as_items(message):
+    return message.typeName, [(k, normalize(v)) for k, v in message.items()]
+
+
+def check(directory):
+    data = make_stream(2000)
+    log = MessageLog(os.path.join(directory, 'check'))
+    tap = log.tap('check')
+    messages, _ = dispatch(data, lambda d: d.setTap(tap), record=True)
+    log.close()
+    read = list(MessageLogReader(log.directory).read())
+    assert messages == [as_items(m) for s, c, m in read], 'Logged messages differ'
+    assert set(c for s, c, m in read) == {tap.connectionId}, 'Wrong connection ids'
+    assert MessageLogReader(log.directory).connections()[tap.connectionId][1] == 'check'
+
+    log = MessageLog(os.path.join(directory, 'rotate'), segmentBytes=16 << 10, maxSegments=3, indexInterval=1024)
+    dispatch(data, lambda d: d.setTap(log.tap()))
+    log.close()
+    segments = [name for name in os.listdir(log.directory) if name.endswith(SEGMENT_SUFFIX)]
+    assert len(segments) == 3, 'Kept {} segments, not 3'.format(len(segments))
+    read = list(MessageLogReader(log.directory).read())
+    assert 0 < len(read) < len(messages), 'Rotated log has {} messages'.format(len(read))
+    assert messages[-len(read):] == [as_items(m) for s, c, m in read], 'Newest messages lost'
+
+
+def main(count=100000):
+    directory = tempfile.mkdtemp(prefix='ibrest-messagelog-')
+    try:
+        check(directory)
+        data = make_stream(count)
+
+        handler = logging.FileHandler(os.path.join(directory, 'messages.txt'))
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        text_logger = logging.getLogger('bench.messagelog')
+        text_logger.addHandler(handler)
+        text_logger.setLevel(logging.DEBUG)
+        text_logger.propagate = False
+
+        def text(dispatcher):
+            dispatcher.logger = text_logger
+            dispatcher.enableLogging()
+
+        log = MessageLog(os.path.join(directory, 'log'))
+        ways = (('no tap', None, None), ('logMessage text', text, handler.baseFilename),
+                ('MessageLog tap', lambda d: d.setTap(log.tap('bench')), log.directory))
+
+        print 'Dispatching {} messages'.format(count)
+        print '  {:17s} {:>12s} {:>12s} {:>12s}'.format('', 'msgs/sec', 'bytes', 'bytes/msg')
+        for name, setup, path in ways:
+            messages, seconds = dispatch(data, setup)
+            handler.flush()
+            log.close()
+            size = 0
+            if path is not None and os.path.isdir(path):
+                size = sum(os.path.getsize(os.path.join(path, n)) for n in os.listdir(path))
+            elif path is not None:
+                size = os.path.getsize(path)
+            print '  {:17s} {:12.0f} {:12d} {:12.1f}'.format(name, len(messages) / seconds, size,
+                                                             size / float(len(messages)))
+        handler.close()
+
+        reader = MessageLogReader(log.directory)
+        start = time.time()
+        times = [seconds for seconds, connectionId, message in reader.read()]
+        everything = time.time() - start
+        first, last = times[len(times) * 45 // 100], times[len(times) * 55 // 100]
+        start = time.time()
+        window = list(reader.read(first, last))
+        windowed = time.time() - start
+        assert len(window) == sum(1 for t in times if first <= t < last), 'Time range query missed messages'
+        start = time.time()
+        orders = list(reader.read(types='OpenOrder'))
+        typed = time.time() - start
+        assert len(orders) == count // 50, 'Found {} of {} open orders'.format(len(orders), count // 50)
+        print 'Querying the log'
+        print '  {:30s} {:10d} messages {:8.3f}s'.format('all of it', len(times), everything)
+        print '  {:30s} {:10d} messages {:8.3f}s'.format('a tenth by time', len(window), windowed)
+        print '  {:30s} {:10d} messages {:8.3f}s'.format('OpenOrder only', len(orders), typed)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,124 @@
+""" Checks that paced connections stay within TWS' message rate, against a stub server which counts messages per second.
+
+Each of several connections sends a burst of cancelMktData requests (three fields each, so the stub can count them) as
+fast as it can, once unpaced and once through ib/opt/pacer.py.  For every run the busiest one second window is
+reported per connection and over all connections, with how long the burst took to drain and the queueing delay the
+pacer recorded.  A paced run fails if any connection (or with gatewayRate, all of them together) exceeds rate + burst
+messages in a second, plus one for a message landing right on the edge of the window.
+
+    python -m bench.pacing [messages] [connections] [rate] [burst] [gatewayRate]
+
+gatewayRate (default 0, off) adds a bucket shared by all the connections, like IBREST_GATEWAY_PACE_RATE.
+"""
+import sys
+import threading
+import time
+
+from ib.opt import ibConnection
+from ib.opt.pacer import PacingStats, TokenBucket, pace
+from ib.opt.replay import FakeTWS
+from bench.decoder import message
+
+SERVER_VERSION = 76
+# cancelMktData sends its message id, version and tickerId
+FIELDS_PER_MESSAGE = 3
+# The client version and clientId the client sends when connecting
+HANDSHAKE_FIELDS = 2
+
+
+class CountingTWS(FakeTWS):
+    """ FakeTWS which records when each message arrives, per connection
+    """
+    def __init__(self):
+        self.fields = {}
+        self.arrivals = {}
+        self.lock = threading.Lock()
+        handshake = [(0.0, message(SERVER_VERSION, time.strftime('%Y%m%d %H:%M:%S EST')))]
+        FakeTWS.__init__(self, speed=0, onRequest=self.count, chunks=handshake)
+
+    def count(self, conn, fields):
+        now = time.time()
+        with self.lock:
+            seen = self.fields.get(conn, 0)
+            total = self.fields[conn] = seen + len(fields)
+            done = max(0, total - HANDSHAKE_FIELDS) // FIELDS_PER_MESSAGE
+            before = max(0, seen - HANDSHAKE_FIELDS) // FIELDS_PER_MESSAGE
+            self.arrivals.setdefault(conn, []).extend([now] * (done - before))
+
+    def received(self):
+        with self.lock:
+            return sum(len(times) for times in self.arrivals.values())
+
+
+def busiest_second(times):
+    """ :return: most messages arriving within any one second
+    """
+    times = sorted(times)
+    best, start = 0, 0
+    for end, t in enumerate(times):
+        while t - times[start] >= 1.0:
+            start += 1
+        best = max(best, end - start + 1)
+    return best
+
+
+def run(messages, connections, rate=None, burst=None, gateway_rate=0):
+    """ Sends messages cancelMktData requests on each of connections connections
+
+    :param rate: messages/sec per connection, or None to send unpaced
+    :return: (per connection busiest seconds, overall busiest second, seconds to drain, PacingStats)
+    """
+    tws = CountingTWS().start()
+    stats = PacingStats()
+    shared = TokenBucket(gateway_rate, burst) if rate is not None and gateway_rate else None
+    clients = []
+    for client_id in xrange(connections):
+        con = ibConnection('127.0.0.1', tws.port, client_id)
+        con.connect()
+        if rate is not None:
+            buckets = [TokenBucket(rate, burst)] + ([shared] if shared else [])
+            pace(con.sender.client, buckets, stats)
+        clients.append(con)
+
+    def burst_of(con):
+        for tickerId in xrange(messages):
+            con.cancelMktData(tickerId)
+
+    start = time.time()
+    threads = [threading.Thread(target=burst_of, args=(con, )) for con in clients]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    expected = messages * connections
+    while tws.received() < expected and time.time() - start < expected / float(rate or 1e6) + 30:
+        time.sleep(0.01)
+    seconds = time.time() - start
+    for con in clients:
+        con.disconnect()
+    tws.stop()
+    per_connection = [busiest_second(times) for times in tws.arrivals.values()]
+    overall = busiest_second([t for times in tws.arrivals.values() for t in times])
+    return per_connection, overall, seconds, stats
+
+
+def main(messages=200, connections=4, rate=44.0, burst=5.0, gateway_rate=0.0):
+    print '{} cancelMktData per connection, {} connections'.format(messages, connections)
+    print '  {:28s} {:>14s} {:>14s} {:>10s} {:>12s} {:>12s}'.format(
+        'run', 'max/s per con', 'max/s overall', 'seconds', 'mean delay', 'max delay')
+    runs = [('unpaced', None), ('paced {:g}/s burst {:g}{}'.format(
+        rate, burst, ', gateway {:g}/s'.format(gateway_rate) if gateway_rate else ''), rate)]
+    for name, run_rate in runs:
+        per_connection, overall, seconds, stats = run(messages, connections, run_rate, burst, gateway_rate)
+        delays = stats.toDict()
+        print '  {:28s} {:14d} {:14d} {:10.2f} {:10.1f}ms {:10.1f}ms'.format(
+            name, max(per_connection), overall, seconds, delays['meanDelayMs'], delays['maxDelayMs'])
+        if run_rate is not None:
+            assert max(per_connection) <= rate + burst + 1, 'A connection sent {} messages in one second'.format(
+                max(per_connection))
+            if gateway_rate:
+                assert overall <= gateway_rate + burst + 1, 'The gateway got {} messages in one second'.format(overall)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]] + [float(a) for a in sys.argv[3:6]])
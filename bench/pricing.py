@@ -0,0 +1,114 @@
+""" Throughput and cross-check harness for the local option pricing in pricing.py.
+
+With no arguments a synthetic book of contracts is priced with both backends (NumPy, if installed, and plain floats),
+the results are checked against each other and implied volatility is solved back from the prices, then contracts/sec
+are reported.
+
+Given a saved GET /options/<underlying>/chain response, the tickOptionComputation values TWS recorded in it are
+checked instead: implied volatility is solved locally from each optPrice and the greeks are recomputed at TWS' implied
+volatility, and the differences are summarized per value.  TWS uses its own rates and dividends, so pass the rate and
+dividend yield to use, and the date the chain was saved on so times to expiry match.
+
+    python -m bench.pricing [count]
+    python -m bench.pricing chain.json YYYYMMDD [rate] [dividendYield]
+"""
+from __future__ import absolute_import
+
+from datetime import datetime
+import json
+import random
+import sys
+import time
+
+import pricing
+
+
+def synthetic_book(count, seed=0):
+    rng = random.Random(seed)
+    under = [rng.uniform(20, 500) for _ in xrange(count)]
+    return dict(
+        right=[rng.choice('CP') for _ in xrange(count)],
+        underPrice=under,
+        strike=[u * rng.uniform(0.7, 1.3) for u in under],
+        time=[rng.uniform(1 / 365.0, 2) for _ in xrange(count)],
+        rate=0.02,
+        dividendYield=[rng.uniform(0, 0.04) for _ in xrange(count)],
+        volatility=[rng.uniform(0.08, 1.2) for _ in xrange(count)],
+    )
+
+
+def max_difference(a, b):
+    pairs = [(x, y) for x, y in zip(a, b) if x is not None and y is not None]
+    return max(abs(x - y) for x, y in pairs) if pairs else float('nan')
+
+
+def timed(data, use_numpy):
+    start = time.time()
+    results = pricing.compute(data, use_numpy)
+    return results, time.time() - start
+
+
+def synthetic(count=20000):
+    book = synthetic_book(count)
+    backends = [False] + ([True] if pricing.numpy is not None else [])
+    print 'Pricing {} contracts{}'.format(count, '' if pricing.numpy is not None else ' (NumPy not installed)')
+    for use_numpy in backends:
+        priced, price_time = timed(book, use_numpy)
+        solve = dict(book, optionPrice=priced['optPrice'])
+        del solve['volatility']
+        solved, solve_time = timed(solve, use_numpy)
+        # Options whose price barely moves with volatility (deep in or out of the money) do not pin it down; skip them
+        roundtrip = max_difference(book['volatility'], [v if vega > 1e-3 else None
+                                                        for v, vega in zip(solved['impliedVol'], priced['vega'])])
+        print '  {:6s} price+greeks {:10.0f}/sec   implied vol {:10.0f}/sec   max vol round trip error {:.2e}'.format(
+            'numpy' if use_numpy else 'float', count / price_time, count / solve_time, roundtrip)
+    if len(backends) == 2:
+        a, b = pricing.compute(book, False), pricing.compute(book, True)
+        worst = max(max_difference(a[k], b[k]) for k in pricing.OUTPUTS)
+        assert worst < 1e-9, 'Backends differ by {}'.format(worst)
+        print '  backends agree to {:.2e}'.format(worst)
+
+
+def cross_check(path, as_of, rate=0.0, dividend_yield=0.0):
+    """ Compares local results with the TWS computations in a saved option chain response
+    """
+    with open(path) as f:
+        chain = json.load(f)
+    now = datetime.strptime(as_of, '%Y%m%d').replace(hour=16)
+    rows = dict(right=[], strike=[], underPrice=[], time=[], optionPrice=[], volatility=[])
+    recorded = {k: [] for k in ('impliedVol', 'delta', 'gamma', 'vega', 'theta')}
+    for side, right in (('calls', 'C'), ('puts', 'P')):
+        grid = chain[side]
+        for i, expiry in enumerate(chain['expiries']):
+            for j, strike in enumerate(chain['strikes']):
+                if None in (grid['optPrice'][i][j], grid['undPrice'][i][j], grid['impliedVol'][i][j]):
+                    continue
+                rows['right'].append(right)
+                rows['strike'].append(strike)
+                rows['underPrice'].append(grid['undPrice'][i][j])
+                rows['time'].append(pricing.years_to_expiry(expiry, now))
+                rows['optionPrice'].append(grid['optPrice'][i][j])
+                rows['volatility'].append(grid['impliedVol'][i][j])
+                for k in recorded:
+                    recorded[k].append(grid[k][i][j])
+    if not rows['strike']:
+        print 'No complete tickOptionComputation values in {}'.format(path)
+        return
+    common = dict(rows, rate=rate, dividendYield=dividend_yield)
+    implied = pricing.compute({k: v for k, v in common.iteritems() if k != 'volatility'})
+    at_tws_vol = pricing.compute({k: v for k, v in common.iteritems() if k != 'optionPrice'})
+    print 'Cross-checking {} TWS computations from {} (as of {}, rate {}, dividend yield {})'.format(
+        len(rows['strike']), path, as_of, rate, dividend_yield)
+    print '  {:10s} {:>12s} {:>12s}'.format('value', 'median diff', 'max diff')
+    for k, local in [('impliedVol', implied['impliedVol'])] + [(k, at_tws_vol[k]) for k in
+                                                                ('delta', 'gamma', 'vega', 'theta')]:
+        diffs = sorted(abs(a - b) for a, b in zip(local, recorded[k]) if a is not None and b is not None)
+        if diffs:
+            print '  {:10s} {:12.2e} {:12.2e}'.format(k, diffs[len(diffs) // 2], diffs[-1])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        cross_check(sys.argv[1], sys.argv[2], *[float(a) for a in sys.argv[3:5]])
+    else:
+        synthetic(*[int(a) for a in sys.argv[1:2]])
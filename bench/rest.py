@@ -0,0 +1,343 @@
+""" End-to-end load test of the REST API against a scripted TWS stand-in.
+
+The Flask app is served in-process and pointed at ScriptedTWS, which completes the handshake, hands out orderIds and
+answers placeOrder, reqPositions, reqMktData, contract details, fundamentals and scanner requests the way TWS would.
+Worker threads then hit each endpoint at the requested concurrency and the throughput and latency percentiles are
+reported, so a slowdown in the request path shows up before a deploy rather than after.  Under each endpoint, the mean
+time of each phase from the responses' Server-Timing headers (see tracing.py) shows where that time went.
+
+    python -m bench.rest [--serve] [--gateways=N] [requests] [concurrency] [endpoint ...]
+
+where endpoint is any of order, market, positions, scanner, fundamentals, chain (default: all of them).  With --serve
+the app is run on serve.py's event loop rather than Werkzeug's threaded server.  With --gateways=N, N stubs are started
+and configured as IBREST_GATEWAYS, each with its own 8 clientIds.
+"""
+import os
+import sys
+import threading
+import time
+import urllib
+import urllib2
+
+from ib.ext.EClientSocket import EClientSocket
+from ib.ext.EReader import EReader
+from ib.ext.TickType import TickType
+from ib.opt.replay import FakeTWS
+from bench.decoder import message
+
+SERVER_VERSION = 76
+POSITIONS = 20
+TICKS = 10
+SCAN_ROWS = 50
+SCANNER_PARAMETERS = '''<ScanParameterResponse>
+<InstrumentList><Instrument><name>US Stocks</name><type>STK</type><secType>STK</secType></Instrument></InstrumentList>
+<LocationTree><Location><displayName>US Stocks</displayName><locationCode>STK.US</locationCode><instruments>STK</instruments>
+<LocationTree><Location><displayName>US Major</displayName><locationCode>STK.US.MAJOR</locationCode>
+<instruments>STK</instruments></Location></LocationTree></Location></LocationTree>
+<ScanTypeList><ScanType><displayName>Top % Gainers</displayName><scanCode>TOP_PERC_GAIN</scanCode>
+<instruments>STK,STOCK.NA</instruments></ScanType></ScanTypeList>
+</ScanParameterResponse>'''
+FUNDAMENTALS_ROWS = 2000
+UNDER_PRICE = 150.25
+EXPIRIES = ['20151120', '20151218', '20160115']
+STRIKES = [100 + 2.5 * i for i in xrange(41)]
+
+
+# ---------------------------------------------------------------------
+# TWS STAND-IN
+# ---------------------------------------------------------------------
+class Session(object):
+    """ Tracks where one client connection is in its request stream.
+
+    The stub only understands the requests IBREST sends.  Once it sees a request whose length it cannot know in advance
+    (placeOrder, reqScannerSubscription) it answers it and stops parsing that connection; IBREST never sends
+    anything after those but a disconnect or a cancel.
+    """
+    def __init__(self):
+        self.fields = []
+        self.clientId = None
+        self.opaque = False
+
+
+class ScriptedTWS(FakeTWS):
+    """ FakeTWS which answers IBREST's requests instead of replaying a recording
+    """
+    def __init__(self, port=0, nextOrderId=1):
+        self.sessions = {}
+        self.nextOrderId = nextOrderId
+        self.permId = 100000
+        self.lock = threading.Lock()
+        handshake = [(0.0, message(SERVER_VERSION, time.strftime('%Y%m%d %H:%M:%S EST')))]
+        FakeTWS.__init__(self, port=port, speed=0, onRequest=self.respond, chunks=handshake)
+
+    def respond(self, conn, fields):
+        session = self.sessions.setdefault(conn, Session())
+        if session.opaque:
+            return
+        session.fields.extend(fields)
+        while session.fields and not session.opaque:
+            if not self.step(conn, session):
+                break
+
+    def step(self, conn, session):
+        """ Consume one complete message from the session's fields, answering it.
+
+        :return: False if more fields are needed
+        """
+        f = session.fields
+        if session.clientId is None:
+            # client version, then client id
+            if len(f) < 2:
+                return False
+            session.clientId = int(f[1])
+            del f[:2]
+            conn.sendall(message(EReader.NEXT_VALID_ID, 1, self.nextOrderId) +
+                         message(EReader.MANAGED_ACCTS, 1, 'DU12345'))
+            return True
+        msgId = int(f[0])
+        if msgId == EClientSocket.REQ_IDS:
+            if len(f) < 3:
+                return False
+            del f[:3]
+            conn.sendall(message(EReader.NEXT_VALID_ID, 1, self.nextOrderId))
+        elif msgId == EClientSocket.REQ_POSITIONS:
+            if len(f) < 2:
+                return False
+            del f[:2]
+            conn.sendall(self.positions())
+        elif msgId == EClientSocket.PLACE_ORDER:
+            if len(f) < 3:
+                return False
+            session.opaque = True
+            conn.sendall(self.orderStatus(int(f[2]), session.clientId))
+        elif msgId == EClientSocket.REQ_CONTRACT_DATA:
+            if len(f) < 17:
+                return False
+            reqId, symbol, secType = int(f[2]), f[4], f[5]
+            del f[:17]
+            if secType in ('OPT', 'FOP'):
+                data = ''.join(self.contractDetails(reqId, symbol, 9000 + n, secType, expiry, strike, right, '100')
+                               for n, (expiry, strike, right) in enumerate(
+                                   (e, k, r) for e in EXPIRIES for k in STRIKES for r in 'CP'))
+            else:
+                data = self.contractDetails(reqId, symbol, 8314)
+            conn.sendall(data + message(EReader.CONTRACT_DATA_END, 1, reqId))
+        elif msgId == EClientSocket.REQ_FUNDAMENTAL_DATA:
+            if len(f) < 11:
+                return False
+            reqId, reportType = int(f[2]), f[10]
+            del f[:11]
+            conn.sendall(message(EReader.FUNDAMENTAL_DATA, 1, reqId, self.fundamentals(reportType)))
+        elif msgId == EClientSocket.REQ_SCANNER_PARAMETERS:
+            if len(f) < 2:
+                return False
+            del f[:2]
+            conn.sendall(message(EReader.SCANNER_PARAMETERS, 1, SCANNER_PARAMETERS))
+        elif msgId == EClientSocket.REQ_SCANNER_SUBSCRIPTION:
+            if len(f) < 3:
+                return False
+            session.opaque = True
+            conn.sendall(self.scan(int(f[2])))
+        elif msgId == EClientSocket.REQ_MKT_DATA:
+            # contract fields, an underComp flag with its three fields if set, genericTicks and snapshot; no BAGs
+            if len(f) < 16 or len(f) < 18 + 3 * (f[15] == '1'):
+                return False
+            tickerId, secType, strike, right = int(f[2]), f[5], float(f[7]), f[8]
+            snapshot = f[17 + 3 * (f[15] == '1')] == '1'
+            del f[:18 + 3 * (f[15] == '1')]
+            if secType in ('OPT', 'FOP'):
+                conn.sendall(self.optionComputation(tickerId, strike, right))
+            else:
+                conn.sendall(self.ticks(tickerId))
+            if snapshot:
+                conn.sendall(message(EReader.TICK_SNAPSHOT_END, 1, tickerId))
+        elif msgId in (EClientSocket.REQ_CALC_IMPLIED_VOLAT, EClientSocket.REQ_CALC_OPTION_PRICE):
+            if len(f) < 17:
+                return False
+            reqId = int(f[2])
+            del f[:17]
+            conn.sendall(self.optionComputation(reqId, UNDER_PRICE, 'C', TickType.CUST_OPTION_COMPUTATION))
+        elif msgId in (EClientSocket.CANCEL_MKT_DATA, EClientSocket.CANCEL_CALC_IMPLIED_VOLAT,
+                       EClientSocket.CANCEL_CALC_OPTION_PRICE):
+            if len(f) < 3:
+                return False
+            del f[:3]
+        else:
+            raise ValueError('ScriptedTWS cannot parse request {}'.format(msgId))
+        return True
+
+    def orderStatus(self, orderId, clientId):
+        with self.lock:
+            self.permId += 1
+            self.nextOrderId = max(self.nextOrderId, orderId + 1)
+            permId = self.permId
+        return message(EReader.ORDER_STATUS, 6, orderId, 'Submitted', 0, 100, '0', permId, 0, '0', clientId, '')
+
+    def positions(self):
+        data = [message(EReader.POSITION, 3, 'DU12345', 8314 + i, 'SYM{}'.format(i), 'STK', '', '0', '', '',
+                        'NYSE', 'USD', 'SYM{}'.format(i), 'SYM{}'.format(i), 100 + i, '150.25')
+                for i in xrange(POSITIONS)]
+        return ''.join(data) + message(EReader.POSITION_END, 1)
+
+    def ticks(self, tickerId):
+        data = []
+        for i in xrange(TICKS):
+            data.append(message(EReader.TICK_PRICE, 6, tickerId, 1 + i % 2, UNDER_PRICE + i * 0.01, 200, 1))
+            data.append(message(EReader.TICK_SIZE, 6, tickerId, 0 + i % 2 * 3, 1000 + i))
+        data.append(message(EReader.TICK_PRICE, 6, tickerId, TickType.LAST, UNDER_PRICE, 100, 1))
+        return ''.join(data)
+
+    def optionComputation(self, tickerId, strike, right, field=TickType.MODEL_OPTION):
+        moneyness = (UNDER_PRICE - strike) / UNDER_PRICE
+        delta = max(0.01, min(0.99, 0.5 + 2 * moneyness)) - (1 if right == 'P' else 0)
+        return message(EReader.TICK_OPTION_COMPUTATION, 6, tickerId, field, 0.25 + abs(moneyness),
+                       delta, max(UNDER_PRICE - strike, 0) + 2.5, 0, 0.02, 0.15, -0.04, UNDER_PRICE)
+
+    def contractDetails(self, reqId, symbol, conId, secType='STK', expiry='', strike='0', right='', multiplier=''):
+        return message(EReader.CONTRACT_DATA, 8, reqId, symbol, secType, expiry, strike, right, 'SMART', 'USD', symbol,
+                       'NMS', symbol, conId, '0.01', multiplier, 'LMT,MKT', 'SMART,NYSE', 1, 0, symbol + ' CORP',
+                       'NYSE', '', 'Technology', 'Computers', 'Software', 'EST', '', '', '', '0', 0)
+
+    def fundamentals(self, reportType):
+        rows = ''.join('<Ratio FieldName="R{0}" Type="N">{0}.5</Ratio>'.format(i) for i in xrange(FUNDAMENTALS_ROWS))
+        return '<ReportSnapshot Major="1" Minor="0"><Ratios>{}</Ratios></ReportSnapshot>'.format(rows)
+
+    def scan(self, tickerId):
+        rows = [(rank, 8314 + rank, 'SYM{}'.format(rank), 'STK', '', '0', '', 'SMART', 'USD', 'SYM{}'.format(rank),
+                 'NMS', 'SYM{}'.format(rank), '', '', '', '') for rank in xrange(SCAN_ROWS)]
+        return message(EReader.SCANNER_DATA, 3, tickerId, len(rows), *[f for row in rows for f in row])
+
+
+# ---------------------------------------------------------------------
+# LOAD GENERATION
+# ---------------------------------------------------------------------
+def serve_app(tws_ports, non_blocking=False):
+    """ Starts the Flask app in a background thread, connected to the stubs on tws_ports.
+
+    :param non_blocking: serve with serve.py's event loop instead of Werkzeug's threaded server
+    :return: base URL of the running app
+    """
+    os.environ['IBREST_GATEWAYS'] = ','.join('tws{}=127.0.0.1:{}'.format(i, port) for i, port in enumerate(tws_ports))
+    # sync has to be imported before app; the other order trips over their circular import
+    import sync
+    from app import app
+    if non_blocking:
+        import serve
+        server = serve.HttpServer('127.0.0.1', 0)
+        thread = threading.Thread(target=server.loop.run_forever, name='IBREST')
+        thread.setDaemon(True)
+        thread.start()
+        return 'http://127.0.0.1:{}'.format(server.port)
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, name='IBREST')
+    thread.setDaemon(True)
+    thread.start()
+    return 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+ENDPOINTS = {
+    'order': ('/order', {'symbol': 'IBM', 'orderType': 'LMT', 'totalQuantity': 100, 'action': 'BUY'}),
+    'market': ('/market/EUR', None),
+    'positions': ('/portfolio/positions', None),
+    'scanner': ('/scanner', {'scanCode': 'TOP_PERC_GAIN', 'numberOfRows': SCAN_ROWS}),
+    'fundamentals': ('/fundamentals/IBM/ReportSnapshot?format=json', None),
+    'chain': ('/options/IBM/chain', None),
+}
+
+
+def call(url, data=None):
+    """ :return: (seconds taken, HTTP status, {phase: ms} from the Server-Timing header)
+    """
+    start = time.time()
+    headers = {}
+    try:
+        resp = urllib2.urlopen(url, urllib.urlencode(data) if data else None)
+        resp.read()
+        status, headers = resp.getcode(), resp.info()
+    except urllib2.HTTPError as e:
+        status, headers = e.code, e.info()
+    except urllib2.URLError:
+        status = None
+    return time.time() - start, status, parse_server_timing(headers.get('Server-Timing', ''))
+
+
+def parse_server_timing(value):
+    """ :return: {phase: ms} from a Server-Timing header value like 'tws;dur=41.5, total;dur=45.0'
+    """
+    timings = {}
+    for entry in value.split(','):
+        name, _, duration = entry.strip().partition(';dur=')
+        if duration:
+            timings[name] = float(duration)
+    return timings
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    index = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def load(url, count, concurrency, data=None):
+    """ Makes count requests to url from concurrency threads.
+
+    :return: (list of latencies, number of failed requests, seconds taken, list of Server-Timing dicts)
+    """
+    latencies = []
+    timings = []
+    failures = [0]
+    remaining = [count]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            seconds, status, timing = call(url, data)
+            with lock:
+                latencies.append(seconds)
+                timings.append(timing)
+                if status != 200:
+                    failures[0] += 1
+
+    threads = [threading.Thread(target=worker) for _ in xrange(concurrency)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, failures[0], time.time() - start, timings
+
+
+def main(count=40, concurrency=4, *endpoints, **kwargs):
+    non_blocking = kwargs.get('non_blocking', False)
+    stubs = [ScriptedTWS().start() for _ in xrange(kwargs.get('gateways', 1))]
+    base = serve_app([tws.port for tws in stubs], non_blocking)
+    print '{} requests per endpoint, {} concurrent (stub TWS on port {}, {} server)'.format(
+        count, concurrency, ', '.join(str(tws.port) for tws in stubs), 'serve.py' if non_blocking else 'threaded Werkzeug')
+    print '  {:12s} {:>8s} {:>8s} {:>10s} {:>10s} {:>10s}'.format('endpoint', 'req/s', 'errors', 'p50 ms', 'p99 ms',
+                                                                 'max ms')
+    for name in endpoints or sorted(ENDPOINTS):
+        path, data = ENDPOINTS[name]
+        latencies, failures, seconds, timings = load(base + path, count, concurrency, data)
+        latencies.sort()
+        print '  {:12s} {:8.1f} {:8d} {:10.1f} {:10.1f} {:10.1f}'.format(
+            name, count / seconds, failures, percentile(latencies, 50) * 1e3, percentile(latencies, 99) * 1e3,
+            latencies[-1] * 1e3)
+        phases = sorted(set(phase for timing in timings for phase in timing), key=lambda p: (p == 'total', p))
+        if phases:
+            print '    mean ms: ' + '  '.join('{} {:.1f}'.format(
+                phase, sum(timing.get(phase, 0) for timing in timings) / len(timings)) for phase in phases)
+    for tws in stubs:
+        tws.stop()
+
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    options = dict(a[2:].partition('=')[::2] for a in sys.argv[1:] if a.startswith('--'))
+    main(*[int(a) for a in args[:2]] + args[2:], non_blocking='serve' in options,
+         gateways=int(options.get('gateways') or 1))
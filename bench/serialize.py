@@ -0,0 +1,223 @@
+""" Benchmark of rendering a large open orders response, the way sync.order_handler and the JSON representation did it
+before serializers.py and the way they do it now.
+
+Every openOrder message gets a Contract, an Order and an OrderState with all of their fields assigned, as EReader does,
+and an orderStatus message follows each.  The old way copies each object's __dict__ (m_ names, defaults and all), then
+the row twice, and renders it with the standard library.  The new way keeps each object's set, non-default fields
+under their IB API names and renders them with the standard library, and with ujson if it is installed.  The decoded
+responses are checked against the objects before timing.
+
+Then a positions response (one row per open order's contract) and a /options/compute response for as many contracts
+(NumPy columns) are rendered in each format the API negotiates, and parsed back the way a client would (into an Arrow
+table rather than rows, for Arrow), checking the parsed data against the JSON.  Formats whose library is not installed
+are skipped.
+
+    python -m bench.serialize [orders]
+"""
+from __future__ import absolute_import
+
+import json
+import sys
+import time
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+from ib.ext.Contract import Contract
+from ib.ext.Order import Order
+from ib.ext.OrderState import OrderState
+from ib.opt import message
+import pricing
+import serializers
+
+OpenOrder = message.registry['openOrder'][0]
+OrderStatus = message.registry['orderStatus'][0]
+
+
+def assign_all(obj):
+    """ Sets every field of obj to its current value, so that its __dict__ holds them all like EReader's objects
+    """
+    for attr in dir(obj):
+        if attr.startswith('m_') and not callable(getattr(obj, attr)):
+            setattr(obj, attr, getattr(obj, attr))
+    return obj
+
+
+def make_messages(count):
+    messages = []
+    for i in xrange(count):
+        contract = assign_all(Contract())
+        contract.m_conId = 8314 + i
+        contract.m_symbol = ('AAPL', 'MSFT', 'IBM', 'GOOG')[i % 4]
+        contract.m_secType = 'STK'
+        contract.m_exchange = 'SMART'
+        contract.m_currency = 'USD'
+        contract.m_localSymbol = contract.m_symbol
+        contract.m_tradingClass = 'NMS'
+        order = assign_all(Order())
+        order.m_orderId = i + 1
+        order.m_clientId = 3
+        order.m_permId = 1000000 + i
+        order.m_action = 'BUY' if i % 2 else 'SELL'
+        order.m_totalQuantity = 100 * (1 + i % 5)
+        order.m_orderType = 'LMT'
+        order.m_lmtPrice = 100.0 + i % 50 / 4.0
+        order.m_tif = 'GTC'
+        order.m_account = 'DU12345'
+        state = assign_all(OrderState())
+        state.m_status = 'Submitted'
+        state.m_initMargin = '1.7976931348623157E308'
+        state.m_commission = sys.float_info.max
+        messages.append(OpenOrder(orderId=i + 1, contract=contract, order=order, orderState=state))
+        messages.append(OrderStatus(orderId=i + 1, status='Submitted', filled=0, remaining=order.m_totalQuantity,
+                                    avgFillPrice=0.0, permId=order.m_permId, parentId=0, lastFillPrice=0.0, clientId=3,
+                                    whyHeld=''))
+    return messages
+
+
+def old_handle(messages):
+    """ sync.order_handler before serializers.py
+    """
+    resp = dict(openOrderEnd=False, openOrder=[], orderStatus=[])
+    by_order = dict()
+    for msg in messages:
+        d = dict()
+        for i in msg.items():
+            if isinstance(i[1], (Contract, Order, OrderState)):
+                d[i[0]] = i[1].__dict__
+            else:
+                d[i[0]] = i[1]
+        resp[msg.typeName].append(d.copy())
+        by_order.setdefault(d['orderId'], dict(openOrder=[], orderStatus=[]))[msg.typeName].append(d.copy())
+    return resp
+
+
+def new_handle(messages):
+    """ sync.order_handler now
+    """
+    resp = dict(openOrderEnd=False, openOrder=[], orderStatus=[])
+    by_order = dict()
+    for msg in messages:
+        d = dict(msg.items())
+        if msg.typeName == 'openOrder':
+            d['contract'] = serializers.to_dict(msg.contract)
+            d['order'] = serializers.to_dict(msg.order)
+            d['orderState'] = serializers.to_dict(msg.orderState)
+        resp[msg.typeName].append(d)
+        by_order.setdefault(d['orderId'], dict(openOrder=[], orderStatus=[]))[msg.typeName].append(d)
+    return resp
+
+
+def check(messages, rendered):
+    """ Every field in the response must be the object's, and every one left out its default or unset
+    """
+    orders = json.loads(rendered)['openOrder']
+    assert len(orders) == len(messages) // 2, 'Orders went missing'
+    for msg, row in zip(messages[::2], orders):
+        for name in ('contract', 'order', 'orderState'):
+            obj, fields = getattr(msg, name), row[name]
+            schema = serializers._schemas[type(obj)]
+            for key, default in zip(schema.keys, schema.defaults):
+                value = getattr(obj, 'm_' + key)
+                if key in fields:
+                    assert fields[key] == value, '{}.{} is {!r}, not {!r}'.format(name, key, fields[key], value)
+                else:
+                    assert value == default or value in serializers._unset, '{}.{} left out'.format(name, key)
+
+
+def render(messages, backend):
+    saved, serializers._backend = serializers._backend, backend
+    try:
+        return serializers.dumps(new_handle(messages))
+    finally:
+        serializers._backend = saved
+
+
+def positions(messages):
+    rows = [dict(account='DU12345', contract=serializers.to_dict(msg.contract), pos=msg.order.m_totalQuantity,
+                 avgCost=msg.order.m_lmtPrice) for msg in messages[::2]]
+    return dict(positionEnd=True, positions=rows)
+
+
+def computations(count):
+    return serializers.Columns(pricing.evaluate(dict(
+        right=['C' if i % 2 else 'P' for i in xrange(count)], strike=[80.0 + i % 40 for i in xrange(count)],
+        underPrice=100.0, time=[0.05 + i % 12 / 12.0 for i in xrange(count)], rate=0.01, volatility=0.25)))
+
+
+def formats():
+    """ :return: list of (name, render, parse, as_json), where as_json turns what parse returns into what the JSON would
+    decode to
+    """
+    def arrow_as_json(table, data):
+        columns, metadata = table.to_pydict(), table.schema.metadata
+        if isinstance(data, serializers.Columns):
+            return dict(columns)
+        rows = [dict() for _ in xrange(len(columns.values()[0]))]
+        for name, values in columns.iteritems():
+            for row, value in zip(rows, values):
+                if value is not None:
+                    keys = name.split('.')
+                    reduce(lambda d, k: d.setdefault(k, dict()), keys[:-1], row)[keys[-1]] = value
+        return dict(((k, json.loads(v)) for k, v in metadata.iteritems()), positions=rows)
+
+    as_is = lambda parsed, data: parsed
+    ways = [('json', serializers.dumps, json.loads, as_is)]
+    if serializers.ujson is not None:
+        ways[0] = ('ujson', serializers.dumps, serializers.ujson.loads, as_is)
+    if msgpack is not None:
+        ways.append(('msgpack', serializers.packb, lambda stream: msgpack.unpackb(stream, raw=False), as_is))
+    if pyarrow is not None:
+        ways.append(('arrow', serializers.arrow_stream,
+                     lambda stream: pyarrow.ipc.open_stream(pyarrow.py_buffer(stream)).read_all(), arrow_as_json))
+    return ways
+
+
+def best(function, repeat=3):
+    """ :return: (result, seconds), best of repeat runs
+    """
+    seconds = None
+    for _ in xrange(repeat):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    return result, seconds
+
+
+def main(orders=5000):
+    messages = make_messages(orders)
+    ways = [('__dict__ + json', lambda: json.dumps(old_handle(messages)))]
+    backends = ['json'] + (['ujson'] if serializers.ujson is not None else [])
+    for backend in backends:
+        ways.append(('schema + {}'.format(backend), lambda backend=backend: render(messages, backend)))
+    for backend in backends:
+        check(messages, render(messages, backend))
+
+    print 'Handling and rendering {} open orders, each with an orderStatus'.format(orders)
+    print '  {:17s} {:>10s} {:>12s} {:>12s}'.format('', 'bytes', 'seconds', 'orders/sec')
+    for name, way in ways:
+        rendered, seconds = best(way)
+        print '  {:17s} {:10d} {:11.3f}s {:12.0f}'.format(name, len(rendered), seconds, orders / seconds)
+    if serializers.ujson is None:
+        print '  (ujson is not installed)'
+
+    for name, data in (('positions', positions(messages)), ('option computations', computations(orders))):
+        print 'Rendering and parsing {} {}'.format(orders, name)
+        print '  {:17s} {:>10s} {:>12s} {:>12s}'.format('', 'bytes', 'render', 'parse')
+        expected = json.loads(serializers.dumps(data))
+        for format_name, render_format, parse, as_json in formats():
+            stream, rendered = best(lambda: render_format(data))
+            parsed, parsed_in = best(lambda: parse(stream))
+            assert as_json(parsed, data) == expected, '{} differs from JSON'.format(format_name)
+            print '  {:17s} {:10d} {:11.3f}s {:11.3f}s'.format(format_name, len(stream), rendered, parsed_in)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,118 @@
+""" On-disk cache of fundamental data reports for the /fundamentals endpoint.
+
+reqFundamentalData returns XML reports of several hundred KB which change at most daily, so each report is stored
+gzipped under its (conId, reportType, date) key and served from disk for the rest of the day.  A JSON rendering of a
+report is made the first time it is asked for and cached alongside the XML, so both formats are parsed at most once.
+"""
+from threading import Lock
+from xml.etree import cElementTree as ElementTree
+import gzip
+import json
+import os
+import tempfile
+import time
+
+# ---------------------------------------------------------------------
+# GLOBAL PARAMETERS
+# ---------------------------------------------------------------------
+# Configuration
+_cache_dir = os.getenv('IBREST_FUNDAMENTALS_DIR', os.path.join(tempfile.gettempdir(), 'ibrest', 'fundamentals'))
+
+# https://www.interactivebrokers.com/en/software/api/apiguide/tables/fundamental_data_reporttypes.htm
+REPORT_TYPES = ['ReportSnapshot', 'ReportsFinSummary', 'ReportRatios', 'ReportsFinStatements', 'RESC',
+                'CalendarReport', 'ReportsOwnership']
+CHUNK_SIZE = 64 * 1024
+
+# conIds never change for a contract, so symbol lookups are kept for the life of the process.  Keyed by the
+# contractKey (ib/opt/contractkey.py) of the contract looked up, without its conId
+con_ids = dict()
+
+
+def today():
+    return time.strftime('%Y%m%d')
+
+
+# ---------------------------------------------------------------------
+# XML TO JSON
+# ---------------------------------------------------------------------
+def element_to_dict(elem):
+    """ Converts an XML element to JSON-friendly data.  Attributes become keys, children become lists keyed by tag (even
+    when there is only one, so the shape does not depend on the report), and text is kept under '#text' unless the
+    element has nothing else, in which case the text itself is returned.
+    """
+    d = dict(elem.attrib)
+    for child in elem:
+        d.setdefault(child.tag, []).append(element_to_dict(child))
+    text = (elem.text or '').strip()
+    if text:
+        if not d:
+            return text
+        d['#text'] = text
+    return d
+
+
+# ---------------------------------------------------------------------
+# CACHE
+# ---------------------------------------------------------------------
+class FundamentalsCache(object):
+    """ Gzipped reports stored as <directory>/<reportType>/<date>/<conId>.<format>.gz
+    """
+
+    def __init__(self, directory=_cache_dir):
+        self.directory = directory
+        self._lock = Lock()
+
+    def path(self, conId, reportType, date, fmt='xml'):
+        return os.path.join(self.directory, reportType, date, '{}.{}.gz'.format(int(conId), fmt))
+
+    def get(self, conId, reportType, date=None, fmt='xml'):
+        """ :return: path of the cached report, or None on a miss.  A JSON report is made from cached XML if needed.
+        """
+        date = date or today()
+        path = self.path(conId, reportType, date, fmt)
+        if os.path.exists(path):
+            return path
+        if fmt == 'json':
+            xml_path = self.get(conId, reportType, date)
+            if xml_path is not None:
+                with gzip.open(xml_path, 'rb') as f:
+                    data = json.dumps(element_to_dict(ElementTree.parse(f).getroot()))
+                return self._write(path, data)
+
+    def put(self, conId, reportType, data, date=None):
+        """ Stores an XML report.
+
+        :return: path of the stored report
+        """
+        return self._write(self.path(conId, reportType, date or today()), data)
+
+    def _write(self, path, data):
+        """ Writes to a temporary file which is then renamed into place, so readers never see a partial report
+        """
+        directory = os.path.dirname(path)
+        with self._lock:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+                f.write(data.encode('utf-8') if isinstance(data, unicode) else data)
+        os.rename(tmp_path, path)
+        return path
+
+
+def read_chunks(path, compressed=False):
+    """ Generator over a cached report, to stream it without loading it whole.
+
+    :param compressed: yield the gzipped bytes as stored, for clients which accept gzip
+    """
+    f = open(path, 'rb') if compressed else gzip.open(path, 'rb')
+    with f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+cache = FundamentalsCache()
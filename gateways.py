@@ -0,0 +1,312 @@
+""" TWS/IB Gateway endpoints that client connections are spread over.
+
+One TWS accepts at most 8 API clients at a time (clientIds 0-7 in the default pool), and its market data lines are
+shared by all of them.  IBREST_GATEWAYS configures any number of endpoints instead, each with its own clientId pool:
+
+    IBREST_GATEWAYS="live=10.0.0.1:4001/0-7@U123456,data=10.0.0.2:4002/0-31"
+
+Each comma separated entry is [name=]host:port[/first-last][@ACCOUNT+ACCOUNT].  The name defaults to host:port, the
+clientIds to 0-7, and accounts are learned from managedAccounts once connected, so @ is only needed to route by
+account before then.  Without IBREST_GATEWAYS the single gateway at IBGW_HOST:IBGW_PORT is used.
+
+For each request the Router picks a gateway: the one holding the request's account, if known, else one of those routed
+to for the request's kind by IBREST_GATEWAY_ROUTES (ie "order=live,scanner=data"), and among those the least loaded
+one that is healthy.  A gateway which fails to connect is avoided for a backoff that doubles with each consecutive
+failure, and used again after its next successful connection.
+
+When a gateway's clientIds are all in use, requests queue for the next one to be released.  Orders are served first,
+then portfolio requests, then everything else (market data, scanners, fundamentals, options), first come first served
+within each class, so a burst of quote requests cannot hold up an order.  A request waits at most IBREST_LEASE_TIMEOUT
+seconds, after which sync.get_client gives up with a 503 and a Retry-After estimated from how long clientIds are held.
+
+TWS disconnects clients sending more than about 50 messages per second, so every connection's requests are paced (see
+ib/opt/pacer.py) to IBREST_PACE_RATE messages per second with bursts of IBREST_PACE_BURST: 44 and 5 by default, which
+never exceeds 50 in any one second.  IBREST_GATEWAY_PACE_RATE additionally caps all connections to a gateway together.
+"""
+from collections import deque
+from threading import Lock
+import logging
+import math
+import os
+import time
+
+from ib.opt.pacer import PacingStats, TokenBucket
+import tasks
+
+log = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------
+# GLOBAL PARAMETERS
+# ---------------------------------------------------------------------
+# Configuration
+_ibgw_host = os.getenv('IBGW_HOST', '127.0.0.1')
+_ibgw_port = int(os.getenv('IBGW_PORT', '4001'))  # Use 7496 for TWS
+_gateways = os.getenv('IBREST_GATEWAYS', '{}:{}'.format(_ibgw_host, _ibgw_port))
+_routes = os.getenv('IBREST_GATEWAY_ROUTES', '')
+# Seconds a failing gateway is avoided for after its first failure, doubling up to _max_backoff
+_backoff = float(os.getenv('IBREST_GATEWAY_BACKOFF', '1'))
+_max_backoff = float(os.getenv('IBREST_GATEWAY_MAX_BACKOFF', '60'))
+# Seconds a request waits for a clientId before it is turned away
+_lease_timeout = float(os.getenv('IBREST_LEASE_TIMEOUT', '30'))
+# Messages per second (and back to back) per connection, and for all connections to one gateway; 0 for no limit
+_pace_rate = float(os.getenv('IBREST_PACE_RATE', '44'))
+_pace_burst = float(os.getenv('IBREST_PACE_BURST', '5'))
+_gateway_pace_rate = float(os.getenv('IBREST_GATEWAY_PACE_RATE', '0'))
+_gateway_pace_burst = float(os.getenv('IBREST_GATEWAY_PACE_BURST', '5'))
+
+DEFAULT_CLIENT_IDS = range(8)
+# Lease priority classes, served in this order; request kinds not listed wait in the last one
+PRIORITY_CLASSES = ('order', 'portfolio', 'other')
+PRIORITIES = {'order': 0, 'portfolio': 1}
+
+
+def priority(kind):
+    return PRIORITIES.get(kind, len(PRIORITY_CLASSES) - 1)
+
+
+class WaitStats(object):
+    """ Count, total and longest wait for a lease, in seconds
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.timeouts = 0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def to_dict(self):
+        return dict(count=self.count, meanMs=round(self.total / self.count * 1e3, 1) if self.count else 0,
+                    maxMs=round(self.max * 1e3, 1), timeouts=self.timeouts)
+
+
+class Gateway(object):
+    """ One TWS/IB Gateway endpoint with its pool of clientIds
+    """
+
+    def __init__(self, name, host, port, client_ids=DEFAULT_CLIENT_IDS, accounts=()):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.client_ids = tuple(client_ids)
+        self.accounts = set(accounts)
+        # Set once a nextValidId from this gateway has seeded the orderId allocator
+        self.seeded = False
+        self._pool = set(self.client_ids)
+        # Leased clientId -> time it was handed out
+        self._leased = dict()
+        # Futures of get_client calls waiting for a clientId, a queue per priority class
+        self._waiters = [deque() for _ in PRIORITY_CLASSES]
+        self._waits = [WaitStats() for _ in PRIORITY_CLASSES]
+        # Moving average of how long a clientId is held, for Retry-After
+        self._hold = 1.0
+        self._lock = Lock()
+        # Shared by all connections to this gateway
+        self.bucket = TokenBucket(_gateway_pace_rate, _gateway_pace_burst) if _gateway_pace_rate > 0 else None
+        self.pacing = PacingStats()
+        self.failures = 0
+        self.down_until = 0
+        self.last_error = None
+
+    def __repr__(self):
+        return 'Gateway({}, {}:{})'.format(self.name, self.host, self.port)
+
+    def lease(self, priority=len(PRIORITY_CLASSES) - 1, timeout=_lease_timeout):
+        """ Takes a clientId from the pool
+
+        :param priority: index into PRIORITY_CLASSES
+        :param timeout: seconds to wait at most, if the pool is empty
+        :return: clientId, or a Future completed with one by release() when the pool is empty, or with None on timeout
+        (then pass it to cancel())
+        """
+        with self._lock:
+            if self._pool:
+                client_id = self._pool.pop()
+                self._leased[client_id] = time.time()
+                self._waits[priority].add(0.0)
+                return client_id
+            future = tasks.Future(timeout, phase='lease')
+            future.priority = priority
+            future.queued = time.time()
+            self._waiters[priority].append(future)
+            return future
+
+    def cancel(self, lease):
+        """ Withdraws a lease which timed out
+        """
+        with self._lock:
+            waiters = self._waiters[lease.priority]
+            if lease in waiters:
+                waiters.remove(lease)
+            self._waits[lease.priority].timeouts += 1
+
+    def release(self, client_id):
+        """ Hands client_id to the longest waiting lease of the highest priority class, or puts it back into the pool.
+        Releasing a clientId which is not leased (ie twice) does nothing.
+        """
+        with self._lock:
+            granted = self._leased.get(client_id)
+            if granted is None:
+                return
+            self._hold += 0.2 * (time.time() - granted - self._hold)
+        while True:
+            with self._lock:
+                now = time.time()
+                lease = next((w.popleft() for w in self._waiters if w), None)
+                if lease is None:
+                    del self._leased[client_id]
+                    self._pool.add(client_id)
+                    return
+                self._leased[client_id] = now
+            # The lease may have timed out meanwhile, then try the next one
+            if lease.set_result(client_id):
+                with self._lock:
+                    self._waits[lease.priority].add(now - lease.queued)
+                return
+
+    def buckets(self):
+        """ :return: TokenBuckets for the messages of a new connection: its own, and the gateway's if limited
+        """
+        buckets = [TokenBucket(_pace_rate, _pace_burst)] if _pace_rate > 0 else []
+        if self.bucket is not None:
+            buckets.append(self.bucket)
+        return buckets
+
+    def waiting(self):
+        return sum(len(w) for w in self._waiters)
+
+    def retry_after(self):
+        """ :return: whole seconds until a clientId is likely to be free for a request queued now
+        """
+        queued = self.waiting() + 1
+        return max(1, int(math.ceil(self._hold * queued / float(len(self.client_ids) or 1))))
+
+    def load(self):
+        """ :return: share of clientIds in use, plus the number of leases waiting per clientId
+        """
+        return (len(self._leased) + self.waiting()) / float(len(self.client_ids) or 1)
+
+    def healthy(self, now=None):
+        return self.down_until <= (time.time() if now is None else now)
+
+    def record_success(self):
+        if self.failures:
+            log.info('{} is back up after {} failures'.format(self, self.failures))
+        self.failures = 0
+        self.down_until = 0
+
+    def record_failure(self, error):
+        """ Marks the gateway down for a backoff which doubles with each consecutive failure
+        """
+        self.failures += 1
+        self.last_error = error
+        backoff = min(_backoff * 2 ** (self.failures - 1), _max_backoff)
+        self.down_until = time.time() + backoff
+        log.warning('{} failed ({}); avoiding it for {}s'.format(self, error, backoff))
+
+    def to_dict(self):
+        return dict(name=self.name, host=self.host, port=self.port, clientIds=len(self.client_ids),
+                    leased=len(self._leased), accounts=sorted(self.accounts), healthy=self.healthy(),
+                    failures=self.failures, lastError=self.last_error, holdMs=round(self._hold * 1e3, 1),
+                    waiting={c: len(w) for c, w in zip(PRIORITY_CLASSES, self._waiters)},
+                    waits={c: w.to_dict() for c, w in zip(PRIORITY_CLASSES, self._waits)},
+                    pacing=self.pacing.toDict())
+
+
+class Router(object):
+    """ Chooses the gateway for each request
+    """
+
+    def __init__(self, gateways, routes=None):
+        """
+        :param gateways: list of Gateways
+        :param routes: dict of request kind to the names of the gateways serving it; other kinds use any gateway
+        """
+        if not gateways:
+            raise ValueError('At least one gateway is required')
+        self.gateways = list(gateways)
+        by_name = {g.name: g for g in self.gateways}
+        self.routes = dict()
+        for kind, names in (routes or {}).iteritems():
+            unknown = [n for n in names if n not in by_name]
+            if unknown:
+                raise ValueError('Unknown gateway {} routed for {}'.format(', '.join(unknown), kind))
+            self.routes[kind] = [by_name[n] for n in names]
+
+    def choose(self, kind=None, account=None, exclude=()):
+        """ Picks a gateway: the one holding account if known, else those routed to for kind, then the least loaded of
+        the healthy ones.  If none are healthy, the one due back first is returned anyway.
+
+        :param exclude: gateways not to use, ie already failed for this request
+        :return: Gateway, or None if all candidates are excluded
+        """
+        candidates = [g for g in self.gateways if g not in exclude]
+        owners = [g for g in candidates if account in g.accounts] if account else []
+        if owners:
+            candidates = owners
+        elif kind in self.routes:
+            candidates = [g for g in self.routes[kind] if g not in exclude]
+        if not candidates:
+            return None
+        now = time.time()
+        healthy = [g for g in candidates if g.healthy(now)]
+        if not healthy:
+            return min(candidates, key=lambda g: g.down_until)
+        return min(healthy, key=lambda g: g.load())
+
+    def accounts(self):
+        """ :return: managed accounts of all gateways
+        """
+        return sorted(set().union(*[g.accounts for g in self.gateways]))
+
+    def to_dict(self):
+        return dict(gateways=[g.to_dict() for g in self.gateways],
+                    routes={kind: [g.name for g in gateways] for kind, gateways in self.routes.iteritems()})
+
+
+# ---------------------------------------------------------------------
+# CONFIGURATION
+# ---------------------------------------------------------------------
+def parse_gateways(spec):
+    """ Parses IBREST_GATEWAYS, see above
+
+    :return: list of Gateways
+    """
+    gateways = []
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, _, address = entry.rpartition('=')
+        address, _, accounts = address.partition('@')
+        address, _, client_ids = address.partition('/')
+        host, _, port = address.rpartition(':')
+        if not host or not port.isdigit():
+            raise ValueError('Gateway {} is not [name=]host:port[/first-last][@ACCOUNT+ACCOUNT]'.format(entry))
+        if client_ids:
+            first, _, last = client_ids.partition('-')
+            client_ids = range(int(first), int(last or first) + 1)
+        else:
+            client_ids = DEFAULT_CLIENT_IDS
+        gateways.append(Gateway(name or address, host, int(port), client_ids, filter(None, accounts.split('+'))))
+    return gateways
+
+
+def parse_routes(spec):
+    """ Parses IBREST_GATEWAY_ROUTES: comma separated kind=name+name entries
+
+    :return: dict of kind to list of gateway names
+    """
+    routes = dict()
+    for entry in spec.split(','):
+        kind, _, names = entry.strip().partition('=')
+        if kind:
+            routes[kind] = filter(None, names.split('+'))
+    return routes
+
+
+router = Router(parse_gateways(_gateways), parse_routes(_routes))
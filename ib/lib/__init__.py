@@ -135,6 +135,7 @@ class DataOutputStream(object):
         @param stream any object with send method
         """
         self.send = stream.send
+        self.sendall = getattr(stream, 'sendall', None)
 
     def write(self, data, pack=struct.pack, eol=struct.pack('!b', 0)):
         """ Writes data to the contained stream.
@@ -151,6 +152,18 @@ class DataOutputStream(object):
                     char = char.encode('utf-8')
                 send(pack('!c', char))
 
+    def writeBytes(self, data):
+        """ Writes an already encoded string to the contained stream in one call.
+
+        @param data string to send
+        @return None
+        """
+        if self.sendall is not None:
+            self.sendall(data)
+        else:
+            while data:
+                data = data[self.send(data):]
+
 
 class Double(float):
     """ Partial implementation of Java Double type.
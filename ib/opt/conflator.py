@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# Tick conflation for listeners which only need the latest values.
+#
+# A Conflator stands between the dispatcher and one listener.  Ticks
+# are not passed on as they arrive: the latest one per tickerId and
+# tick type is kept, and its key marked dirty, until the next flush
+# hands the listener one message per dirty key.  Flushes happen on
+# demand, every interval seconds on a thread started by the first
+# tick, and before any other message is passed on, so that a listener
+# never sees a tick after a message which followed it.  A fast market
+# so costs a slow listener at most one call per key per interval.
+#
+# Use:
+#    {{{
+#    conflator = Conflator(my_callback, interval=0.25)
+#    con.register(conflator, message.TickPrice, message.TickSize)
+#    con.register(conflator.close, message.ConnectionClosed)
+#    }}}
+##
+from threading import Event, Lock, RLock, Thread
+
+from ib.lib import maybeName, logger
+from ib.opt.dispatcher import conflationKey
+
+
+class Conflator(object):
+    """ Listener which passes the latest tick per tickerId and tick type
+        on to another listener when flushed.
+
+    """
+    def __init__(self, listener, interval=None):
+        """ Initializer.
+
+        @param listener callable to receive messages
+        @param interval seconds between flushes by start's thread, or None
+               to flush only on demand
+        """
+        self.listener = listener
+        self.interval = interval
+        self.lock = Lock()
+        self.deliverLock = RLock()
+        self.latest = {}
+        self.dirty = []
+        self.stopped = Event()
+        self.thread = None
+        self.received = 0
+        self.delivered = 0
+        self.logger = logger.logger()
+
+    def __call__(self, message):
+        """ Keeps a tick until the next flush; anything else is passed on
+            right away, after the ticks before it.
+
+        @param message instance of Message
+        @return None
+        """
+        key = conflationKey(message)
+        if key is None:
+            with self.deliverLock:
+                self.flush()
+                self.deliver(message)
+            return
+        with self.lock:
+            self.received += 1
+            if key not in self.latest:
+                self.dirty.append(key)
+            self.latest[key] = message
+        if self.thread is None:
+            self.start()
+
+    def flush(self):
+        """ Passes the latest tick of every dirty key on to the listener,
+            in the order the keys first became dirty.
+
+        @return number of messages passed on
+        """
+        with self.deliverLock:
+            with self.lock:
+                latest, dirty = self.latest, self.dirty
+                if not dirty:
+                    return 0
+                self.latest, self.dirty = {}, []
+                self.delivered += len(dirty)
+            for key in dirty:
+                self.deliver(latest[key])
+            return len(dirty)
+
+    def deliver(self, message):
+        try:
+            self.listener(message)
+        except (Exception, ):
+            errmsg = ("Exception in conflated dispatch.  "
+                      "Handler '%s' for '%s'")
+            self.logger.exception(errmsg, maybeName(self.listener), message.typeName)
+
+    def start(self):
+        """ Starts flushing every interval seconds, if an interval was given.
+            Called by the first tick if not before.
+
+        @return self
+        """
+        with self.lock:
+            if not self.interval or self.thread is not None or self.stopped.isSet():
+                return self
+            self.thread = Thread(target=self.run, name='Conflator')
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def close(self, *args):
+        """ Flushes and stops the interval thread.  Can be registered for
+            ConnectionClosed messages.
+
+        @return None
+        """
+        self.stopped.set()
+        self.flush()
+
+    def pending(self):
+        """ @return number of dirty keys waiting for the next flush
+        """
+        return len(self.dirty)
+
+    def toDict(self):
+        with self.lock:
+            return dict(received=self.received, delivered=self.delivered, pending=len(self.dirty),
+                        conflated=self.received - self.delivered - len(self.dirty))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# Canonical, hashable keys for contracts.
+#
+# Contract has no __hash__ worth using (it is mutable, and hashes by
+# identity), and its __eq__ goes through Util.StringCompare a dozen
+# times and compares combo legs pairwise.  contractKey reduces a
+# Contract (ib.ext or ib.opt.slotted) to a ContractKey instead: its
+# conId when TWS has given it one, otherwise a tuple of the fields
+# Contract.__eq__ compares, with None and '' taken as the same, string
+# fields interned, and combo legs sorted.  Keys hash once, and equal
+# keys are the same object, so dicts and sets of them (caches, or
+# subscriptions indexed by contract) compare by identity.
+#
+# Use:
+#    {{{
+#    from ib.opt.contractkey import contractKey
+#    subscriptions[contractKey(contract)] = tickerId
+#    }}}
+##
+from weakref import WeakValueDictionary
+
+
+##
+# Keys in use, so that equal keys are one object.
+keys = WeakValueDictionary()
+
+
+class ContractKey(object):
+    """ Identity of a contract: its conId, or if it has none (0) the
+        tuple of its normalized fields.
+
+    """
+    __slots__ = ('conId', 'fields', 'hash', '__weakref__')
+
+    def __init__(self, conId, fields=None):
+        self.conId = conId
+        self.fields = fields
+        self.hash = hash(fields if conId == 0 else conId)
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, (ContractKey, )) or self.hash != other.hash:
+            return False
+        return self.conId == other.conId and self.fields == other.fields
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        if self.conId:
+            return 'ContractKey(%d)' % self.conId
+        return 'ContractKey(0, %r)' % (self.fields, )
+
+
+def normalize(value):
+    """ @return value as an interned str, with None as ''
+    """
+    if not value:
+        return ''
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return intern(str(value))
+
+
+def comboLegKey(leg):
+    """ @return tuple of the fields ComboLeg.__eq__ compares, its
+        strings (compared ignoring case) upper cased
+    """
+    return (leg.m_conId, leg.m_ratio, leg.m_openClose, leg.m_shortSaleSlot, leg.m_exemptCode,
+            normalize(leg.m_action).upper(), normalize(leg.m_exchange).upper(),
+            normalize(leg.m_designatedLocation).upper())
+
+
+def contractFields(contract):
+    """ @return tuple of the normalized fields Contract.__eq__ compares
+        (as it does, leaving out those of option and futures
+        contracts for bonds)
+    """
+    c = contract
+    secType = normalize(c.m_secType)
+    fields = (secType, normalize(c.m_symbol), normalize(c.m_exchange), normalize(c.m_primaryExch),
+              normalize(c.m_currency), normalize(c.m_secIdType), normalize(c.m_secId))
+    if secType != 'BOND':
+        fields += (float(c.m_strike or 0), normalize(c.m_expiry), normalize(c.m_right), normalize(c.m_multiplier),
+                   normalize(c.m_localSymbol), normalize(c.m_tradingClass))
+    if c.m_comboLegs:
+        fields += (tuple(sorted(comboLegKey(leg) for leg in c.m_comboLegs)), )
+    if c.m_underComp is not None:
+        fields += ((c.m_underComp.m_conId, c.m_underComp.m_delta, c.m_underComp.m_price), )
+    return fields
+
+
+def contractKey(contract):
+    """ Canonical key of a contract.  A contract with a conId and the
+        same contract without one get different keys.
+
+    @param contract Contract
+    @return ContractKey, the same object for equal keys
+    """
+    conId = contract.m_conId or 0
+    key = ContractKey(conId, None if conId else contractFields(contract))
+    return keys.setdefault(key, key)
@@ -0,0 +1,548 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# Table-driven replacement for EReader.processMsg.
+#
+# EReader.processMsg is one long if/elif chain over the incoming
+# message ids, and every field is read one byte at a time through
+# readStr.  DecodingReader instead:
+#
+#    - reads the socket in chunks and splits complete fields off a
+#      buffer;
+#    - looks message ids up in a dict;
+#    - runs a parse function generated for the exact (msgId, message
+#      version, server version) combination, with all version branches
+#      resolved when it is compiled.
+#
+# The generated functions make exactly the same EWrapper calls, with
+# the same argument values and types, as the generated EReader code.
+# The few messages with nested, data-dependent layouts (openOrder,
+# contract and bond details, scanner and historical data) are
+# delegated to EReader.processMsg unchanged.
+#
+# The objects messages carry are built from objectTypes, the ext
+# classes unless useTypes swaps in others (see ib.opt.slotted).
+##
+from collections import deque
+from types import FunctionType
+
+from ib.ext.ComboLeg import ComboLeg
+from ib.ext.CommissionReport import CommissionReport
+from ib.ext.Contract import Contract
+from ib.ext.ContractDetails import ContractDetails
+from ib.ext.EClientErrors import EClientErrors
+from ib.ext.EReader import EReader
+from ib.ext.Execution import Execution
+from ib.ext.Order import Order
+from ib.ext.OrderComboLeg import OrderComboLeg
+from ib.ext.OrderState import OrderState
+from ib.ext.TagValue import TagValue
+from ib.ext.TickType import TickType
+from ib.ext.UnderComp import UnderComp
+from ib.lib import Double, Thread
+from ib.opt import metrics
+
+
+MAX_VALUE = Double.MAX_VALUE
+
+##
+# Statement templates, keyed by field kind, matching the EReader read*
+# method of the same name.  'x' is a scratch local.
+conversions = {
+    'str': '%s = f() or None',
+    'int': 'x = f(); %s = int(x) if x else 0',
+    'intMax': 'x = f(); %s = int(x) if x else MAX',
+    'long': 'x = f(); %s = long(x) if x else 0L',
+    'float': 'x = f(); %s = float(x) if x else 0',
+    'floatMax': 'x = f(); %s = float(x) if x else MAX',
+    'bool': 'x = f(); %s = int(x) != 0 if x else False',
+}
+
+##
+# tickPrice messages carry a size for these price tick types.
+sizeTickTypes = {TickType.BID: TickType.BID_SIZE, TickType.ASK: TickType.ASK_SIZE, TickType.LAST: TickType.LAST_SIZE}
+
+##
+# Classes messages' objects are built from, by ext class name.  Classes
+# with a fields attribute (ie ib.opt.slotted's) are built in one call,
+# with their fields passed positionally.
+objectTypes = dict((cls.__name__, cls) for cls in (ComboLeg, CommissionReport, Contract, ContractDetails, Execution,
+                                                   Order, OrderComboLeg, OrderState, TagValue, UnderComp))
+
+##
+# Types of the values that can be written as literals in generated code.
+literalTypes = (int, long, float, bool, str, type(None))
+
+
+def literal(value):
+    """ @return source of value if it can be written as a literal, else None
+    """
+    if type(value) in literalTypes and value == value and value not in (float('inf'), float('-inf')):
+        return repr(value)
+    return None
+
+
+class Source(object):
+    """ Accumulates source lines for one generated parse function.
+
+    """
+    def __init__(self):
+        self.lines = ['def parse(r, f, w):']
+        self.objects = {}
+
+    def __call__(self, line):
+        self.lines.append('    ' + line)
+
+    def local(self, target):
+        """ Returns where to put a value meant for target: a local of its
+            own for the fields of objects left to build, else target.
+
+        """
+        name, dot, attr = target.partition('.')
+        if dot and name in self.objects:
+            self.objects[name][1][attr] = '%s_%s' % (name, attr)
+            return '%s_%s' % (name, attr)
+        return target
+
+    def new(self, target, typeName):
+        """ Emits the creation of an object of objectTypes into target.
+            Objects of classes with fields are instead created by build,
+            once their fields are read.
+
+        """
+        if hasattr(objectTypes[typeName], 'fields'):
+            self.objects[target] = (typeName, {})
+        else:
+            self('%s = %s()' % (target, typeName))
+
+    def build(self, target):
+        """ Emits the creation of an object begun with new whose fields
+            are now read, passing them positionally (up to the last one
+            read), if it was left to build.
+
+        """
+        try:
+            typeName, values = self.objects.pop(target)
+        except (KeyError, ):
+            return
+        cls = objectTypes[typeName]
+        last = max([cls.fields.index(name) for name in values] + [-1])
+        args, keywords = [], False
+        for name, default in zip(cls.fields, cls.defaults)[:last + 1]:
+            if name in values:
+                args.append('%s=%s' % (name, values[name]) if keywords else values[name])
+            elif not keywords:
+                source = literal(default)
+                # defaults with no literal (ie NEW) are left to the constructor, and later fields passed by name
+                keywords = source is None
+                if not keywords:
+                    args.append(source)
+        self('%s = %s(%s)' % (target, typeName, str.join(', ', args)))
+
+    def assign(self, target, source):
+        self('%s = %s' % (self.local(target), source))
+
+    def read(self, target, kind):
+        """ Emits a read of one field into target.
+
+        @param target local name or attribute expression
+        @param kind key of the conversions mapping
+        """
+        self(conversions[kind] % self.local(target))
+
+    def reads(self, *fields):
+        for target, kind in fields:
+            self.read(target, kind)
+
+    def readIf(self, present, target, kind, default):
+        """ Emits a read if the field is present in this message version, otherwise assigns its default.
+
+        @param present True if the field is on the wire
+        @param target local name or attribute expression
+        @param kind key of the conversions mapping
+        @param default source expression used when the field is absent
+        """
+        if present:
+            self.read(target, kind)
+        else:
+            self.assign(target, default)
+
+    def compile(self, name):
+        namespace = dict(objectTypes, MAX=MAX_VALUE, sizeTickTypes=sizeTickTypes)
+        exec compile(str.join('\n', self.lines), '<%s>' % name, 'exec') in namespace
+        function = namespace['parse']
+        function.__name__ = name
+        function.source = self.lines
+        return function
+
+
+def simple(method, *fields):
+    """ Builder for messages that are a fixed list of fields passed straight to one EWrapper method.
+
+    @param method name of EWrapper method
+    @param *fields (name, kind) pairs in wire order
+    @return builder function
+    """
+    def build(a, version, serverVersion):
+        a.reads(*fields)
+        a('w.%s(%s)' % (method, str.join(', ', [name for name, kind in fields])))
+    return build
+
+
+def buildTickPrice(a, version, serverVersion):
+    a.reads(('tickerId', 'int'), ('tickType', 'int'), ('price', 'float'))
+    a.readIf(version >= 2, 'size', 'int', '0')
+    a.readIf(version >= 3, 'canAutoExecute', 'int', '0')
+    a('w.tickPrice(tickerId, tickType, price, canAutoExecute)')
+    if version >= 2:
+        a('sizeTickType = sizeTickTypes.get(tickType)')
+        a('if sizeTickType is not None: w.tickSize(tickerId, sizeTickType, size)')
+
+
+def buildTickOptionComputation(a, version, serverVersion):
+    a.reads(('tickerId', 'int'), ('tickType', 'int'))
+    # -1 and -2 are the "not yet computed" indicators
+    a.read('impliedVol', 'float')
+    a('if impliedVol < 0: impliedVol = MAX')
+    a.read('delta', 'float')
+    a('if abs(delta) > 1: delta = MAX')
+    a('optPrice = pvDividend = gamma = vega = theta = undPrice = MAX')
+    indent = ''
+    if version < 6:
+        a('if tickType == %d:' % TickType.MODEL_OPTION)
+        indent = '    '
+    a(indent + conversions['float'] % 'optPrice')
+    a(indent + 'if optPrice < 0: optPrice = MAX')
+    a(indent + conversions['float'] % 'pvDividend')
+    a(indent + 'if pvDividend < 0: pvDividend = MAX')
+    if version >= 6:
+        for name in ('gamma', 'vega', 'theta'):
+            a.read(name, 'float')
+            a('if abs(%s) > 1: %s = MAX' % (name, name))
+        a.read('undPrice', 'float')
+        a('if undPrice < 0: undPrice = MAX')
+    a('w.tickOptionComputation(tickerId, tickType, impliedVol, delta, optPrice, pvDividend, gamma, vega, theta, '
+      'undPrice)')
+
+
+def buildOrderStatus(a, version, serverVersion):
+    a.reads(('id', 'int'), ('status', 'str'), ('filled', 'int'), ('remaining', 'int'), ('avgFillPrice', 'float'))
+    for minVersion, name, kind, default in ((2, 'permId', 'int', '0'), (3, 'parentId', 'int', '0'),
+                                            (4, 'lastFillPrice', 'float', '0'), (5, 'clientId', 'int', '0'),
+                                            (6, 'whyHeld', 'str', 'None')):
+        a.readIf(version >= minVersion, name, kind, default)
+    a('w.orderStatus(id, status, filled, remaining, avgFillPrice, permId, parentId, lastFillPrice, clientId, whyHeld)')
+
+
+def buildAcctValue(a, version, serverVersion):
+    a.reads(('key', 'str'), ('val', 'str'), ('cur', 'str'))
+    a.readIf(version >= 2, 'accountName', 'str', 'None')
+    a('w.updateAccountValue(key, val, cur, accountName)')
+
+
+def buildPortfolioValue(a, version, serverVersion):
+    a.new('contract', 'Contract')
+    if version >= 6:
+        a.read('contract.m_conId', 'int')
+    a.reads(('contract.m_symbol', 'str'), ('contract.m_secType', 'str'), ('contract.m_expiry', 'str'),
+            ('contract.m_strike', 'float'), ('contract.m_right', 'str'))
+    if version >= 7:
+        a.reads(('contract.m_multiplier', 'str'), ('contract.m_primaryExch', 'str'))
+    a.read('contract.m_currency', 'str')
+    if version >= 2:
+        a.read('contract.m_localSymbol', 'str')
+    if version >= 8:
+        a.read('contract.m_tradingClass', 'str')
+    a.reads(('position', 'int'), ('marketPrice', 'float'), ('marketValue', 'float'))
+    if version >= 3:
+        a.reads(('averageCost', 'float'), ('unrealizedPNL', 'float'), ('realizedPNL', 'float'))
+    else:
+        a('averageCost = unrealizedPNL = realizedPNL = 0.0')
+    a.readIf(version >= 4, 'accountName', 'str', 'None')
+    if version == 6 and serverVersion == 39:
+        a.read('contract.m_primaryExch', 'str')
+    a.build('contract')
+    a('w.updatePortfolio(contract, position, marketPrice, marketValue, averageCost, unrealizedPNL, realizedPNL, '
+      'accountName)')
+
+
+def buildErrMsg(a, version, serverVersion):
+    # errors go through the client, which forwards them to the wrapper
+    if version < 2:
+        a.read('msg', 'str')
+        a('r.m_parent.error(msg)')
+    else:
+        a.reads(('id', 'int'), ('errorCode', 'int'), ('errorMsg', 'str'))
+        a('r.m_parent.error(id, errorCode, errorMsg)')
+
+
+def buildExecutionData(a, version, serverVersion):
+    a.readIf(version >= 7, 'reqId', 'int', '-1')
+    a.read('orderId', 'int')
+    a.new('contract', 'Contract')
+    if version >= 5:
+        a.read('contract.m_conId', 'int')
+    a.reads(('contract.m_symbol', 'str'), ('contract.m_secType', 'str'), ('contract.m_expiry', 'str'),
+            ('contract.m_strike', 'float'), ('contract.m_right', 'str'))
+    if version >= 9:
+        a.read('contract.m_multiplier', 'str')
+    a.reads(('contract.m_exchange', 'str'), ('contract.m_currency', 'str'), ('contract.m_localSymbol', 'str'))
+    if version >= 10:
+        a.read('contract.m_tradingClass', 'str')
+    a.build('contract')
+    a.new('exec_', 'Execution')
+    a.assign('exec_.m_orderId', 'orderId')
+    a.reads(('exec_.m_execId', 'str'), ('exec_.m_time', 'str'), ('exec_.m_acctNumber', 'str'),
+            ('exec_.m_exchange', 'str'), ('exec_.m_side', 'str'), ('exec_.m_shares', 'int'),
+            ('exec_.m_price', 'float'))
+    if version >= 2:
+        a.read('exec_.m_permId', 'int')
+    if version >= 3:
+        a.read('exec_.m_clientId', 'int')
+    if version >= 4:
+        a.read('exec_.m_liquidation', 'int')
+    if version >= 6:
+        a.reads(('exec_.m_cumQty', 'int'), ('exec_.m_avgPrice', 'float'))
+    if version >= 8:
+        a.read('exec_.m_orderRef', 'str')
+    if version >= 9:
+        a.reads(('exec_.m_evRule', 'str'), ('exec_.m_evMultiplier', 'float'))
+    a.build('exec_')
+    a('w.execDetails(reqId, contract, exec_)')
+
+
+def buildDeltaNeutralValidation(a, version, serverVersion):
+    a.read('reqId', 'int')
+    a.new('underComp', 'UnderComp')
+    a.reads(('underComp.m_conId', 'int'), ('underComp.m_delta', 'float'), ('underComp.m_price', 'float'))
+    a.build('underComp')
+    a('w.deltaNeutralValidation(reqId, underComp)')
+
+
+def buildCommissionReport(a, version, serverVersion):
+    a.new('commissionReport', 'CommissionReport')
+    a.reads(('commissionReport.m_execId', 'str'), ('commissionReport.m_commission', 'float'),
+            ('commissionReport.m_currency', 'str'), ('commissionReport.m_realizedPNL', 'float'),
+            ('commissionReport.m_yield', 'float'), ('commissionReport.m_yieldRedemptionDate', 'int'))
+    a.build('commissionReport')
+    a('w.commissionReport(commissionReport)')
+
+
+def buildPosition(a, version, serverVersion):
+    a.read('account', 'str')
+    a.new('contract', 'Contract')
+    a.reads(('contract.m_conId', 'int'), ('contract.m_symbol', 'str'), ('contract.m_secType', 'str'),
+            ('contract.m_expiry', 'str'), ('contract.m_strike', 'float'), ('contract.m_right', 'str'),
+            ('contract.m_multiplier', 'str'), ('contract.m_exchange', 'str'), ('contract.m_currency', 'str'),
+            ('contract.m_localSymbol', 'str'))
+    if version >= 2:
+        a.read('contract.m_tradingClass', 'str')
+    a.build('contract')
+    a.read('pos', 'int')
+    a.readIf(version >= 3, 'avgCost', 'float', '0')
+    a('w.position(account, contract, pos, avgCost)')
+
+
+R = EReader
+
+##
+# Message id to parse function builder.  Ids missing here are handled
+# by the generated EReader.processMsg.
+builders = {
+    R.TICK_PRICE: buildTickPrice,
+    R.TICK_SIZE: simple('tickSize', ('tickerId', 'int'), ('tickType', 'int'), ('size', 'int')),
+    R.TICK_OPTION_COMPUTATION: buildTickOptionComputation,
+    R.TICK_GENERIC: simple('tickGeneric', ('tickerId', 'int'), ('tickType', 'int'), ('value', 'float')),
+    R.TICK_STRING: simple('tickString', ('tickerId', 'int'), ('tickType', 'int'), ('value', 'str')),
+    R.TICK_EFP: simple('tickEFP', ('tickerId', 'int'), ('tickType', 'int'), ('basisPoints', 'float'),
+                       ('formattedBasisPoints', 'str'), ('impliedFuturesPrice', 'float'), ('holdDays', 'int'),
+                       ('futureExpiry', 'str'), ('dividendImpact', 'float'), ('dividendsToExpiry', 'float')),
+    R.ORDER_STATUS: buildOrderStatus,
+    R.ERR_MSG: buildErrMsg,
+    R.ACCT_VALUE: buildAcctValue,
+    R.PORTFOLIO_VALUE: buildPortfolioValue,
+    R.ACCT_UPDATE_TIME: simple('updateAccountTime', ('timeStamp', 'str')),
+    R.NEXT_VALID_ID: simple('nextValidId', ('orderId', 'int')),
+    R.EXECUTION_DATA: buildExecutionData,
+    R.MARKET_DEPTH: simple('updateMktDepth', ('id', 'int'), ('position', 'int'), ('operation', 'int'),
+                           ('side', 'int'), ('price', 'float'), ('size', 'int')),
+    R.MARKET_DEPTH_L2: simple('updateMktDepthL2', ('id', 'int'), ('position', 'int'), ('marketMaker', 'str'),
+                              ('operation', 'int'), ('side', 'int'), ('price', 'float'), ('size', 'int')),
+    R.NEWS_BULLETINS: simple('updateNewsBulletin', ('newsMsgId', 'int'), ('newsMsgType', 'int'),
+                             ('newsMessage', 'str'), ('originatingExch', 'str')),
+    R.MANAGED_ACCTS: simple('managedAccounts', ('accountsList', 'str')),
+    R.RECEIVE_FA: simple('receiveFA', ('faDataType', 'int'), ('xml', 'str')),
+    R.SCANNER_PARAMETERS: simple('scannerParameters', ('xml', 'str')),
+    R.CURRENT_TIME: simple('currentTime', ('time', 'long')),
+    R.REAL_TIME_BARS: simple('realtimeBar', ('reqId', 'int'), ('time', 'long'), ('open', 'float'),
+                             ('high', 'float'), ('low', 'float'), ('close', 'float'), ('volume', 'long'),
+                             ('wap', 'float'), ('count', 'int')),
+    R.FUNDAMENTAL_DATA: simple('fundamentalData', ('reqId', 'int'), ('data', 'str')),
+    R.CONTRACT_DATA_END: simple('contractDetailsEnd', ('reqId', 'int')),
+    R.OPEN_ORDER_END: simple('openOrderEnd'),
+    R.ACCT_DOWNLOAD_END: simple('accountDownloadEnd', ('accountName', 'str')),
+    R.EXECUTION_DATA_END: simple('execDetailsEnd', ('reqId', 'int')),
+    R.DELTA_NEUTRAL_VALIDATION: buildDeltaNeutralValidation,
+    R.TICK_SNAPSHOT_END: simple('tickSnapshotEnd', ('reqId', 'int')),
+    R.MARKET_DATA_TYPE: simple('marketDataType', ('reqId', 'int'), ('marketDataType', 'int')),
+    R.COMMISSION_REPORT: buildCommissionReport,
+    R.POSITION: buildPosition,
+    R.POSITION_END: simple('positionEnd'),
+    R.ACCOUNT_SUMMARY: simple('accountSummary', ('reqId', 'int'), ('account', 'str'), ('tag', 'str'),
+                              ('value', 'str'), ('currency', 'str')),
+    R.ACCOUNT_SUMMARY_END: simple('accountSummaryEnd', ('reqId', 'int')),
+}
+
+##
+# Messages left to the generated code.
+generatedMessages = (R.OPEN_ORDER, R.CONTRACT_DATA, R.BOND_CONTRACT_DATA, R.SCANNER_DATA, R.HISTORICAL_DATA)
+
+##
+# Compiled parse functions keyed by (msgId, version, serverVersion).
+# Compiling is idempotent, so concurrent readers at worst duplicate work.
+parsers = {}
+
+
+def compileParser(msgId, version, serverVersion):
+    """ Generates the parse function for one message layout.
+
+    @param msgId incoming message id
+    @param version message version read from the wire
+    @param serverVersion server version negotiated on connect
+    @return function(reader, readField, wrapper)
+    """
+    a = Source()
+    builders[msgId](a, version, serverVersion)
+    return a.compile('parse_%d_v%d_s%d' % (msgId, version, serverVersion))
+
+
+def parseCompiled(reader, msgId):
+    """ Table entry for messages with a compiled parser.
+
+    """
+    x = reader.readField()
+    version = int(x) if x else 0
+    key = (msgId, version, reader.m_parent.m_serverVersion)
+    try:
+        parse = parsers[key]
+    except (KeyError, ):
+        parse = parsers[key] = compileParser(*key)
+    parse(reader, reader.readField, reader.m_parent.m_anyWrapper)
+
+
+##
+# The generated EReader.processMsg, with its globals' ext classes
+# replaced by objectTypes.
+generatedProcessMsg = EReader.processMsg.im_func
+
+
+def parseGenerated(reader, msgId):
+    """ Table entry for messages handled by the generated EReader code.
+
+    """
+    return generatedProcessMsg(reader, msgId)
+
+
+def useTypes(types):
+    """ Replaces objectTypes, making parse functions (and the generated
+        EReader code) build messages' objects from the given classes.
+
+    @param types mapping of ext class name to class, ie ib.opt.slotted.types
+    """
+    global parsers, generatedProcessMsg
+    objectTypes.update(types)
+    function = EReader.processMsg.im_func
+    generatedProcessMsg = FunctionType(function.func_code, dict(function.func_globals, **objectTypes),
+                                       function.func_name, function.func_defaults, function.func_closure)
+    parsers = {}
+
+
+##
+# The dispatch table itself: message id to table entry.
+handlers = dict([(msgId, parseCompiled) for msgId in builders] +
+                [(msgId, parseGenerated) for msgId in generatedMessages])
+
+
+class DecodingReader(EReader):
+    """ EReader with buffered field reads and a dispatch-table processMsg.
+
+    """
+    chunkSize = 8192
+
+    def __init__(self, parent, dis):
+        """ Initializer.
+
+        EReader.__init__ is overloaded and re-dispatches through
+        self.__init__, so its body is repeated here instead.
+
+        @param parent EClientSocket owning this reader
+        @param dis DataInputStream for the connected socket
+        """
+        Thread.__init__(self, 'EReader', parent, dis)
+        self.setName('EReader')
+        self.m_parent = parent
+        self.m_dis = dis
+        self.fields = deque()
+        self.partial = ''
+        self.recv = dis.recv
+
+    def readField(self):
+        """ Returns the next NUL terminated field as a string ('' if empty).
+
+        """
+        fields = self.fields
+        while not fields:
+            data = self.recv(self.chunkSize)
+            if not data:
+                raise EOFError('connection closed by TWS')
+            parts = (self.partial + data).split('\0')
+            self.partial = parts.pop()
+            fields.extend(parts)
+        return fields.popleft()
+
+    def readStr(self):
+        """ Same contract as EReader.readStr, but served from the field buffer.
+
+        """
+        return self.readField() or None
+
+    def processMsg(self, msgId):
+        """ Decodes and dispatches one message using the handlers table.
+
+        @param msgId incoming message id
+        @return False to stop reading, True otherwise
+        """
+        if msgId == -1:
+            return False
+        try:
+            handler = handlers[msgId]
+        except (KeyError, ):
+            self.m_parent.error(EClientErrors.NO_VALID_ID, EClientErrors.UNKNOWN_ID.code(),
+                                EClientErrors.UNKNOWN_ID.msg())
+            return False
+        if metrics.enabled:
+            return self.processTimed(handler, msgId)
+        handler(self, msgId)
+        return True
+
+    def processTimed(self, handler, msgId):
+        """ processMsg with the message's size and decode time recorded
+            to ib.opt.metrics.  Fields are counted as they are read.
+
+        """
+        read = self.readField
+        size = [len(str(msgId)) + 1]
+        def readField():
+            field = read()
+            size[0] += len(field) + 1
+            return field
+        self.readField = readField
+        stats = metrics.messageMetrics
+        start = stats.startDecode()
+        try:
+            handler(self, msgId)
+        finally:
+            del self.readField
+        stats.endDecode(msgId, size[0], start)
+        return True
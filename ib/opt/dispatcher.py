@@ -2,18 +2,170 @@
 # -*- coding: utf-8 -*-
 
 ##
-# Defines Dispatcher class to send messages to registered listeners.
+# Defines Dispatcher class to send messages to registered listeners,
+# and the MessageQueue its iterators read from.
 #
 ##
-from Queue import Queue, Empty
+from collections import deque
+from threading import Condition, Lock
+import time
 
 from ib.lib import maybeName, logger
-from ib.opt import message
+from ib.opt import message, metrics
 
 
-class Dispatcher(object):
+##
+# Tick messages, by method name, with the attribute holding their tick
+# type.  A tick supersedes an earlier one with the same tickerId and
+# tick type, so the two may be conflated.
+tickTypeAttributes = {
+    'tickPrice': 'field',
+    'tickSize': 'field',
+    'tickOptionComputation': 'field',
+    'tickGeneric': 'tickType',
+    'tickString': 'tickType',
+    'tickEFP': 'tickType',
+}
+
+
+def conflationKey(message):
+    """ Returns the key under which a message may be conflated.
+
+    @param message instance of Message
+    @return (tickerId, tick type) for ticks, otherwise None
     """
+    attribute = tickTypeAttributes.get(message.typeName)
+    if attribute is None:
+        return None
+    return message.tickerId, getattr(message, attribute)
+
+
+class MessageQueue(object):
+    """ Bounded queue of messages, read in batches.
 
+    What a full queue does with one more message depends on its policy:
+
+        block       put waits for the consumer to make room
+        dropOldest  the oldest queued message is discarded
+        conflate    a tick replaces the queued tick of the same tickerId
+                    and tick type, if there is one, keeping its place;
+                    anything else waits like block
+
+    Consumers wait on a condition, so an idle one costs nothing.
+    """
+    block, dropOldest, conflate = policies = ('block', 'dropOldest', 'conflate')
+
+    def __init__(self, maxsize=10000, policy='block'):
+        """ Initializer.
+
+        @param maxsize most messages queued at once
+        @param policy one of MessageQueue.policies
+        """
+        if policy not in self.policies:
+            raise ValueError('Unknown overflow policy %r' % (policy, ))
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.lock = Lock()
+        self.notEmpty = Condition(self.lock)
+        self.notFull = Condition(self.lock)
+        self.cells = deque()
+        self.pending = {}
+        self.closed = False
+        self.dropped = 0
+        self.conflated = 0
+        self.highWater = 0
+
+    def put(self, message):
+        """ Queues a message, as the overflow policy allows.  Messages put
+            after close are discarded.
+
+        @param message instance of Message
+        @return None
+        """
+        key = conflationKey(message) if self.policy == self.conflate else None
+        with self.lock:
+            if key is not None:
+                cell = self.pending.get(key)
+                if cell is not None:
+                    cell[1] = message
+                    self.conflated += 1
+                    return
+            cells = self.cells
+            if len(cells) >= self.maxsize:
+                if self.policy == self.dropOldest:
+                    cells.popleft()
+                    self.dropped += 1
+                else:
+                    while len(cells) >= self.maxsize and not self.closed:
+                        self.notFull.wait()
+            if self.closed:
+                return
+            cell = [key, message]
+            if key is not None:
+                self.pending[key] = cell
+            cells.append(cell)
+            self.highWater = max(self.highWater, len(cells))
+            self.notEmpty.notify()
+
+    def get(self, maxItems=None, timeout=None):
+        """ Takes the queued messages, waiting for at least one.
+
+        @param maxItems most messages to take, or None for all of them
+        @param timeout seconds to wait, or None to wait until there are
+               messages or the queue is closed
+        @return list of messages; empty on timeout or once closed and drained
+        """
+        with self.lock:
+            cells = self.cells
+            if not cells and not self.closed and timeout != 0:
+                deadline = None if timeout is None else time.time() + timeout
+                while not cells and not self.closed:
+                    wait = None if deadline is None else deadline - time.time()
+                    if wait is not None and wait <= 0:
+                        break
+                    self.notEmpty.wait(wait)
+            count = len(cells) if maxItems is None else min(maxItems, len(cells))
+            pending = self.pending
+            batch = []
+            for _ in xrange(count):
+                key, message = cells.popleft()
+                if key is not None:
+                    del pending[key]
+                batch.append(message)
+            if batch:
+                self.notFull.notify_all()
+            return batch
+
+    def close(self, *args):
+        """ Wakes all waiting consumers and producers.  Messages already
+            queued may still be taken.
+
+        @return None
+        """
+        with self.lock:
+            self.closed = True
+            self.notEmpty.notify_all()
+            self.notFull.notify_all()
+
+    def __len__(self):
+        return len(self.cells)
+
+    def toDict(self):
+        with self.lock:
+            return dict(queued=len(self.cells), highWater=self.highWater, maxsize=self.maxsize,
+                        policy=self.policy, dropped=self.dropped, conflated=self.conflated)
+
+
+class Dispatcher(object):
+    """ Sends each message to the listeners registered for its type.
+
+    Listeners are kept in tuples which are never changed: register and
+    unregister build new ones under a lock and swap them in, along with
+    the (message class, listeners) route of each method name.  Dispatch
+    so needs one dict lookup and no lock, and may run on any number of
+    threads while listeners come and go.
+
+    A tap (see setTap) gets every message, with or without listeners.
     """
     def __init__(self, listeners=None, messageTypes=None):
         """ Initializer.
@@ -21,9 +173,17 @@ class Dispatcher(object):
         @param listeners=None mapping of existing listeners
         @param types=None method name to message type lookup
         """
-        self.listeners = listeners if listeners else {}
         self.messageTypes = messageTypes if messageTypes else message.registry
         self.logger = logger.logger()
+        self.lock = Lock()
+        self.names = {}
+        for name, messageType in self.messageTypes.items():
+            self.names.setdefault(maybeName(messageType[0]), []).append(name)
+        self.listeners = {}
+        self.routes = {}
+        self.tap = None
+        for key, values in (listeners or {}).items():
+            self.update(key, tuple(values))
 
     def __call__(self, name, args):
         """ Send message to each listener.
@@ -32,13 +192,20 @@ class Dispatcher(object):
         @param args arguments for message instance
         @return None
         """
-        results = []
+        if self.tap is not None:
+            try:
+                self.tap(name, args)
+            except (Exception, ):
+                self.logger.exception('Exception in message tap for %s', name)
         try:
-            messageType = self.messageTypes[name]
-            listeners = self.listeners[maybeName(messageType[0])]
+            messageType, listeners = self.routes[name]
         except (KeyError, ):
-            return results
-        message = messageType[0](**args)
+            return []
+        message = messageType(**args)
+        timed = metrics.enabled
+        if timed:
+            start = metrics.timer()
+        results = []
         for listener in listeners:
             try:
                 results.append(listener(message))
@@ -47,8 +214,27 @@ class Dispatcher(object):
                           "Handler '%s' for '%s'")
                 self.logger.exception(errmsg, maybeName(listener), name)
                 results.append(None)
+        if timed:
+            metrics.messageMetrics.recordDispatch(name, metrics.timer() - start)
         return results
 
+    def update(self, key, listeners):
+        """ Swaps in the listeners of a message type.  Called with lock held.
+
+        @param key message type name
+        @param listeners tuple of listeners, possibly empty
+        @return None
+        """
+        if listeners:
+            self.listeners[key] = listeners
+        else:
+            self.listeners.pop(key, None)
+        for name in self.names.get(key, ()):
+            if listeners:
+                self.routes[name] = (self.messageTypes[name][0], listeners)
+            else:
+                self.routes.pop(name, None)
+
     def enableLogging(self, enable=True):
         """ Enable or disable logging of all messages.
 
@@ -61,6 +247,16 @@ class Dispatcher(object):
             self.unregisterAll(self.logMessage)
         return enable
 
+    def setTap(self, tap):
+        """ Sets the callable given the method name and arguments of
+            every message before it is dispatched, ie the tap of an
+            ib.opt.messagelog.MessageLog.
+
+        @param tap callable(name, args), or None to remove the tap
+        @return None
+        """
+        self.tap = tap
+
     def logMessage(self, message):
         """ Format and send a message values to the logger.
 
@@ -70,26 +266,46 @@ class Dispatcher(object):
         line = str.join(', ', ('%s=%s' % item for item in message.items()))
         self.logger.debug('%s(%s)', message.typeName, line)
 
-    def iterator(self, *types):
+    def iterator(self, *types, **options):
         """ Create and return a function for iterating over messages.
 
+        The function is a generator of lists of messages, one per wakeup,
+        read from a MessageQueue.  With block=False it yields what is
+        queued and stops; with a timeout it yields an empty list whenever
+        that many seconds pass without messages.  It ends once the
+        connection is closed and the queue drained, and then unregisters
+        its queue.  The queue is available as its queue attribute.
+
         @param *types zero or more message types to associate with listener
-        @return function that yields messages
+        @param maxsize=10000 most messages queued at once
+        @param policy='block' MessageQueue overflow policy
+        @param batch=None most messages per list, or None for no limit
+        @return function that yields lists of messages
         """
-        queue = Queue()
-        closed = []
-        def messageGenerator(block=True, timeout=0.1):
-            while True:
-                try:
-                    yield queue.get(block=block, timeout=timeout)
-                except (Empty, ):
-                    if closed:
+        queue = MessageQueue(options.get('maxsize', 10000), options.get('policy', MessageQueue.block))
+        batch = options.get('batch')
+        def messageGenerator(block=True, timeout=None):
+            try:
+                while True:
+                    messages = queue.get(batch, timeout if block else 0)
+                    if messages or (block and timeout is not None and not queue.closed):
+                        yield messages
+                    elif not block or queue.closed:
                         break
-        self.register(closed.append, 'ConnectionClosed')
+            finally:
+                queue.close()
+                self.unregister(queue.close, 'ConnectionClosed')
+                if types:
+                    self.unregister(queue.put, *types)
+                else:
+                    self.unregisterAll(queue.put)
+        messageGenerator.queue = queue
         if types:
             self.register(queue.put, *types)
         else:
             self.registerAll(queue.put)
+        # After queue.put, so that a queued ConnectionClosed is still delivered
+        self.register(queue.close, 'ConnectionClosed')
         return messageGenerator
 
     def register(self, listener, *types):
@@ -100,12 +316,13 @@ class Dispatcher(object):
         @return True if associated with one or more handler; otherwise False
         """
         count = 0
-        for messagetype in types:
-            key = maybeName(messagetype)
-            listeners = self.listeners.setdefault(key, [])
-            if listener not in listeners:
-                listeners.append(listener)
-                count += 1
+        with self.lock:
+            for messagetype in types:
+                key = maybeName(messagetype)
+                listeners = self.listeners.get(key, ())
+                if listener not in listeners:
+                    self.update(key, listeners + (listener, ))
+                    count += 1
         return count > 0
 
     def registerAll(self, listener):
@@ -124,14 +341,12 @@ class Dispatcher(object):
         @return True if disassociated with one or more handler; otherwise False
         """
         count = 0
-        for messagetype in types:
-            try:
-                listeners = self.listeners[maybeName(messagetype)]
-            except (KeyError, ):
-                pass
-            else:
+        with self.lock:
+            for messagetype in types:
+                key = maybeName(messagetype)
+                listeners = self.listeners.get(key, ())
                 if listener in listeners:
-                    listeners.remove(listener)
+                    self.update(key, tuple(l for l in listeners if l != listener))
                     count += 1
         return count > 0
 
@@ -0,0 +1,528 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# Precompiled request encoders for the hottest EClientSocket requests.
+#
+# EClientSocket.placeOrder walks a few hundred lines of server-version
+# branches and makes about 100 overloaded send() calls, each of which
+# writes its field one character at a time.  The functions here are
+# generated once per negotiated server version: every version branch
+# is resolved at compile time, leaving a straight-line function that
+# turns a Contract and Order into a flat list of fields.  The fields
+# are then joined into one payload and written with a single call.
+#
+# Use:
+#    {{{
+#    encoder = placeOrderEncoder(client.serverVersion())
+#    problem = encoder.check(contract, order)
+#    payload = encoder(orderId, contract, order)
+#    }}}
+##
+from ib.ext.EClientErrors import EClientErrors
+from ib.ext.EClientSocket import EClientSocket, mlock
+from ib.lib import synchronized, Double, Integer
+from ib.opt.decoder import DecodingReader
+
+
+##
+# Both Java sentinels share the same value, so one constant covers
+# sendMax() for ints and doubles.
+MAX_VALUE = Double.MAX_VALUE
+assert MAX_VALUE == Integer.MAX_VALUE
+
+EOL = '\0'
+
+
+def field(value):
+    """ Encodes one value exactly as EClientSocket.send() would.
+
+    @param value str, int, long, float, bool or None
+    @return encoded field as string (without terminator)
+    """
+    if value is None:
+        return ''
+    if value is True:
+        return '1'
+    if value is False:
+        return '0'
+    return str(value)
+
+
+def fieldMax(value):
+    """ Encodes one value exactly as EClientSocket.sendMax() would.
+
+    @param value int or float, where MAX_VALUE means 'unset'
+    @return encoded field as string (without terminator)
+    """
+    return '' if value == MAX_VALUE else str(value)
+
+
+class Source(object):
+    """ Accumulates indented source lines for a generated function.
+
+    """
+    def __init__(self, signature):
+        self.lines = ['def encode(%s):' % signature,
+                      '    out = []',
+                      '    a = out.append']
+        self.depth = 1
+
+    def __call__(self, line):
+        self.lines.append('    ' * self.depth + line)
+
+    def indent(self):
+        self.depth += 1
+
+    def dedent(self):
+        self.depth -= 1
+
+    def compile(self, name):
+        """ Compiles accumulated source and returns the function.
+
+        @param name name given to the generated function
+        @return generated function
+        """
+        self.depth = 1
+        self('return out')
+        namespace = {'s': field, 'm': fieldMax, 'MAX': MAX_VALUE}
+        exec compile(str.join('\n', self.lines), '<%s>' % name, 'exec') in namespace
+        function = namespace['encode']
+        function.__name__ = name
+        function.source = self.lines
+        return function
+
+
+class Encoder(object):
+    """ A compiled encoder plus the version checks that apply to it.
+
+    Calling an instance returns the whole payload as one string.
+    """
+    def __init__(self, serverVersion, encodeFields, checks):
+        """ Initializer.
+
+        @param serverVersion server version this encoder was compiled for
+        @param encodeFields generated function returning a list of fields
+        @param checks sequence of (predicate, message) for this version
+        """
+        self.serverVersion = serverVersion
+        self.fields = encodeFields
+        self.checks = tuple(checks)
+
+    def check(self, *args):
+        """ Runs the version checks that apply to this server version.
+
+        @return error message of the first failed check, or None
+        """
+        for predicate, message in self.checks:
+            if predicate(*args):
+                return message
+        return None
+
+    def __call__(self, *args):
+        return EOL.join(self.fields(*args)) + EOL
+
+
+C = EClientSocket
+
+
+def emitContract(a, sv, minConIdVersion):
+    """ Emits the contract fields shared by placeOrder and reqMktData.
+
+    """
+    if sv >= minConIdVersion:
+        a('a(s(c.m_conId))')
+    for name in ('symbol', 'secType', 'expiry', 'strike', 'right'):
+        a('a(s(c.m_%s))' % name)
+    if sv >= 15:
+        a('a(s(c.m_multiplier))')
+    a('a(s(c.m_exchange))')
+    if sv >= 14:
+        a('a(s(c.m_primaryExch))')
+    a('a(s(c.m_currency))')
+    if sv >= 2:
+        a('a(s(c.m_localSymbol))')
+    if sv >= C.MIN_SERVER_VER_TRADING_CLASS:
+        a('a(s(c.m_tradingClass))')
+
+
+def emitUnderComp(a):
+    a('uc = c.m_underComp')
+    a('if uc is not None:')
+    a('    a("1"); a(s(uc.m_conId)); a(s(uc.m_delta)); a(s(uc.m_price))')
+    a('else:')
+    a('    a("0")')
+
+
+def emitTagValues(a, expr):
+    a('tvs = %s' % expr)
+    a('a(str(0 if tvs is None else len(tvs)))')
+    a('for tv in tvs or ():')
+    a('    a(s(tv.m_tag)); a(s(tv.m_value))')
+
+
+def compilePlaceOrder(sv):
+    """ Generates the placeOrder field encoder for one server version.
+
+    The generated code mirrors EClientSocket.placeOrder field for field;
+    only branches on the server version are resolved here.
+
+    @param sv negotiated server version
+    @return function(id, c, o) returning list of fields
+    """
+    a = Source('id, c, o')
+    version = 27 if sv < C.MIN_SERVER_VER_NOT_HELD else 41
+    a('a("%d"); a("%d"); a(s(id))' % (C.PLACE_ORDER, version))
+    emitContract(a, sv, C.MIN_SERVER_VER_PLACE_ORDER_CONID)
+    if sv >= C.MIN_SERVER_VER_SEC_ID_TYPE:
+        a('a(s(c.m_secIdType)); a(s(c.m_secId))')
+    a('a(s(o.m_action)); a(s(o.m_totalQuantity)); a(s(o.m_orderType))')
+    if sv < C.MIN_SERVER_VER_ORDER_COMBO_LEGS_PRICE:
+        a('a(s(0 if o.m_lmtPrice == MAX else o.m_lmtPrice))')
+    else:
+        a('a(m(o.m_lmtPrice))')
+    if sv < C.MIN_SERVER_VER_TRAILING_PERCENT:
+        a('a(s(0 if o.m_auxPrice == MAX else o.m_auxPrice))')
+    else:
+        a('a(m(o.m_auxPrice))')
+    for name in ('tif', 'ocaGroup', 'account', 'openClose', 'origin', 'orderRef', 'transmit'):
+        a('a(s(o.m_%s))' % name)
+    if sv >= 4:
+        a('a(s(o.m_parentId))')
+    if sv >= 5:
+        for name in ('blockOrder', 'sweepToFill', 'displaySize', 'triggerMethod'):
+            a('a(s(o.m_%s))' % name)
+        a('a("0")' if sv < 38 else 'a(s(o.m_outsideRth))')
+    if sv >= 7:
+        a('a(s(o.m_hidden))')
+    a('bag = c.m_secType.lower() == "bag"')
+    if sv >= 8:
+        a('if bag:')
+        a.indent()
+        a('legs = c.m_comboLegs')
+        a('a(str(0 if legs is None else len(legs)))')
+        a('for leg in legs or ():')
+        a.indent()
+        a('a(s(leg.m_conId)); a(s(leg.m_ratio)); a(s(leg.m_action)); a(s(leg.m_exchange)); a(s(leg.m_openClose))')
+        if sv >= C.MIN_SERVER_VER_SSHORT_COMBO_LEGS:
+            a('a(s(leg.m_shortSaleSlot)); a(s(leg.m_designatedLocation))')
+        if sv >= C.MIN_SERVER_VER_SSHORTX_OLD:
+            a('a(s(leg.m_exemptCode))')
+        a.dedent()
+        a.dedent()
+    if sv >= C.MIN_SERVER_VER_ORDER_COMBO_LEGS_PRICE:
+        a('if bag:')
+        a('    legs = o.m_orderComboLegs')
+        a('    a(str(0 if legs is None else len(legs)))')
+        a('    for leg in legs or ():')
+        a('        a(m(leg.m_price))')
+    if sv >= C.MIN_SERVER_VER_SMART_COMBO_ROUTING_PARAMS:
+        a('if bag:')
+        a.indent()
+        emitTagValues(a, 'o.m_smartComboRoutingParams')
+        a.dedent()
+    if sv >= 9:
+        a('a("")')
+    if sv >= 10:
+        a('a(s(o.m_discretionaryAmt))')
+    if sv >= 11:
+        a('a(s(o.m_goodAfterTime))')
+    if sv >= 12:
+        a('a(s(o.m_goodTillDate))')
+    if sv >= 13:
+        a('a(s(o.m_faGroup)); a(s(o.m_faMethod)); a(s(o.m_faPercentage)); a(s(o.m_faProfile))')
+    if sv >= 18:
+        a('a(s(o.m_shortSaleSlot)); a(s(o.m_designatedLocation))')
+    if sv >= C.MIN_SERVER_VER_SSHORTX_OLD:
+        a('a(s(o.m_exemptCode))')
+    if sv >= 19:
+        a('a(s(o.m_ocaType))')
+        if sv < 38:
+            a('a("0")')
+        a('a(s(o.m_rule80A)); a(s(o.m_settlingFirm)); a(s(o.m_allOrNone))')
+        a('a(m(o.m_minQty)); a(m(o.m_percentOffset))')
+        a('a(s(o.m_eTradeOnly)); a(s(o.m_firmQuoteOnly))')
+        for name in ('nbboPriceCap', 'auctionStrategy', 'startingPrice', 'stockRefPrice', 'delta'):
+            a('a(m(o.m_%s))' % name)
+        if sv == 26:
+            a('vol = o.m_orderType == "VOL"')
+            a('a(m(MAX if vol else o.m_stockRangeLower)); a(m(MAX if vol else o.m_stockRangeUpper))')
+        else:
+            a('a(m(o.m_stockRangeLower)); a(m(o.m_stockRangeUpper))')
+    if sv >= 22:
+        a('a(s(o.m_overridePercentageConstraints))')
+    if sv >= 26:
+        a('a(m(o.m_volatility)); a(m(o.m_volatilityType))')
+        if sv < 28:
+            a('a(s(o.m_deltaNeutralOrderType.lower() == "mkt"))')
+        else:
+            a('a(s(o.m_deltaNeutralOrderType)); a(m(o.m_deltaNeutralAuxPrice))')
+            if sv >= C.MIN_SERVER_VER_DELTA_NEUTRAL_CONID:
+                a('if o.m_deltaNeutralOrderType:')
+                a('    a(s(o.m_deltaNeutralConId)); a(s(o.m_deltaNeutralSettlingFirm))')
+                a('    a(s(o.m_deltaNeutralClearingAccount)); a(s(o.m_deltaNeutralClearingIntent))')
+            if sv >= C.MIN_SERVER_VER_DELTA_NEUTRAL_OPEN_CLOSE:
+                a('if o.m_deltaNeutralOrderType:')
+                a('    a(s(o.m_deltaNeutralOpenClose)); a(s(o.m_deltaNeutralShortSale))')
+                a('    a(s(o.m_deltaNeutralShortSaleSlot)); a(s(o.m_deltaNeutralDesignatedLocation))')
+        a('a(s(o.m_continuousUpdate))')
+        if sv == 26:
+            a('vol = o.m_orderType == "VOL"')
+            a('a(m(o.m_stockRangeLower if vol else MAX)); a(m(o.m_stockRangeUpper if vol else MAX))')
+        a('a(m(o.m_referencePriceType))')
+    if sv >= 30:
+        a('a(m(o.m_trailStopPrice))')
+    if sv >= C.MIN_SERVER_VER_TRAILING_PERCENT:
+        a('a(m(o.m_trailingPercent))')
+    if sv >= C.MIN_SERVER_VER_SCALE_ORDERS:
+        if sv >= C.MIN_SERVER_VER_SCALE_ORDERS2:
+            a('a(m(o.m_scaleInitLevelSize)); a(m(o.m_scaleSubsLevelSize))')
+        else:
+            a('a(""); a(m(o.m_scaleInitLevelSize))')
+        a('a(m(o.m_scalePriceIncrement))')
+    if sv >= C.MIN_SERVER_VER_SCALE_ORDERS3:
+        a('if o.m_scalePriceIncrement > 0.0 and o.m_scalePriceIncrement != MAX:')
+        a('    a(m(o.m_scalePriceAdjustValue)); a(m(o.m_scalePriceAdjustInterval)); a(m(o.m_scaleProfitOffset))')
+        a('    a(s(o.m_scaleAutoReset)); a(m(o.m_scaleInitPosition)); a(m(o.m_scaleInitFillQty))')
+        a('    a(s(o.m_scaleRandomPercent))')
+    if sv >= C.MIN_SERVER_VER_SCALE_TABLE:
+        a('a(s(o.m_scaleTable)); a(s(o.m_activeStartTime)); a(s(o.m_activeStopTime))')
+    if sv >= C.MIN_SERVER_VER_HEDGE_ORDERS:
+        a('a(s(o.m_hedgeType))')
+        a('if o.m_hedgeType:')
+        a('    a(s(o.m_hedgeParam))')
+    if sv >= C.MIN_SERVER_VER_OPT_OUT_SMART_ROUTING:
+        a('a(s(o.m_optOutSmartRouting))')
+    if sv >= C.MIN_SERVER_VER_PTA_ORDERS:
+        a('a(s(o.m_clearingAccount)); a(s(o.m_clearingIntent))')
+    if sv >= C.MIN_SERVER_VER_NOT_HELD:
+        a('a(s(o.m_notHeld))')
+    if sv >= C.MIN_SERVER_VER_UNDER_COMP:
+        emitUnderComp(a)
+    if sv >= C.MIN_SERVER_VER_ALGO_ORDERS:
+        a('a(s(o.m_algoStrategy))')
+        a('if o.m_algoStrategy:')
+        a.indent()
+        emitTagValues(a, 'o.m_algoParams')
+        a.dedent()
+    if sv >= C.MIN_SERVER_VER_WHAT_IF_ORDERS:
+        a('a(s(o.m_whatIf))')
+    return a.compile('placeOrder_v%d' % sv)
+
+
+def compileReqMktData(sv):
+    """ Generates the reqMktData field encoder for one server version.
+
+    @param sv negotiated server version
+    @return function(tickerId, c, genericTickList, snapshot) returning list of fields
+    """
+    a = Source('tickerId, c, genericTickList, snapshot')
+    a('a("%d"); a("10"); a(s(tickerId))' % C.REQ_MKT_DATA)
+    emitContract(a, sv, C.MIN_SERVER_VER_REQ_MKT_DATA_CONID)
+    if sv >= 8:
+        a('if c.m_secType.lower() == "bag":')
+        a('    legs = c.m_comboLegs')
+        a('    a(str(0 if legs is None else len(legs)))')
+        a('    for leg in legs or ():')
+        a('        a(s(leg.m_conId)); a(s(leg.m_ratio)); a(s(leg.m_action)); a(s(leg.m_exchange))')
+    if sv >= C.MIN_SERVER_VER_UNDER_COMP:
+        emitUnderComp(a)
+    if sv >= 31:
+        a('a(s(genericTickList))')
+    if sv >= C.MIN_SERVER_VER_SNAPSHOT_MKT_DATA:
+        a('a(s(snapshot))')
+    return a.compile('reqMktData_v%d' % sv)
+
+
+def empty(value):
+    return value is None or len(value) == 0
+
+
+def anyLeg(legs, predicate):
+    return any(predicate(leg) for leg in legs or ())
+
+
+def isBag(contract):
+    return contract.m_secType.lower() == C.BAG_SEC_TYPE.lower()
+
+
+##
+# Version checks from EClientSocket.placeOrder as
+# (minimum server version, predicate(contract, order), message).
+placeOrderChecks = (
+    (C.MIN_SERVER_VER_SCALE_ORDERS,
+     lambda c, o: o.m_scaleInitLevelSize != Integer.MAX_VALUE or o.m_scalePriceIncrement != Double.MAX_VALUE,
+     "  It does not support Scale orders."),
+    (C.MIN_SERVER_VER_SSHORT_COMBO_LEGS,
+     lambda c, o: anyLeg(c.m_comboLegs, lambda l: l.m_shortSaleSlot != 0 or not empty(l.m_designatedLocation)),
+     "  It does not support SSHORT flag for combo legs."),
+    (C.MIN_SERVER_VER_WHAT_IF_ORDERS,
+     lambda c, o: o.m_whatIf,
+     "  It does not support what-if orders."),
+    (C.MIN_SERVER_VER_UNDER_COMP,
+     lambda c, o: c.m_underComp is not None,
+     "  It does not support delta-neutral orders."),
+    (C.MIN_SERVER_VER_SCALE_ORDERS2,
+     lambda c, o: o.m_scaleSubsLevelSize != Integer.MAX_VALUE,
+     "  It does not support Subsequent Level Size for Scale orders."),
+    (C.MIN_SERVER_VER_ALGO_ORDERS,
+     lambda c, o: not empty(o.m_algoStrategy),
+     "  It does not support algo orders."),
+    (C.MIN_SERVER_VER_NOT_HELD,
+     lambda c, o: o.m_notHeld,
+     "  It does not support notHeld parameter."),
+    (C.MIN_SERVER_VER_SEC_ID_TYPE,
+     lambda c, o: not empty(c.m_secIdType) or not empty(c.m_secId),
+     "  It does not support secIdType and secId parameters."),
+    (C.MIN_SERVER_VER_PLACE_ORDER_CONID,
+     lambda c, o: c.m_conId > 0,
+     "  It does not support conId parameter."),
+    (C.MIN_SERVER_VER_SSHORTX,
+     lambda c, o: o.m_exemptCode != -1,
+     "  It does not support exemptCode parameter."),
+    (C.MIN_SERVER_VER_SSHORTX,
+     lambda c, o: anyLeg(c.m_comboLegs, lambda l: l.m_exemptCode != -1),
+     "  It does not support exemptCode parameter."),
+    (C.MIN_SERVER_VER_HEDGE_ORDERS,
+     lambda c, o: not empty(o.m_hedgeType),
+     "  It does not support hedge orders."),
+    (C.MIN_SERVER_VER_OPT_OUT_SMART_ROUTING,
+     lambda c, o: o.m_optOutSmartRouting,
+     "  It does not support optOutSmartRouting parameter."),
+    (C.MIN_SERVER_VER_DELTA_NEUTRAL_CONID,
+     lambda c, o: (o.m_deltaNeutralConId > 0 or not empty(o.m_deltaNeutralSettlingFirm) or
+                   not empty(o.m_deltaNeutralClearingAccount) or not empty(o.m_deltaNeutralClearingIntent)),
+     "  It does not support deltaNeutral parameters: ConId, SettlingFirm, ClearingAccount, ClearingIntent"),
+    (C.MIN_SERVER_VER_DELTA_NEUTRAL_OPEN_CLOSE,
+     lambda c, o: (not empty(o.m_deltaNeutralOpenClose) or o.m_deltaNeutralShortSale or
+                   o.m_deltaNeutralShortSaleSlot > 0 or not empty(o.m_deltaNeutralDesignatedLocation)),
+     "  It does not support deltaNeutral parameters: OpenClose, ShortSale, ShortSaleSlot, DesignatedLocation"),
+    (C.MIN_SERVER_VER_SCALE_ORDERS3,
+     lambda c, o: (o.m_scalePriceIncrement > 0 and o.m_scalePriceIncrement != Double.MAX_VALUE and
+                   (o.m_scalePriceAdjustValue != Double.MAX_VALUE or
+                    o.m_scalePriceAdjustInterval != Integer.MAX_VALUE or
+                    o.m_scaleProfitOffset != Double.MAX_VALUE or o.m_scaleAutoReset or
+                    o.m_scaleInitPosition != Integer.MAX_VALUE or
+                    o.m_scaleInitFillQty != Integer.MAX_VALUE or o.m_scaleRandomPercent)),
+     "  It does not support Scale order parameters: PriceAdjustValue, PriceAdjustInterval, "
+     "ProfitOffset, AutoReset, InitPosition, InitFillQty and RandomPercent"),
+    (C.MIN_SERVER_VER_ORDER_COMBO_LEGS_PRICE,
+     lambda c, o: isBag(c) and anyLeg(o.m_orderComboLegs, lambda l: l.m_price != Double.MAX_VALUE),
+     "  It does not support per-leg prices for order combo legs."),
+    (C.MIN_SERVER_VER_TRAILING_PERCENT,
+     lambda c, o: o.m_trailingPercent != Double.MAX_VALUE,
+     "  It does not support trailing percent parameter"),
+    (C.MIN_SERVER_VER_TRADING_CLASS,
+     lambda c, o: not empty(c.m_tradingClass),
+     "  It does not support tradingClass parameters in placeOrder."),
+    (C.MIN_SERVER_VER_SCALE_TABLE,
+     lambda c, o: not empty(o.m_scaleTable) or not empty(o.m_activeStartTime) or not empty(o.m_activeStopTime),
+     "  It does not support scaleTable, activeStartTime and activeStopTime parameters."),
+)
+
+
+##
+# Version checks from EClientSocket.reqMktData as
+# (minimum server version, predicate(contract, snapshot), message).
+reqMktDataChecks = (
+    (C.MIN_SERVER_VER_SNAPSHOT_MKT_DATA,
+     lambda c, snapshot: snapshot,
+     "  It does not support snapshot market data requests."),
+    (C.MIN_SERVER_VER_UNDER_COMP,
+     lambda c, snapshot: c.m_underComp is not None,
+     "  It does not support delta-neutral orders."),
+    (C.MIN_SERVER_VER_REQ_MKT_DATA_CONID,
+     lambda c, snapshot: c.m_conId > 0,
+     "  It does not support conId parameter."),
+    (C.MIN_SERVER_VER_TRADING_CLASS,
+     lambda c, snapshot: not empty(c.m_tradingClass),
+     "  It does not support tradingClass parameter in reqMarketData."),
+)
+
+
+def applicable(checks, sv):
+    return [(predicate, message) for minVersion, predicate, message in checks if sv < minVersion]
+
+
+##
+# Compiled encoders, keyed by server version.  Compilation is cheap
+# and idempotent, so a race between two connections only wastes work.
+placeOrderEncoders = {}
+reqMktDataEncoders = {}
+
+
+def placeOrderEncoder(sv):
+    """ Returns the placeOrder encoder for a server version, compiling it on first use.
+
+    @param sv negotiated server version
+    @return Encoder instance; call as encoder(id, contract, order)
+    """
+    try:
+        return placeOrderEncoders[sv]
+    except (KeyError, ):
+        encoder = placeOrderEncoders[sv] = Encoder(sv, compilePlaceOrder(sv), applicable(placeOrderChecks, sv))
+        return encoder
+
+
+def reqMktDataEncoder(sv):
+    """ Returns the reqMktData encoder for a server version, compiling it on first use.
+
+    @param sv negotiated server version
+    @return Encoder instance; call as encoder(tickerId, contract, genericTickList, snapshot)
+    """
+    try:
+        return reqMktDataEncoders[sv]
+    except (KeyError, ):
+        encoder = reqMktDataEncoders[sv] = Encoder(sv, compileReqMktData(sv), applicable(reqMktDataChecks, sv))
+        return encoder
+
+
+class EncodingClientSocket(EClientSocket):
+    """ EClientSocket that sends placeOrder and reqMktData as one precompiled payload.
+
+    Every other request goes through the generated EClientSocket code
+    unchanged.  Incoming messages are read by a DecodingReader.
+    """
+    def createReader(self, socket, dis):
+        """ Same contract as EClientSocket.createReader.
+
+        """
+        return DecodingReader(socket, dis)
+
+    @synchronized(mlock)
+    def placeOrder(self, id, contract, order):
+        """ Same contract as EClientSocket.placeOrder.
+
+        """
+        if not self.m_connected:
+            self.notConnected()
+            return
+        encoder = placeOrderEncoder(self.m_serverVersion)
+        problem = encoder.check(contract, order)
+        if problem is not None:
+            self.error(id, EClientErrors.UPDATE_TWS, problem)
+            return
+        try:
+            self.m_dos.writeBytes(encoder(id, contract, order))
+        except Exception as e:
+            self.error(id, EClientErrors.FAIL_SEND_ORDER, str(e))
+            self.close()
+
+    @synchronized(mlock)
+    def reqMktData(self, tickerId, contract, genericTickList, snapshot):
+        """ Same contract as EClientSocket.reqMktData.
+
+        """
+        if not self.m_connected:
+            self.error(EClientErrors.NO_VALID_ID, EClientErrors.NOT_CONNECTED, "")
+            return
+        encoder = reqMktDataEncoder(self.m_serverVersion)
+        problem = encoder.check(contract, snapshot)
+        if problem is not None:
+            self.error(tickerId, EClientErrors.UPDATE_TWS, problem)
+            return
+        try:
+            self.m_dos.writeBytes(encoder(tickerId, contract, genericTickList, snapshot))
+        except Exception as e:
+            self.error(tickerId, EClientErrors.FAIL_SEND_REQMKT, str(e))
+            self.close()
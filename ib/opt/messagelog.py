@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# Segmented binary log of every message dispatched, for auditing and
+# offline analysis.
+#
+# A MessageLog is given to each connection's Dispatcher as its tap
+# (Dispatcher.setTap), and appends a record per message, before it is
+# dispatched:
+#
+#    time (float seconds), connection id, message type, payload length
+#
+# The payload is the message's arguments in slot order, marshalled,
+# with IbPy objects reduced to their fields differing from the class'
+# defaults.  Connection ids are numbered by the log, and listed with
+# the label each tap was made with in the directory's connections
+# file.
+#
+# Records go to segment files named by the time of their first record
+# (in microseconds), each starting with the message type names its
+# records' types index.  A segment is closed and the next one started
+# once it reaches segmentBytes, and with maxSegments, the oldest are
+# deleted beyond that many.  Alongside each segment, a sparse index
+# holds the time and offset of a record every indexInterval bytes; the
+# segment is flushed to disk as each is written.
+#
+# MessageLogReader memory-maps the segments overlapping a time range,
+# bisects their index for the first record, and skips records of other
+# types or connections without unmarshalling them.
+#
+# Use:
+#    {{{
+#    log = MessageLog('/var/log/ibrest/messages', maxSegments=100)
+#    con = ibConnection(port=4001, clientId=1)
+#    con.setTap(log.tap('clientId 1'))
+#    ...
+#    for seconds, connectionId, message in MessageLogReader(log.directory).read(start, end, 'OpenOrder'):
+#        print seconds, connectionId, message
+#    }}}
+#
+# or from the command line:
+#
+#    python -m ib.opt.messagelog DIRECTORY [--start T] [--end T] [--type NAME]
+##
+from bisect import bisect_left
+from mmap import mmap, ACCESS_READ
+from struct import Struct
+from threading import Lock
+import marshal
+import os
+import time
+
+from ib.lib import logger
+from ib.opt import decoder, message
+
+
+MAGIC = 'IBMLOG1\n'
+
+##
+# Segment header after MAGIC: length of the marshalled type names.
+namesHeader = Struct('!I')
+
+##
+# Record header: time, connection id, index of the message type name,
+# payload length.
+header = Struct('!dIHI')
+
+##
+# Index entry: time and segment offset of a record.
+indexEntry = Struct('!dQ')
+
+SEGMENT_SUFFIX = '.iblog'
+INDEX_SUFFIX = '.idx'
+CONNECTIONS = 'connections'
+
+##
+# Marks a dict in a payload as an IbPy object, holding its class name.
+OBJECT = '@'
+
+##
+# Types marshalled as they are.
+scalarTypes = (int, long, float, bool, str, unicode, type(None))
+
+##
+# Fields of each IbPy class with their defaults, as (name, default)
+# tuples; see objectFields.
+classFields = {}
+
+
+def objectFields(cls):
+    """ @return tuple of (field name, default) of an IbPy class
+    """
+    try:
+        return classFields[cls]
+    except (KeyError, ):
+        pass
+    instance = cls()
+    names = getattr(cls, 'fields', None) or sorted(
+        set(name for name in dir(cls) if name.startswith('m_')) | set(getattr(instance, '__dict__', ())))
+    fields = classFields[cls] = tuple((name, getattr(instance, name)) for name in names
+                                      if not callable(getattr(instance, name)))
+    return fields
+
+
+def encode(value):
+    """ @return value in marshallable form, IbPy objects as dicts of their
+        fields differing from their defaults, under OBJECT their class name,
+        and anything else (ie the exception of an error) as its str
+    """
+    if type(value) in scalarTypes:
+        return value
+    if isinstance(value, (list, tuple)):
+        return [encode(v) for v in value]
+    if type(value).__name__ not in decoder.objectTypes:
+        return str(value)
+    fields = {OBJECT: type(value).__name__}
+    for name, default in objectFields(type(value)):
+        v = getattr(value, name)
+        if not isDefault(v, default):
+            fields[name] = encode(v)
+    return fields
+
+
+def isDefault(value, default):
+    """ @return True if value is a field's default: an equal scalar, or
+        an empty list for an empty list
+    """
+    if type(value) is not type(default):
+        return False
+    if type(value) in scalarTypes:
+        return value == default
+    return isinstance(value, list) and not value and not default
+
+
+def decode(value):
+    """ @return value with the objects encode made dicts of rebuilt from
+        decoder.objectTypes (ext or slotted classes, as decoding is), or
+        left dicts if their class is not one of those
+    """
+    if isinstance(value, list):
+        return [decode(v) for v in value]
+    if isinstance(value, dict) and value.get(OBJECT) in decoder.objectTypes:
+        obj = decoder.objectTypes[value.pop(OBJECT)]()
+        for name, v in value.items():
+            setattr(obj, name, decode(v))
+        return obj
+    return value
+
+
+def segmentPaths(directory):
+    """ @return sorted list of (start time, segment path) in directory
+    """
+    segments = []
+    for name in os.listdir(directory):
+        if name.endswith(SEGMENT_SUFFIX):
+            try:
+                segments.append((int(name[:-len(SEGMENT_SUFFIX)]) / 1e6, os.path.join(directory, name)))
+            except (ValueError, ):
+                pass
+    return sorted(segments)
+
+
+class MessageLog(object):
+    """ Appends dispatched messages to segment files in a directory.
+
+    Shared by the taps of any number of connections, on any threads.
+    """
+    def __init__(self, directory, segmentBytes=64 << 20, maxSegments=0, indexInterval=64 << 10):
+        """ Initializer.
+
+        @param directory where segments are written, created if missing
+        @param segmentBytes size at which a segment is closed
+        @param maxSegments most segments kept, or 0 to keep them all
+        @param indexInterval bytes of records between index entries
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.segmentBytes = segmentBytes
+        self.maxSegments = maxSegments
+        self.indexInterval = indexInterval
+        self.names = tuple(sorted(message.registry))
+        self.typeIndex = dict((name, i) for i, name in enumerate(self.names))
+        self.slots = dict((name, message.registry[name][0].__slots__) for name in self.names)
+        self.lock = Lock()
+        self.logger = logger.logger()
+        self.segment = self.index = None
+        self.size = self.nextIndex = 0
+        self.last = 0.0
+        self.connectionId = 0
+        try:
+            with open(os.path.join(directory, CONNECTIONS)) as connections:
+                for line in connections:
+                    self.connectionId = max(self.connectionId, int(line.split('\t', 1)[0]))
+        except (IOError, ValueError, ):
+            pass
+
+    def tap(self, label=''):
+        """ Numbers a new connection.
+
+        @param label description of the connection for the connections
+               file, ie its host, port and clientId
+        @return callable(name, args) for Dispatcher.setTap
+        """
+        with self.lock:
+            self.connectionId += 1
+            connectionId = self.connectionId
+            with open(os.path.join(self.directory, CONNECTIONS), 'a') as connections:
+                connections.write('%d\t%.6f\t%s\n' % (connectionId, time.time(), label.replace('\n', ' ')))
+        def tap(name, args):
+            self.write(connectionId, name, args)
+        tap.connectionId = connectionId
+        return tap
+
+    def write(self, connectionId, name, args):
+        """ Appends one message.  Messages of types the registry doesn't
+            know are left out, as Dispatcher leaves them undispatched.
+
+        @param connectionId id numbered by tap
+        @param name method name, ie tickPrice
+        @param args arguments for message instance
+        @return None
+        """
+        try:
+            typeIndex = self.typeIndex[name]
+        except (KeyError, ):
+            return
+        payload = marshal.dumps(tuple([encode(args.get(slot)) for slot in self.slots[name]]), 2)
+        with self.lock:
+            # Records stay in time order even if the clock steps back
+            now = self.last = max(time.time(), self.last)
+            if self.segment is None or self.size >= self.segmentBytes:
+                self.rotate(now)
+            if self.size >= self.nextIndex:
+                self.segment.flush()
+                self.index.write(indexEntry.pack(now, self.size))
+                self.index.flush()
+                self.nextIndex = self.size + self.indexInterval
+            self.segment.write(header.pack(now, connectionId, typeIndex, len(payload)))
+            self.segment.write(payload)
+            self.size += header.size + len(payload)
+
+    def rotate(self, now):
+        """ Closes the current segment and starts one for records from
+            now, deleting the oldest beyond maxSegments.  Called with lock
+            held.
+
+        """
+        self.closeSegment()
+        stem = os.path.join(self.directory, '%020d' % int(now * 1e6))
+        self.segment = open(stem + SEGMENT_SUFFIX, 'ab')
+        self.index = open(stem + INDEX_SUFFIX, 'ab')
+        names = marshal.dumps(self.names, 2)
+        self.segment.write(MAGIC + namesHeader.pack(len(names)) + names)
+        self.size = self.nextIndex = len(MAGIC) + namesHeader.size + len(names)
+        if self.maxSegments:
+            for start, path in segmentPaths(self.directory)[:-self.maxSegments]:
+                for oldPath in (path, path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX):
+                    try:
+                        os.remove(oldPath)
+                    except (OSError, ):
+                        self.logger.exception('Could not remove message log segment %s', oldPath)
+
+    def closeSegment(self):
+        for stream in (self.segment, self.index):
+            if stream is not None:
+                stream.close()
+        self.segment = self.index = None
+
+    def flush(self):
+        with self.lock:
+            for stream in (self.segment, self.index):
+                if stream is not None:
+                    stream.flush()
+
+    def close(self):
+        with self.lock:
+            self.closeSegment()
+
+
+class IndexTimes(object):
+    """ Sequence view of the times in a memory-mapped index, for bisect.
+
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data) // indexEntry.size
+
+    def __getitem__(self, i):
+        return indexEntry.unpack_from(self.data, i * indexEntry.size)[0]
+
+
+def mapFile(path):
+    """ @return read only mmap of path, or None if it is missing or empty
+    """
+    try:
+        with open(path, 'rb') as stream:
+            if os.fstat(stream.fileno()).st_size == 0:
+                return None
+            return mmap(stream.fileno(), 0, access=ACCESS_READ)
+    except (IOError, OSError, ):
+        return None
+
+
+class MessageLogReader(object):
+    """ Time range queries over the segments of a MessageLog directory.
+
+    Segments still being written can be read up to their last flush.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def connections(self):
+        """ @return dict of connection id to (time tapped, label)
+        """
+        connections = {}
+        try:
+            with open(os.path.join(self.directory, CONNECTIONS)) as lines:
+                for line in lines:
+                    connectionId, tapped, label = line.rstrip('\n').split('\t', 2)
+                    connections[int(connectionId)] = (float(tapped), label)
+        except (IOError, ValueError, ):
+            pass
+        return connections
+
+    def read(self, start=None, end=None, types=None, connectionIds=None):
+        """ Generates the messages logged from start until end.
+
+        @param start time of the first message, or None for the oldest
+        @param end time the messages are before, or None for the newest
+        @param types message type names (ie 'OpenOrder') or method names
+               (ie 'openOrder'), or None for all of them
+        @param connectionIds connection ids, or None for all of them
+        @return generator of (time, connection id, Message) tuples
+        """
+        if isinstance(types, basestring):
+            types = (types, )
+        segments = segmentPaths(self.directory)
+        for i, (segmentStart, path) in enumerate(segments):
+            if end is not None and segmentStart >= end:
+                break
+            if start is not None and i + 1 < len(segments) and segments[i + 1][0] <= start:
+                continue
+            for record in self.readSegment(path, start, end, types, connectionIds):
+                yield record
+
+    def readSegment(self, path, start, end, types, connectionIds):
+        data = mapFile(path)
+        if data is None or data[:len(MAGIC)] != MAGIC:
+            return
+        try:
+            offset = len(MAGIC)
+            length = namesHeader.unpack_from(data, offset)[0]
+            offset += namesHeader.size
+            names = marshal.loads(data[offset:offset + length])
+            offset += length
+            messageTypes = [message.registry[name][0] if name in message.registry else None for name in names]
+            wanted = None
+            if types is not None:
+                wanted = set(i for i, name in enumerate(names)
+                             if name in types or (messageTypes[i] and messageTypes[i].__name__ in types))
+            if start is not None:
+                offset = max(offset, self.seek(path, start))
+            size = len(data)
+            unpack = header.unpack_from
+            while offset + header.size <= size:
+                seconds, connectionId, typeIndex, length = unpack(data, offset)
+                offset += header.size
+                if offset + length > size or (end is not None and seconds >= end):
+                    # a record cut short by a crash, or the end of the range
+                    break
+                if (start is None or seconds >= start) and (wanted is None or typeIndex in wanted) and \
+                        (connectionIds is None or connectionId in connectionIds):
+                    messageType = messageTypes[typeIndex]
+                    if messageType is not None:
+                        values = marshal.loads(data[offset:offset + length])
+                        args = dict(zip(messageType.__slots__, [decode(v) for v in values]))
+                        yield seconds, connectionId, messageType(**args)
+                offset += length
+        finally:
+            data.close()
+
+    def seek(self, path, start):
+        """ @return offset of an indexed record at or before the first one
+            from start, or 0 if there is none
+        """
+        index = mapFile(path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX)
+        if index is None:
+            return 0
+        try:
+            i = bisect_left(IndexTimes(index), start)
+            return indexEntry.unpack_from(index, (i - 1) * indexEntry.size)[1] if i > 0 else 0
+        finally:
+            index.close()
+
+
+def main(argv):
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog DIRECTORY [--start T] [--end T] [--type NAME] [--connection ID]')
+    parser.add_option('--start', type='float', help='time (seconds since the epoch) of the first message')
+    parser.add_option('--end', type='float', help='time the messages are before')
+    parser.add_option('--type', action='append', help='message type to show (repeatable)')
+    parser.add_option('--connection', type='int', action='append', help='connection id to show (repeatable)')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('a message log directory is required')
+    reader = MessageLogReader(args[0])
+    for connectionId, (tapped, label) in sorted(reader.connections().items()):
+        print '# connection %d %s %s' % (connectionId, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(tapped)),
+                                         label)
+    for seconds, connectionId, msg in reader.read(options.start, options.end, options.type, options.connection):
+        print '%.6f %d %s' % (seconds, connectionId, msg)
+
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv[1:])
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# Opt-in timing of the work done per message on the thread reading TWS.
+#
+# Once enabled, DecodingReader.processMsg records for each incoming
+# message id how many arrived, their bytes, and the time spent decoding
+# them (not counting listeners), and Dispatcher.__call__ records for
+# each message type the time its listeners took.  Times go into
+# histograms with fixed buckets, so recording is a bisect and a few
+# increments.  render() writes everything in the Prometheus text
+# exposition format.  While disabled, the default, each message costs
+# a single attribute test.
+#
+# Use:
+#    {{{
+#    from ib.opt import metrics
+#    metrics.enable()
+#    ...
+#    print metrics.render()
+#    }}}
+##
+from bisect import bisect_left
+from threading import Lock, local
+import time
+
+from ib.ext.EReader import EReader
+
+
+##
+# True while messages are being timed; see enable.
+enabled = False
+
+##
+# Clock used for all timings.
+timer = time.time
+
+##
+# Upper bounds, in seconds, of the histogram buckets.
+secondsBuckets = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                  0.1, 0.25, 0.5, 1.0)
+
+##
+# Incoming message id to its EReader constant name, ie 1 to TICK_PRICE.
+messageNames = dict((value, name) for name, value in vars(EReader).items()
+                    if name.isupper() and isinstance(value, int))
+
+
+class Histogram(object):
+    """ Counts of observed values per bucket, with their count and sum.
+        Not locked; the Metrics owning it is.
+
+    """
+    def __init__(self, bounds=secondsBuckets):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        """ Prometheus text lines for this histogram.
+
+        @param name metric name, without the _bucket, _sum or _count suffix
+        @param labels label string for inside the braces, ie 'type="tickPrice"'
+        @return list of strings
+        """
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + ('+Inf', ), self.counts):
+            cumulative += count
+            lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, cumulative))
+        lines.append('%s_sum{%s} %r' % (name, labels, self.sum))
+        lines.append('%s_count{%s} %d' % (name, labels, self.count))
+        return lines
+
+
+class Metrics(object):
+    """ Per message id decode statistics and per message type listener
+        times, shared by all connections.
+
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.decoded = {}
+        self.dispatched = {}
+        self.current = local()
+
+    def recordDecode(self, msgId, size, seconds):
+        """ Records one decoded message.
+
+        @param msgId incoming message id
+        @param size bytes the message took on the wire
+        @param seconds time decoding, not counting listeners
+        """
+        with self.lock:
+            try:
+                stats = self.decoded[msgId]
+            except (KeyError, ):
+                stats = self.decoded[msgId] = [0, 0, Histogram()]
+            stats[0] += 1
+            stats[1] += size
+            stats[2].observe(seconds)
+
+    def recordDispatch(self, name, seconds):
+        """ Records the time the listeners of one message took, and adds it
+            to the listener time of the message being decoded on this thread.
+
+        @param name method name, ie tickPrice
+        @param seconds time in listeners
+        """
+        current = self.current
+        current.listenerTime = getattr(current, 'listenerTime', 0.0) + seconds
+        with self.lock:
+            try:
+                histogram = self.dispatched[name]
+            except (KeyError, ):
+                histogram = self.dispatched[name] = Histogram()
+            histogram.observe(seconds)
+
+    def startDecode(self):
+        """ Marks the start of a message on this thread.
+
+        @return start time
+        """
+        self.current.listenerTime = 0.0
+        return timer()
+
+    def endDecode(self, msgId, size, start):
+        """ Records a message started with startDecode, less the listener
+            time dispatched since.
+
+        """
+        elapsed = timer() - start
+        self.recordDecode(msgId, size, max(0.0, elapsed - self.current.listenerTime))
+
+    def reset(self):
+        with self.lock:
+            self.decoded.clear()
+            self.dispatched.clear()
+
+    def render(self):
+        """ Formats all metrics in the Prometheus text exposition format.
+
+        @return string
+        """
+        with self.lock:
+            decoded = sorted((messageNames.get(msgId, str(msgId)), stats[0], stats[1], stats[2])
+                             for msgId, stats in self.decoded.items())
+            dispatched = sorted(self.dispatched.items())
+            lines = [
+                '# HELP ib_messages_received_total Messages received from TWS, by message id.',
+                '# TYPE ib_messages_received_total counter',
+            ]
+            lines.extend('ib_messages_received_total{msg="%s"} %d' % (name, count)
+                         for name, count, size, histogram in decoded)
+            lines.extend([
+                '# HELP ib_message_bytes_total Bytes of messages received from TWS, by message id.',
+                '# TYPE ib_message_bytes_total counter',
+            ])
+            lines.extend('ib_message_bytes_total{msg="%s"} %d' % (name, size)
+                         for name, count, size, histogram in decoded)
+            lines.extend([
+                '# HELP ib_decode_seconds Time decoding messages received from TWS, not counting listeners.',
+                '# TYPE ib_decode_seconds histogram',
+            ])
+            for name, count, size, histogram in decoded:
+                lines.extend(histogram.lines('ib_decode_seconds', 'msg="%s"' % name))
+            lines.extend([
+                '# HELP ib_dispatch_seconds Time in the listeners of each message type.',
+                '# TYPE ib_dispatch_seconds histogram',
+            ])
+            for name, histogram in dispatched:
+                lines.extend(histogram.lines('ib_dispatch_seconds', 'type="%s"' % name))
+        return str.join('\n', lines) + '\n'
+
+
+##
+# The Metrics instance readers and dispatchers record to.
+messageMetrics = Metrics()
+
+
+def enable(on=True):
+    """ Starts or stops timing messages.
+
+    @param on if True (default), enables timing; otherwise disables
+    @return on
+    """
+    global enabled
+    enabled = bool(on)
+    return enabled
+
+
+def render():
+    """ @return messageMetrics in the Prometheus text exposition format
+    """
+    return messageMetrics.render()
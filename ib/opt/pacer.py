@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# Outbound message pacing.
+#
+# TWS disconnects clients that send more than about 50 messages per
+# second.  A paced client collects the fields of each request into one
+# message instead of writing them to the socket one character at a
+# time, then takes a token from each of its buckets (typically one of
+# its own and one shared by every connection to the same gateway).
+# A message with tokens to spare is written right away; one over the
+# rate is queued and written by the scheduler thread at the time its
+# tokens become available, so bursts are smoothed rather than dropped.
+# Messages of one connection are always written in order.
+#
+# Use:
+#    {{{
+#    con = ibConnection(...)
+#    con.connect()
+#    stats = PacingStats()
+#    pace(con.sender.client, [TokenBucket(44, 5)], stats)
+#    con.reqMktData(...)
+#    print stats.toDict()
+#    }}}
+##
+from collections import deque
+from functools import wraps
+from itertools import count
+from threading import Condition, Lock, Thread
+import heapq
+import time
+
+from ib.ext.EClientSocket import EClientSocket, mlock
+from ib.lib import DataOutputStream, logger
+
+
+##
+# EClientSocket methods which send a request, and so one message each.
+requestPrefixes = ('req', 'cancel', 'place', 'calculate', 'exercise', 'replace', 'request', 'set')
+requestMethods = tuple(sorted(name for name, value in vars(EClientSocket).items()
+                              if name.startswith(requestPrefixes) and callable(value)))
+
+
+class TokenBucket(object):
+    """ Token bucket which hands out send times instead of refusing.
+
+    Kept as the virtual time its next token is due (the GCRA form of a
+    token bucket), so that one send time can be taken from several
+    buckets at once.  Tokens accrue at rate per second up to burst, and
+    a message finding none left is given the time its token will be
+    there.  In any one second window at most rate + burst messages are
+    due, plus one for a message landing right on the window's edge.
+    """
+    def __init__(self, rate, burst=1):
+        """ Initializer.
+
+        @param rate messages per second
+        @param burst messages which may be sent back to back
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.interval = 1.0 / self.rate
+        self.tolerance = (max(self.burst, 1.0) - 1) * self.interval
+        self.due = 0.0
+
+    def earliest(self):
+        """ @return time the next token is available at
+        """
+        return self.due - self.tolerance
+
+    def take(self, at):
+        """ Takes a token for a message sent at time at.
+        """
+        self.due = max(self.due, at) + self.interval
+
+
+##
+# Serializes reservations, so that each one sees all of its buckets
+# in the same state.
+reserveLock = Lock()
+
+
+def reserve(buckets):
+    """ Takes a token from each bucket for one message.
+
+    @param buckets sequence of TokenBuckets
+    @return time the message may be sent at; now or later
+    """
+    with reserveLock:
+        due = time.time()
+        for bucket in buckets:
+            due = max(due, bucket.earliest())
+        for bucket in buckets:
+            bucket.take(due)
+    return due
+
+
+class PacingStats(object):
+    """ Counts messages and how long they were queued.  May be shared
+        by many streams.
+
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.messages = 0
+        self.delayed = 0
+        self.queued = 0
+        self.totalDelay = 0.0
+        self.maxDelay = 0.0
+
+    def enqueue(self):
+        with self.lock:
+            self.queued += 1
+
+    def record(self, delay, queued=False):
+        """ Records a message written after waiting delay seconds.
+
+        """
+        with self.lock:
+            self.messages += 1
+            if queued:
+                self.queued -= 1
+                self.delayed += 1
+                self.totalDelay += delay
+                self.maxDelay = max(self.maxDelay, delay)
+
+    def toDict(self):
+        with self.lock:
+            return dict(messages=self.messages, delayed=self.delayed, queued=self.queued,
+                        meanDelayMs=round(self.totalDelay / self.delayed * 1e3, 1) if self.delayed else 0,
+                        maxDelayMs=round(self.maxDelay * 1e3, 1))
+
+
+class Scheduler(object):
+    """ Thread which calls each scheduled callback once it is due.
+
+    """
+    def __init__(self, name='Pacer'):
+        self.name = name
+        self.heap = []
+        self.sequence = count()
+        self.condition = Condition()
+        self.thread = None
+        self.logger = logger.logger()
+
+    def schedule(self, due, callback):
+        """ Calls callback() on the scheduler thread at time due.  Callbacks
+            due at the same time are called in the order they were scheduled.
+
+        """
+        with self.condition:
+            heapq.heappush(self.heap, (due, next(self.sequence), callback))
+            self.condition.notify()
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name=self.name)
+                self.thread.setDaemon(True)
+                self.thread.start()
+
+    def run(self):
+        heap = self.heap
+        while True:
+            with self.condition:
+                while True:
+                    wait = heap[0][0] - time.time() if heap else None
+                    if wait is not None and wait <= 0:
+                        break
+                    self.condition.wait(wait)
+                callback = heapq.heappop(heap)[2]
+            try:
+                callback()
+            except (Exception, ):
+                self.logger.exception('Exception in paced write')
+
+
+defaultScheduler = Scheduler()
+
+
+class PacedStream(object):
+    """ Output stream which collects the fields of one request, then
+        writes them as one message when its buckets allow.
+
+    """
+    def __init__(self, write, buckets, stats=None, onError=None, scheduler=None):
+        """ Initializer.
+
+        @param write callable(data) sending data on the connection
+        @param buckets TokenBuckets every message takes a token from
+        @param stats PacingStats to record to, or None
+        @param onError callable() for when a write fails
+        @param scheduler Scheduler for queued messages; default is defaultScheduler
+        """
+        self.write = write
+        self.buckets = tuple(buckets)
+        self.stats = PacingStats() if stats is None else stats
+        self.onError = onError
+        self.scheduler = defaultScheduler if scheduler is None else scheduler
+        self.buffer = []
+        self.lock = Lock()
+        self.pending = deque()
+        self.lastDue = 0
+        self.failed = False
+
+    def send(self, data):
+        self.buffer.append(data)
+        return len(data)
+
+    sendall = send
+
+    def flush(self):
+        """ Ends the current message, and writes or queues it.
+
+        """
+        if not self.buffer:
+            return
+        data = str.join('', self.buffer)
+        self.buffer = []
+        due = reserve(self.buckets)
+        with self.lock:
+            # Never before an earlier message of this connection
+            due = self.lastDue = max(due, self.lastDue)
+            queued = bool(self.pending) or due > time.time()
+            if queued:
+                self.pending.append((data, time.time()))
+                self.stats.enqueue()
+            else:
+                ok = self.writeMessage(data, 0.0, False)
+        if queued:
+            self.scheduler.schedule(due, self.writeNext)
+        elif not ok:
+            self.failed = True
+            if self.onError is not None:
+                self.onError()
+
+    def writeNext(self):
+        with self.lock:
+            data, queued = self.pending.popleft()
+            ok = self.writeMessage(data, time.time() - queued, True)
+        if not ok and not self.failed:
+            self.failed = True
+            if self.onError is not None:
+                self.onError()
+
+    def writeMessage(self, data, delay, queued):
+        self.stats.record(delay, queued)
+        if self.failed:
+            return True
+        try:
+            self.write(data)
+        except (Exception, ):
+            return False
+        return True
+
+
+def pacedRequest(method, stream):
+    """ Wraps a request method to flush stream once it has been called.
+
+    """
+    @wraps(method)
+    def request(*args):
+        with mlock:
+            try:
+                return method(*args)
+            finally:
+                stream.flush()
+    return request
+
+
+def pace(client, buckets, stats=None, scheduler=None):
+    """ Routes the requests of a connected EClientSocket through a PacedStream.
+
+    @param client connected EClientSocket (or subclass) instance
+    @param buckets TokenBuckets every message takes a token from
+    @param stats PacingStats to record to, or None
+    @param scheduler Scheduler for queued messages; default is defaultScheduler
+    @return PacedStream instance
+    """
+    dos = client.m_dos
+    write = dos.writeBytes
+    stream = PacedStream(write, buckets, stats, client.close, scheduler)
+    client.m_dos = DataOutputStream(stream)
+    for name in requestMethods:
+        setattr(client, name, pacedRequest(getattr(client, name), stream))
+    return stream
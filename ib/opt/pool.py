@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# Runs listeners on worker threads instead of the thread reading TWS.
+#
+# A listener registered with a Dispatcher runs on the EReader thread
+# (or the transport loop), so a slow one delays every message behind
+# it.  Wrapped by DispatchPool.wrap, it is instead handed its messages
+# through a bounded queue on one of the pool's worker threads.  The
+# worker is picked by the message's tickerId, orderId, reqId or (for
+# errors) id, so the messages of one id are always handled in the
+# order they arrived;
+# messages without one all go to the same worker.  Messages of
+# different ids may be handled in any order, so a listener relying on
+# ie openOrderEnd following every openOrder needs a pool of one worker.
+#
+# Use:
+#    {{{
+#    pool = DispatchPool(workers=4)
+#    con.register(pool.wrap(my_callback), message.TickPrice, message.OrderStatus)
+#    ...
+#    print pool.toDict()
+#    print pool.render()
+#    }}}
+##
+from threading import Lock, Thread
+import time
+
+from ib.lib import maybeName, logger
+from ib.opt.dispatcher import MessageQueue
+from ib.opt.metrics import Histogram
+
+
+##
+# Message attributes identifying the request or order a message is for,
+# in the order they are looked for.  Errors carry theirs as id.
+orderingAttributes = ('tickerId', 'orderId', 'reqId', 'id')
+
+
+def orderingKey(message):
+    """ Returns the id whose messages must be handled in order.
+
+    @param message instance of Message
+    @return tickerId, orderId, reqId or id of message, or None
+    """
+    for attribute in orderingAttributes:
+        value = getattr(message, attribute, None)
+        if value is not None:
+            return value
+    return None
+
+
+class ListenerStats(object):
+    """ Counts the calls of one listener, with their queueing delay and
+        how long the listener took, as totals and as histograms.
+
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = 0
+        self.errors = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+        self.totalTime = 0.0
+        self.maxTime = 0.0
+        self.waits = Histogram()
+        self.times = Histogram()
+
+    def record(self, wait, elapsed, error=False):
+        with self.lock:
+            self.calls += 1
+            self.errors += error
+            self.totalWait += wait
+            self.maxWait = max(self.maxWait, wait)
+            self.totalTime += elapsed
+            self.maxTime = max(self.maxTime, elapsed)
+            self.waits.observe(wait)
+            self.times.observe(elapsed)
+
+    def toDict(self):
+        with self.lock:
+            calls = self.calls or 1
+            return dict(calls=self.calls, errors=self.errors,
+                        meanWaitMs=round(self.totalWait / calls * 1e3, 3), maxWaitMs=round(self.maxWait * 1e3, 3),
+                        meanTimeMs=round(self.totalTime / calls * 1e3, 3), maxTimeMs=round(self.maxTime * 1e3, 3))
+
+
+class PooledListener(object):
+    """ Listener which queues its messages for a DispatchPool worker.
+        Equal to any other wrapping the same listener in the same pool,
+        so that pool.wrap(listener) can also be unregistered.
+
+    """
+    def __init__(self, pool, listener, stats):
+        self.pool = pool
+        self.listener = listener
+        self.stats = stats
+
+    def __call__(self, message):
+        self.pool.submit(self, message)
+
+    def __eq__(self, other):
+        return (isinstance(other, PooledListener) and
+                other.pool is self.pool and other.listener == self.listener)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.listener)
+
+    def handle(self, message, queued):
+        """ Calls the listener on a worker thread.
+
+        """
+        start = time.time()
+        error = False
+        try:
+            self.listener(message)
+        except (Exception, ):
+            error = True
+            errmsg = ("Exception in pooled dispatch.  "
+                      "Handler '%s' for '%s'")
+            self.pool.logger.exception(errmsg, maybeName(self.listener), message.typeName)
+        self.stats.record(start - queued, time.time() - start, error)
+
+
+class DispatchPool(object):
+    """ Worker threads, each with a bounded queue, running wrapped
+        listeners.
+
+    """
+    def __init__(self, workers=4, maxsize=10000, name='Dispatch'):
+        """ Initializer.
+
+        @param workers number of worker threads
+        @param maxsize most messages queued per worker; the reading thread
+               waits for room beyond that, so memory stays bounded
+        @param name name prefix of the worker threads
+        """
+        self.name = name
+        self.queues = [MessageQueue(maxsize, MessageQueue.block) for _ in xrange(max(1, workers))]
+        self.threads = []
+        self.listeners = {}
+        self.lock = Lock()
+        self.logger = logger.logger()
+
+    def wrap(self, listener):
+        """ Returns a listener running listener on this pool.
+
+        @param listener callable to receive messages
+        @return PooledListener instance to register instead of listener
+        """
+        with self.lock:
+            stats = self.listeners.setdefault(maybeName(listener), ListenerStats())
+        return PooledListener(self, listener, stats)
+
+    def submit(self, pooled, message):
+        """ Queues message for pooled on the worker for its ordering key.
+
+        @param pooled PooledListener instance
+        @param message instance of Message
+        @return None
+        """
+        if not self.threads:
+            self.start()
+        queues = self.queues
+        queue = queues[hash(orderingKey(message)) % len(queues)]
+        queue.put((pooled, message, time.time()))
+
+    def start(self):
+        """ Starts the worker threads, if not yet running.
+
+        @return self
+        """
+        with self.lock:
+            if not self.threads:
+                for i, queue in enumerate(self.queues):
+                    thread = Thread(target=self.run, args=(queue, ), name='%s-%d' % (self.name, i))
+                    thread.setDaemon(True)
+                    thread.start()
+                    self.threads.append(thread)
+        return self
+
+    def run(self, queue):
+        while True:
+            batch = queue.get()
+            if not batch:
+                break
+            for pooled, message, queued in batch:
+                pooled.handle(message, queued)
+
+    def close(self):
+        """ Lets the workers finish the queued messages, then stop.
+            Messages submitted after are discarded.
+
+        @return None
+        """
+        for queue in self.queues:
+            queue.close()
+
+    def join(self, timeout=None):
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def toDict(self):
+        with self.lock:
+            listeners = dict(self.listeners)
+        workers = [queue.toDict() for queue in self.queues]
+        return dict(workers=[dict(queued=w['queued'], highWater=w['highWater']) for w in workers],
+                    listeners=dict((name, stats.toDict()) for name, stats in listeners.items()))
+
+    def render(self):
+        """ Formats the queue depth of each worker, and the queueing delay,
+            time and errors of each listener, in the Prometheus text
+            exposition format (see ib.opt.metrics).
+
+        @return string
+        """
+        with self.lock:
+            listeners = sorted(self.listeners.items())
+        workers = [queue.toDict() for queue in self.queues]
+        pool = 'pool="%s"' % self.name
+        lines = [
+            '# HELP ib_pool_queue_depth Messages queued for each dispatch pool worker.',
+            '# TYPE ib_pool_queue_depth gauge',
+        ]
+        lines.extend('ib_pool_queue_depth{%s,worker="%d"} %d' % (pool, i, w['queued'])
+                     for i, w in enumerate(workers))
+        lines.extend([
+            '# HELP ib_pool_queue_high_water Most messages ever queued for each dispatch pool worker.',
+            '# TYPE ib_pool_queue_high_water gauge',
+        ])
+        lines.extend('ib_pool_queue_high_water{%s,worker="%d"} %d' % (pool, i, w['highWater'])
+                     for i, w in enumerate(workers))
+        lines.extend([
+            '# HELP ib_pool_listener_errors_total Exceptions raised by each pooled listener.',
+            '# TYPE ib_pool_listener_errors_total counter',
+        ])
+        lines.extend('ib_pool_listener_errors_total{%s,listener="%s"} %d' % (pool, name, stats.errors)
+                     for name, stats in listeners)
+        for metric, help, attribute in (
+                ('ib_pool_wait_seconds', 'Time messages waited in the queue for each pooled listener.', 'waits'),
+                ('ib_pool_listener_seconds', 'Time in each pooled listener.', 'times')):
+            lines.extend(['# HELP %s %s' % (metric, help), '# TYPE %s histogram' % metric])
+            for name, stats in listeners:
+                with stats.lock:
+                    lines.extend(getattr(stats, attribute).lines(metric, '%s,listener="%s"' % (pool, name)))
+        return str.join('\n', lines) + '\n'
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# Wire-protocol recording and replay, for benchmarking without TWS.
+#
+# A recording is the raw byte stream of one client session, split into
+# the chunks actually read from or written to the socket, each with
+# the time it happened relative to the start of the session.
+#
+# Recording in-process:
+#
+#    {{{
+#    recorder = Recorder('session.ibrec')
+#    con = ibConnection(port=4001, clientId=1)
+#    con.sender.connect(con.host, con.port, con.clientId, con.receiver,
+#                       clientType=recordingClientType(recorder))
+#    ...
+#    con.disconnect()
+#    }}}
+#
+# Recording any client (IBREST included) by proxying it to TWS:
+#
+#    python -m ib.opt.replay record session.ibrec 4002 127.0.0.1 4001
+#
+# Replaying to any client, ten times faster than it was recorded:
+#
+#    python -m ib.opt.replay serve session.ibrec 4001 --speed 10
+##
+from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SHUT_RDWR, error as SocketError
+from struct import Struct
+from threading import Thread, Lock, Event
+import time
+
+from ib.lib import Socket, logger
+from ib.opt.encoder import EncodingClientSocket
+
+
+MAGIC = 'IBREC1\n'
+
+##
+# Record header: seconds since session start, direction, chunk length.
+header = Struct('!dcI')
+
+##
+# Directions, as seen from the client.
+INBOUND = 'i'
+OUTBOUND = 'o'
+
+
+class Recorder(object):
+    """ Appends timestamped chunks to a recording file.
+
+    Safe to share between the reader thread and request threads.
+    """
+    def __init__(self, path):
+        """ Initializer.
+
+        @param path file name of recording to create
+        """
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.lock = Lock()
+        self.start = None
+
+    def record(self, direction, data):
+        """ Append one chunk.
+
+        @param direction INBOUND or OUTBOUND
+        @param data bytes read or written
+        @return None
+        """
+        if not data:
+            return
+        now = time.time()
+        with self.lock:
+            if self.file is None:
+                return
+            if self.start is None:
+                self.start = now
+            self.file.write(header.pack(now - self.start, direction, len(data)))
+            self.file.write(data)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def readRecording(path):
+    """ Iterate over the chunks of a recording.
+
+    @param path file name of recording
+    @return generator of (seconds, direction, data) tuples
+    """
+    with open(path, 'rb') as stream:
+        if stream.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a wire recording' % path)
+        while True:
+            head = stream.read(header.size)
+            if len(head) < header.size:
+                return
+            seconds, direction, length = header.unpack(head)
+            yield seconds, direction, stream.read(length)
+
+
+def inboundStream(path):
+    """ The concatenated bytes TWS sent in a recording.
+
+    @param path file name of recording
+    @return string
+    """
+    return ''.join(data for seconds, direction, data in readRecording(path) if direction == INBOUND)
+
+
+class RecordingTap(object):
+    """ Stream wrapper that records everything passing through it.
+
+    """
+    def __init__(self, sock, recorder):
+        self.sock = sock
+        self.recorder = recorder
+
+    def recv(self, size):
+        data = self.sock.recv(size)
+        self.recorder.record(INBOUND, data)
+        return data
+
+    def send(self, data):
+        sent = self.sock.send(data)
+        self.recorder.record(OUTBOUND, data[:sent])
+        return sent
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+        self.recorder.record(OUTBOUND, data)
+
+
+class RecordingSocket(Socket):
+    """ Socket whose input and output streams are recorded.
+
+    """
+    def __init__(self, host, port, recorder):
+        Socket.__init__(self, host, port)
+        self.tap = RecordingTap(self, recorder)
+        self.recorder = recorder
+
+    def getInputStream(self):
+        return self.tap
+
+    def getOutputStream(self):
+        return self.tap
+
+    def disconnect(self):
+        try:
+            Socket.disconnect(self)
+        finally:
+            self.recorder.close()
+
+
+def recordingClientType(recorder):
+    """ Creates a clientType for Sender.connect that records its session.
+
+    @param recorder Recorder instance to write to
+    @return callable taking the EWrapper handler
+    """
+    def create(handler):
+        client = EncodingClientSocket(handler)
+        def eConnect(host, port, clientId):
+            host = client.checkConnected(host)
+            if host is None:
+                return
+            try:
+                client.m_socket = RecordingSocket(host, port, recorder)
+                EncodingClientSocket.eConnect(client, client.m_socket, clientId)
+            except Exception:
+                client.eDisconnect()
+                client.connectionError()
+        client.eConnect = eConnect
+        return client
+    return create
+
+
+def pump(source, target, direction, recorder):
+    """ Copy one direction of a proxied connection, recording as we go.
+
+    """
+    try:
+        while True:
+            data = source.recv(8192)
+            if not data:
+                break
+            recorder.record(direction, data)
+            target.sendall(data)
+    except SocketError:
+        pass
+    for sock in (source, target):
+        try:
+            sock.shutdown(SHUT_RDWR)
+        except SocketError:
+            pass
+
+
+def recordingProxy(path, listenPort, twsHost, twsPort):
+    """ Accept one client on listenPort and proxy it to TWS, recording the session.
+
+    @return None once either side disconnects
+    """
+    listener = listen(listenPort)
+    client, address = listener.accept()
+    listener.close()
+    tws = socket(AF_INET, SOCK_STREAM)
+    tws.connect((twsHost, twsPort))
+    recorder = Recorder(path)
+    upstream = Thread(target=pump, args=(client, tws, OUTBOUND, recorder))
+    upstream.start()
+    pump(tws, client, INBOUND, recorder)
+    upstream.join()
+    recorder.close()
+
+
+def listen(port, host='127.0.0.1'):
+    listener = socket(AF_INET, SOCK_STREAM)
+    listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(8)
+    return listener
+
+
+def splitFields(buf):
+    """ Split complete NUL terminated fields off a buffer.
+
+    @return (list of fields, remaining partial field)
+    """
+    parts = buf.split('\0')
+    return parts[:-1], parts[-1]
+
+
+class FakeTWS(object):
+    """ Local stand-in for TWS that replays a recording to each client.
+
+    Every client connection gets the inbound side of the recording,
+    paced by its timestamps divided by speed (speed=0 sends it as fast
+    as possible).  Everything the client sends is split into fields
+    and kept in requests, and passed to onRequest if given.
+    """
+    def __init__(self, path=None, port=0, speed=1.0, onRequest=None, chunks=None):
+        """ Initializer.
+
+        @param path recording to replay, or None with chunks
+        @param port TCP port to listen on; 0 picks a free one
+        @param speed replay speed multiplier; 0 means no pacing
+        @param onRequest callable(connection, fields) for client traffic
+        @param chunks (seconds, data) inbound chunks to use instead of a file
+        """
+        if chunks is None:
+            chunks = [(s, d) for s, direction, d in readRecording(path) if direction == INBOUND]
+        self.chunks = chunks
+        self.speed = speed
+        self.onRequest = onRequest
+        self.requests = []
+        self.listener = listen(port)
+        self.port = self.listener.getsockname()[1]
+        self.stopped = Event()
+        self.logger = logger.logger()
+        self.thread = Thread(target=self.serve, name='FakeTWS')
+        self.thread.setDaemon(True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        try:
+            self.listener.close()
+        except SocketError:
+            pass
+
+    def serve(self):
+        while not self.stopped.is_set():
+            try:
+                conn, address = self.listener.accept()
+            except SocketError:
+                break
+            for target in (self.replay, self.readRequests):
+                thread = Thread(target=target, args=(conn, ))
+                thread.setDaemon(True)
+                thread.start()
+
+    def replay(self, conn):
+        """ Send the recording's inbound chunks to one client.
+
+        """
+        start = time.time()
+        try:
+            for seconds, data in self.chunks:
+                if self.speed:
+                    delay = start + seconds / self.speed - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                conn.sendall(data)
+        except SocketError:
+            self.logger.debug('FakeTWS client went away during replay')
+
+    def readRequests(self, conn):
+        """ Collect everything one client sends.
+
+        """
+        partial = ''
+        while not self.stopped.is_set():
+            try:
+                data = conn.recv(8192)
+            except SocketError:
+                break
+            if not data:
+                break
+            fields, partial = splitFields(partial + data)
+            if fields:
+                self.requests.append(fields)
+                if self.onRequest is not None:
+                    self.onRequest(conn, fields)
+
+
+def main(argv):
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog record FILE LISTEN_PORT TWS_HOST TWS_PORT\n'
+                                '       %prog serve FILE PORT [--speed N]')
+    parser.add_option('--speed', type='float', default=1.0, help='replay speed multiplier, 0 for no pacing')
+    options, args = parser.parse_args(argv)
+    if len(args) == 5 and args[0] == 'record':
+        recordingProxy(args[1], int(args[2]), args[3], int(args[4]))
+    elif len(args) == 3 and args[0] == 'serve':
+        server = FakeTWS(args[1], int(args[2]), options.speed).start()
+        try:
+            while server.thread.is_alive():
+                server.thread.join(1)
+        except KeyboardInterrupt:
+            server.stop()
+    else:
+        parser.error('unknown command')
+
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv[1:])
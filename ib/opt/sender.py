@@ -10,8 +10,8 @@
 ##
 from functools import wraps
 
-from ib.ext.EClientSocket import EClientSocket
 from ib.lib import toTypeName
+from ib.opt.encoder import EncodingClientSocket
 from ib.opt.message import registry, clientSocketMethods
 
 
@@ -30,14 +30,14 @@ class Sender(object):
         self.dispatcher = dispatcher
         self.clientMethodNames = [m[0] for m in clientSocketMethods]
 
-    def connect(self, host, port, clientId, handler, clientType=EClientSocket):
+    def connect(self, host, port, clientId, handler, clientType=EncodingClientSocket):
         """ Creates a TWS client socket and connects it.
 
         @param host name of host for connection; default is localhost
         @param port port number for connection; default is 7496
         @param clientId client identifier to send when connected
         @param handler object to receive reader messages
-        @keyparam clientType=EClientSocket callable producing socket client
+        @keyparam clientType=EncodingClientSocket callable producing socket client
         @return True if connected, False otherwise
         """
         def reconnect():
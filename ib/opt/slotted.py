@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# Slotted equivalents of the IbPy value types.
+#
+# ib.ext's Contract, Order (over a hundred fields), Execution and the
+# like keep their m_ fields in a per instance __dict__, and one of each
+# is made for every openOrder, position or execDetails message.  The
+# classes here have the same m_ attributes, defaults, constants and
+# methods, but keep their fields in __slots__.  Each takes all of its
+# fields positionally, in the order of the ext class' longest
+# constructor and then of its declarations (see fields), or by their m_
+# names.
+#
+# Once enabled, DecodingReader builds these instead of the ext classes,
+# in one positional call for the messages it parses itself.  Code using
+# them as it would the ext objects keeps working, save for what needs a
+# __dict__ (vars(), or isinstance checks against the ext classes).
+#
+# Use:
+#    {{{
+#    from ib.opt import slotted
+#    contract = slotted.Contract(8314, 'IBM', 'STK')
+#    slotted.enable()
+#    }}}
+##
+from copy import copy
+from types import FunctionType
+import inspect
+import re
+
+from ib.ext.ComboLeg import ComboLeg
+from ib.ext.CommissionReport import CommissionReport
+from ib.ext.Contract import Contract
+from ib.ext.ContractDetails import ContractDetails
+from ib.ext.Execution import Execution
+from ib.ext.Order import Order
+from ib.ext.OrderComboLeg import OrderComboLeg
+from ib.ext.OrderState import OrderState
+from ib.ext.TagValue import TagValue
+from ib.ext.UnderComp import UnderComp
+from ib.opt import decoder
+
+
+##
+# The ext classes given slotted equivalents, each after those its
+# defaults hold (ContractDetails' summary is a Contract).
+extTypes = (ComboLeg, OrderComboLeg, TagValue, UnderComp, Contract, ContractDetails, Order, OrderState, Execution,
+            CommissionReport)
+
+##
+# Matches the m_ field declarations in a generated class body.
+declarationPattern = re.compile(r'^    (m_\w+)\s*=', re.M)
+
+##
+# Matches the (mangled) names of the overloads of a generated __init__.
+overloadPattern = re.compile(r'^_\w+__init___\d+$')
+
+
+class NewValue(object):
+    """ Default of the fields getting a new list or object per instance.
+
+    """
+    def __repr__(self):
+        return 'NEW'
+
+
+NEW = NewValue()
+
+
+class Slotted(object):
+    """ Base of the slotted classes.
+
+    """
+    __slots__ = ()
+
+    ##
+    # Field names (with their m_ prefix) in constructor order.
+    fields = ()
+
+    ##
+    # Field defaults in constructor order, NEW for those whose default
+    # is a new list or object.
+    defaults = ()
+
+    def clone(self):
+        return copy(self)
+
+    def __getstate__(self):
+        return tuple([getattr(self, name) for name in self.fields])
+
+    def __setstate__(self, state):
+        for name, value in zip(self.fields, state):
+            setattr(self, name, value)
+
+
+def fieldNames(cls, instance):
+    """ Orders the m_ fields of an ext class: the arguments of its
+        longest constructor overload, then the remaining declarations,
+        then any field only its __init__ sets.
+
+    @param cls ext class
+    @param instance new instance of cls
+    @return list of field names
+    """
+    overloads = [inspect.getargspec(value).args[1:] for name, value in vars(cls).items()
+                 if overloadPattern.match(name)]
+    names = ['m_' + (arg[2:] if arg.startswith('p_') else arg) for arg in max(overloads or [[]], key=len)]
+    try:
+        declared = declarationPattern.findall(inspect.getsource(cls))
+    except (IOError, TypeError, ):
+        declared = sorted(name for name in vars(cls) if name.startswith('m_'))
+    for name in declared + sorted(vars(instance)):
+        if name.startswith('m_') and name not in names:
+            names.append(name)
+    return names
+
+
+def makeInit(names, factories):
+    """ Generates the __init__ of a slotted class.
+
+    @param names field names in constructor order
+    @param factories mapping of field name to the callable making its
+           value when the NEW default is passed
+    @return function
+    """
+    lines = ['def __init__(self, %s):' % str.join(', ', names)]
+    for name in names:
+        if name in factories:
+            lines.append('    self.%s = %s_new() if %s is NEW else %s' % (name, name, name, name))
+        else:
+            lines.append('    self.%s = %s' % (name, name))
+    namespace = dict(('%s_new' % name, factory) for name, factory in factories.items())
+    namespace['NEW'] = NEW
+    exec compile(str.join('\n', lines), '<slotted __init__>', 'exec') in namespace
+    return namespace['__init__']
+
+
+def makeSlotted(cls, made):
+    """ Builds the slotted equivalent of an ext class, without its
+        methods (see rebind).
+
+    @param cls ext class
+    @param made mapping of ext class to slotted class built so far
+    @return new class
+    """
+    instance = cls()
+    names = fieldNames(cls, instance)
+    defaults, factories = [], {}
+    for name in names:
+        default = getattr(instance, name)
+        if isinstance(default, list):
+            factories[name] = list
+            default = NEW
+        elif type(default) in made:
+            factories[name] = made[type(default)]
+            default = NEW
+        defaults.append(default)
+    namespace = dict((name, value) for name, value in vars(cls).items()
+                     if not (name.startswith('m_') or name.startswith('__') or callable(value)))
+    init = makeInit(names, factories)
+    init.func_defaults = tuple(defaults)
+    namespace.update(__slots__=tuple(names), fields=tuple(names), defaults=tuple(defaults), ext=cls,
+                     __init__=init, __module__=__name__, __doc__='Slotted equivalent of ib.ext.%s' % cls.__name__)
+    return type(cls.__name__, (Slotted, ), namespace)
+
+
+def rebind(cls, slottedCls, names):
+    """ Copies the methods of an ext class (but its constructors) to its
+        slotted equivalent, with the ext class names they use (ie in
+        isinstance and super calls) bound to the slotted classes.
+
+    @param cls ext class
+    @param slottedCls slotted class
+    @param names mapping of ext class name to slotted class
+    """
+    for name, value in vars(cls).items():
+        if isinstance(value, FunctionType) and name != '__init__' and not overloadPattern.match(name):
+            code = value.func_code
+            globs = dict(value.func_globals, **names)
+            setattr(slottedCls, name, FunctionType(code, globs, name, value.func_defaults, value.func_closure))
+
+
+def build():
+    """ Builds the slotted equivalents of all extTypes.
+
+    @return mapping of ext class name to slotted class
+    """
+    made = {}
+    for cls in extTypes:
+        made[cls] = makeSlotted(cls, made)
+    names = dict((cls.__name__, slottedCls) for cls, slottedCls in made.items())
+    for cls, slottedCls in made.items():
+        rebind(cls, slottedCls, names)
+    return names
+
+
+##
+# Slotted class by ext class name.
+types = build()
+
+ComboLeg = types['ComboLeg']
+OrderComboLeg = types['OrderComboLeg']
+TagValue = types['TagValue']
+UnderComp = types['UnderComp']
+Contract = types['Contract']
+ContractDetails = types['ContractDetails']
+Order = types['Order']
+OrderState = types['OrderState']
+Execution = types['Execution']
+CommissionReport = types['CommissionReport']
+
+
+def enable(on=True):
+    """ Makes DecodingReader build slotted objects, or ext objects again.
+        Best called before connecting, as readers already parsing
+        messages may finish those with the previous types.
+
+    @param on if True (default), builds slotted objects; otherwise ext
+    @return on
+    """
+    on = bool(on)
+    decoder.useTypes(types if on else dict((cls.__name__, cls) for cls in extTypes))
+    return on
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# Event loop transport: many TWS connections served by one thread.
+#
+# The stock client starts an EReader thread per connection which
+# blocks in recv() and decodes messages as it reads them, one field
+# at a time.  Here every connection is a non-blocking socket on one
+# shared asyncore loop instead:
+#
+#    - received data is split into fields as it arrives, and each
+#      message is decoded (with the DecodingReader tables) once all
+#      of its fields are buffered, so no thread ever waits mid-message;
+#    - requests are appended to an output buffer which the loop writes
+#      with one send() per wakeup, coalescing the many small writes
+#      EClientSocket makes per request.
+#
+# Message handlers run on the loop thread, so a slow handler delays
+# every connection on the loop.
+#
+# Use:
+#    {{{
+#    con = loopConnection('127.0.0.1', 4001, clientId=1)
+#    con.register(my_callback, message.TickPrice)
+#    con.connect()
+#    }}}
+#
+# or pass TransportSender(dispatcher) as the sender to Connection.create.
+##
+from copy import copy
+from functools import partial
+from threading import Event, Lock, Thread as PyThread
+import asyncore
+import fcntl
+import os
+import socket
+
+from ib.ext.EClientErrors import EClientErrors
+from ib.ext.EReader import EReader
+from ib.lib import DataOutputStream, Thread, logger
+from ib.opt.connection import Connection
+from ib.opt.decoder import DecodingReader
+from ib.opt.dispatcher import Dispatcher
+from ib.opt.encoder import EncodingClientSocket
+from ib.opt.sender import Sender
+
+
+class Incomplete(Exception):
+    """ Raised when the buffered fields end part way through a message.
+
+    """
+
+
+class DeferredWrapper(object):
+    """ Records EWrapper calls while a message is decoded, so that
+        messages which call the wrapper once per row (scanner and
+        historical data) do not call it at all until every row is in.
+        The decoder reuses one ContractDetails for every scanner row,
+        so each row's is copied as it is recorded.
+
+    """
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        return partial(self.record, name)
+
+    def record(self, name, *args):
+        self.calls.append((name, tuple([detach(arg) for arg in args])))
+
+
+def detach(value):
+    """ @return copy of value if it is a ContractDetails (with a copy of
+        its summary Contract), else value
+    """
+    if hasattr(value, 'm_summary'):
+        value = copy(value)
+        value.m_summary = copy(value.m_summary)
+    return value
+
+
+class Loop(object):
+    """ asyncore loop on a daemon thread, shared by all its connections.
+
+    """
+    def __init__(self, name='TransportLoop'):
+        self.map = {}
+        self.name = name
+        self.thread = None
+        self.lock = Lock()
+        self.logger = logger.logger()
+        self.wakeRead, self.wakeWrite = os.pipe()
+        # A full pipe already guarantees a wakeup, so writes must never block (on the loop thread least of all)
+        fcntl.fcntl(self.wakeWrite, fcntl.F_SETFL, os.O_NONBLOCK)
+        self.waker = asyncore.file_dispatcher(self.wakeRead, map=self.map)
+        self.waker.writable = lambda: False
+        self.waker.handle_read = self.drainWaker
+
+    def start(self):
+        """ Starts the loop thread, if not yet running.
+
+        @return self
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = PyThread(target=self.run, name=self.name)
+                self.thread.setDaemon(True)
+                self.thread.start()
+        return self
+
+    def run(self):
+        while True:
+            try:
+                asyncore.loop(30.0, use_poll=True, map=self.map, count=1)
+            except (Exception, ):
+                self.logger.exception('Exception in transport loop')
+
+    def wake(self):
+        """ Interrupts the poll, so that new sockets and output are seen.
+
+        """
+        try:
+            os.write(self.wakeWrite, 'x')
+        except (OSError, ):
+            pass
+
+    def drainWaker(self):
+        try:
+            self.waker.recv(4096)
+        except (socket.error, ):
+            pass
+
+
+defaultLoop = Loop()
+
+
+class Channel(asyncore.dispatcher):
+    """ One non-blocking TWS socket on a Loop.
+
+    Writes from any thread are buffered, and sent by the loop thread.
+    Channels also stand in for the Socket and output stream objects
+    EClientSocket expects.
+    """
+    def __init__(self, loop, reader):
+        asyncore.dispatcher.__init__(self, map=loop.map)
+        self.loop = loop
+        self.reader = reader
+        self.outgoing = []
+        self.outgoingLock = Lock()
+        self.closing = False
+
+    def open(self, host, port):
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connect((host, port))
+        self.loop.start().wake()
+
+    def queue(self, data):
+        """ Queues data to be sent by the loop.  Safe from any thread.
+
+        """
+        with self.outgoingLock:
+            idle = not self.outgoing
+            self.outgoing.append(data)
+        if idle:
+            self.loop.wake()
+
+    def disconnect(self):
+        """ Closes the socket once all queued output has been sent.
+
+        """
+        self.closing = True
+        self.loop.wake()
+
+    def writable(self):
+        return not self.connected or self.closing or bool(self.outgoing)
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        with self.outgoingLock:
+            data = str.join('', self.outgoing)
+            self.outgoing = []
+        if data:
+            sent = asyncore.dispatcher.send(self, data)
+            if sent < len(data):
+                with self.outgoingLock:
+                    self.outgoing.insert(0, data[sent:])
+                return
+        if self.closing and not self.outgoing:
+            self.handle_close()
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            self.reader.feed(data)
+
+    def handle_close(self):
+        self.close()
+        self.reader.closed()
+
+    def handle_error(self):
+        self.loop.logger.exception('Exception on TWS connection')
+        self.handle_close()
+
+
+class ChannelOutput(object):
+    """ Output stream for DataOutputStream which queues on a Channel.
+
+    """
+    def __init__(self, channel):
+        self.queue = channel.queue
+
+    def send(self, data):
+        self.queue(data)
+        return len(data)
+
+    def sendall(self, data):
+        self.queue(data)
+
+
+class TransportReader(DecodingReader):
+    """ DecodingReader fed by a Channel instead of reading on its own
+        thread.  It is never started.
+
+    """
+    def __init__(self, parent):
+        """ Initializer.
+
+        @param parent TransportClientSocket owning this reader
+        """
+        Thread.__init__(self, 'EReader', parent, None)
+        self.m_parent = parent
+        self.m_dis = None
+        self.fields = []
+        self.position = 0
+        self.partial = []
+        self.deferred = None
+        self.handshake = Event()
+
+    def readField(self):
+        """ Returns the next buffered field, or raises Incomplete.
+
+        """
+        position = self.position
+        if position == len(self.fields):
+            raise Incomplete()
+        self.position = position + 1
+        return self.fields[position]
+
+    def eWrapper(self):
+        if self.deferred is not None:
+            return self.deferred
+        return self.m_parent.wrapper()
+
+    def feed(self, data):
+        """ Buffers received data and decodes every complete message.
+
+        @param data string received from TWS
+        """
+        parts = data.split('\0')
+        if len(parts) == 1:
+            self.partial.append(data)
+            return
+        if self.partial:
+            self.partial.append(parts[0])
+            parts[0] = str.join('', self.partial)
+        rest = parts.pop()
+        self.partial = [rest] if rest else []
+        self.fields.extend(parts)
+        parent = self.m_parent
+        try:
+            while not self.handshake.isSet() or parent.isConnected():
+                start = self.position
+                try:
+                    if self.handshake.isSet():
+                        self.readMessage()
+                    else:
+                        self.readHandshake()
+                except (Incomplete, ):
+                    self.position = start
+                    break
+        except (Exception, ), ex:
+            if parent.isConnected():
+                parent.wrapper().error(ex)
+            self.closed()
+        del self.fields[:self.position]
+        self.position = 0
+
+    def readHandshake(self):
+        parent = self.m_parent
+        serverVersion = self.readInt()
+        twsTime = self.readStr() if serverVersion >= 20 else ''
+        parent.m_serverVersion, parent.m_TwsTime = serverVersion, twsTime
+        if serverVersion < parent.SERVER_VERSION:
+            parent.eDisconnect()
+            parent.m_anyWrapper.error(EClientErrors.NO_VALID_ID, EClientErrors.UPDATE_TWS.code(),
+                                      EClientErrors.UPDATE_TWS.msg())
+        else:
+            if serverVersion >= 3:
+                parent.send(parent.clientId)
+            parent.m_connected = True
+        self.handshake.set()
+
+    def readMessage(self):
+        msgId = self.readInt()
+        if msgId in (EReader.SCANNER_DATA, EReader.HISTORICAL_DATA):
+            self.deferred = DeferredWrapper()
+            try:
+                more = self.processMsg(msgId)
+            finally:
+                calls, self.deferred = self.deferred.calls, None
+            wrapper = self.m_parent.wrapper()
+            for name, args in calls:
+                getattr(wrapper, name)(*args)
+        else:
+            more = self.processMsg(msgId)
+        if not more:
+            self.closed()
+
+    def closed(self):
+        """ Called once the socket is gone, like the end of EReader.run.
+
+        """
+        self.handshake.set()
+        if self.m_parent.isConnected():
+            self.m_parent.close()
+
+
+class TransportClientSocket(EncodingClientSocket):
+    """ EncodingClientSocket connected through a Channel on a Loop.
+
+    """
+    connectTimeout = 10.0
+
+    def __init__(self, anyWrapper, loop=None):
+        EncodingClientSocket.__init__(self, anyWrapper)
+        self.loop = defaultLoop if loop is None else loop
+        self.clientId = None
+
+    def eConnect(self, host, port, clientId):
+        """ Same contract as EClientSocket.eConnect: returns once the
+            handshake with TWS has completed or failed.
+
+        """
+        host = self.checkConnected(host)
+        if host is None:
+            return
+        self.clientId = clientId
+        reader = self.m_reader = TransportReader(self)
+        channel = self.m_socket = Channel(self.loop, reader)
+        self.m_dos = DataOutputStream(ChannelOutput(channel))
+        try:
+            self.send(self.CLIENT_VERSION)
+            channel.open(host, port)
+        except (Exception, ):
+            self.eDisconnect()
+            self.connectionError()
+            return
+        if not reader.handshake.wait(self.connectTimeout) or not self.m_connected:
+            self.eDisconnect()
+            self.connectionError()
+
+
+class TransportSender(Sender):
+    """ Sender which connects with a TransportClientSocket.
+
+    """
+    def __init__(self, dispatcher, loop=None):
+        Sender.__init__(self, dispatcher)
+        self.loop = loop
+
+    def connect(self, host, port, clientId, handler, clientType=None):
+        if clientType is None:
+            clientType = partial(TransportClientSocket, loop=self.loop)
+        return Sender.connect(self, host, port, clientId, handler, clientType)
+
+
+def loopConnection(host='localhost', port=7496, clientId=0, loop=None):
+    """ Creates a Connection served by a Loop instead of reader threads.
+
+    @param loop Loop to use; default is the shared defaultLoop
+    @return Connection instance
+    """
+    dispatcher = Dispatcher()
+    return Connection.create(host, port, clientId, sender=TransportSender(dispatcher, loop), dispatcher=dispatcher)
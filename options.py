@@ -0,0 +1,122 @@
+""" Option chains for the /options endpoints.
+
+A chain is resolved with one reqContractDetails call, then cut down to the expiries and strikes nearest the money that
+fit in the market data line budget (IBREST_MARKET_DATA_LINES, 100 by default).  Each subscribed contract is given a fixed
+cell in a ChainGrid up front, so tickOptionComputation messages are written straight into preallocated strike x expiry
+rows as they arrive and the whole grid can be returned in one response.
+"""
+import os
+
+from ib.ext.TickType import TickType
+from ib.lib import Double
+
+# ---------------------------------------------------------------------
+# GLOBAL PARAMETERS
+# ---------------------------------------------------------------------
+# Configuration
+_line_budget = int(os.getenv('IBREST_MARKET_DATA_LINES', '100'))
+
+# tickOptionComputation values, in EWrapper argument order
+GREEKS = ('impliedVol', 'delta', 'optPrice', 'pvDividend', 'gamma', 'vega', 'theta', 'undPrice')
+RIGHTS = {'C': 'calls', 'P': 'puts'}
+# Model computations are preferred; bid/ask/last computations only fill cells the model has not
+OPTION_TICKS = (TickType.MODEL_OPTION, TickType.LAST_OPTION, TickType.BID_OPTION, TickType.ASK_OPTION)
+
+
+def _right(contract):
+    return contract.m_right[:1].upper()
+
+
+# ---------------------------------------------------------------------
+# STRIKE WINDOW
+# ---------------------------------------------------------------------
+def select_window(details, price, expiries=None, max_expiries=None, budget=None):
+    """ Picks the option contracts to subscribe to.
+
+    :param details: ContractDetails of the whole chain, from reqContractDetails
+    :param price: underlying price; strikes closest to it are kept
+    :param expiries: expiries to include, or None for the nearest ones
+    :param max_expiries: when expiries is None, how many of the nearest expiries to include
+    :param budget: market data lines available, one per contract
+    :return: list of Contracts, at most budget long
+    """
+    budget = _line_budget - 1 if budget is None else budget  # one line goes to the underlying
+    by_expiry = dict()
+    for d in details:
+        c = d.m_summary
+        if _right(c) in RIGHTS:
+            by_expiry.setdefault(c.m_expiry, []).append(c)
+    chosen = sorted(e for e in by_expiry if expiries is None or e in expiries)
+    if expiries is None and max_expiries:
+        chosen = chosen[:max_expiries]
+    # A call and a put per strike per expiry; drop far expiries until at least one strike fits
+    while chosen and budget // (2 * len(chosen)) == 0:
+        chosen.pop()
+    if not chosen:
+        return []
+    per_expiry = budget // (2 * len(chosen))
+    contracts = []
+    for expiry in chosen:
+        strikes = sorted(set(c.m_strike for c in by_expiry[expiry]), key=lambda k: (abs(k - price), k))[:per_expiry]
+        seen = set()
+        for c in by_expiry[expiry]:
+            key = (c.m_strike, _right(c))
+            if c.m_strike in strikes and key not in seen:
+                seen.add(key)
+                contracts.append(c)
+    return contracts
+
+
+# ---------------------------------------------------------------------
+# GRID
+# ---------------------------------------------------------------------
+class ChainGrid(object):
+    """ Greeks for a set of option contracts, as expiry x strike rows of each tickOptionComputation value per right
+    """
+
+    def __init__(self, contracts):
+        self.expiries = sorted(set(c.m_expiry for c in contracts))
+        self.strikes = sorted(set(c.m_strike for c in contracts))
+        expiry_index = {e: i for i, e in enumerate(self.expiries)}
+        strike_index = {k: j for j, k in enumerate(self.strikes)}
+        shape = len(self.expiries), len(self.strikes)
+        self.values = {side: {g: [[None] * shape[1] for _ in xrange(shape[0])] for g in GREEKS + ('field',)}
+                       for side in RIGHTS.itervalues()}
+        self.conIds = {side: [[None] * shape[1] for _ in xrange(shape[0])] for side in RIGHTS.itervalues()}
+        self.cells = []
+        for c in contracts:
+            cell = RIGHTS[_right(c)], expiry_index[c.m_expiry], strike_index[c.m_strike]
+            self.conIds[cell[0]][cell[1]][cell[2]] = c.m_conId
+            self.cells.append(cell)
+        # Cells without a model computation yet; those with only a bid/ask/last one are counted too
+        self.missing = len(self.cells)
+
+    def update(self, cell, field, values):
+        """ Stores one tickOptionComputation in its cell.  The cell only stops counting as missing once the model
+        computation arrives.
+
+        :param cell: one of self.cells
+        :param field: tick type of the computation
+        :param values: tickOptionComputation values in GREEKS order
+        """
+        if field not in OPTION_TICKS:
+            return
+        side, i, j = cell
+        grid = self.values[side]
+        current = grid['field'][i][j]
+        if current is not None and OPTION_TICKS.index(current) < OPTION_TICKS.index(field):
+            return
+        if field == TickType.MODEL_OPTION and current != field:
+            self.missing -= 1
+        grid['field'][i][j] = field
+        for g, v in zip(GREEKS, values):
+            grid[g][i][j] = None if v == Double.MAX_VALUE else v
+
+    def complete(self):
+        return self.missing == 0
+
+    def to_dict(self):
+        resp = dict(expiries=self.expiries, strikes=self.strikes, missing=self.missing)
+        for side, grid in self.values.iteritems():
+            resp[side] = dict(grid, conId=self.conIds[side])
+        return resp
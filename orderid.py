@@ -0,0 +1,61 @@
+""" Order ID allocation shared by all pooled client connections.
+
+TWS only requires that each new orderId is larger than any previously used one, so gaps are harmless while duplicates
+are fatal.  IDs are handed out from an itertools.count, whose next() is atomic under the GIL, so allocation needs no
+lock.  Seeding from nextValidId only ever moves the counter forward, and ranges are refreshed in the background with
+reqIds() so that allocation never has to wait on TWS once the first nextValidId has arrived.
+"""
+from itertools import count, islice
+from threading import Lock
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class OrderIdAllocator(object):
+    """ Lock-free orderId allocator seeded from nextValidId messages
+    """
+
+    def __init__(self, block_size=100, low_water=20):
+        """
+        :param block_size: number of IDs we consider reserved after each nextValidId
+        :param low_water: when fewer than this many reserved IDs remain, a reqIds() refresh is sent
+        """
+        self.block_size = block_size
+        self.low_water = low_water
+        self._counter = count(0)
+        self._seed_lock = Lock()  # only taken by seed(), never on the allocation path
+        self._ceiling = 0
+        self._refreshing = False
+
+    def seed(self, order_id):
+        """ Move the counter forward to order_id (typically from a nextValidId message).  Never moves it backwards.
+        """
+        order_id = int(order_id)
+        with self._seed_lock:
+            current = next(self._counter)  # consumes one ID, which is a harmless gap
+            gap = order_id - current - 1
+            if gap > 0:
+                # islice runs in C without releasing the GIL, so the skip is atomic w.r.t. allocating threads
+                next(islice(self._counter, gap, gap), None)
+            self._ceiling = max(order_id, current + 1) + self.block_size
+            self._refreshing = False
+        log.debug('Seeded orderId allocator at {}'.format(order_id))
+
+    def next_id(self, client=None):
+        """ Hand out the next orderId.  If a connected client is given and our reserved range is running low, ask TWS
+        for a fresh nextValidId via reqIds() without waiting for the answer.
+        """
+        order_id = next(self._counter)
+        if client is not None and not self._refreshing and order_id >= self._ceiling - self.low_water:
+            self._refreshing = True
+            try:
+                client.reqIds(self.block_size)
+            except Exception:
+                self._refreshing = False
+                log.exception('Could not prefetch orderIds')
+        return order_id
+
+
+# Shared allocator used by sync
+allocator = OrderIdAllocator()
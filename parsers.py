@@ -44,3 +44,68 @@ contract_parser.add_argument('exchange', type=str, required=False, default='SMAR
 contract_parser.add_argument('currency', type=str, required=False, default='USD',
                              help='Currency used for order (ie USD, GBP))')
 contract_parser.add_argument('symbol', type=str, required=True, help='Stock ticker symbol to order')
+
+
+# ---------------------------------------------------------------------
+# SCANNER PARSER
+# ---------------------------------------------------------------------
+# Contains args used for ScannerSubscription objects:
+# https://www.interactivebrokers.com/en/software/api/apiguide/java/scannersubscription.htm
+scanner_parser = reqparse.RequestParser()
+scanner_parser.add_argument('scanCode', type=str, required=True, help='Scan to run (ie TOP_PERC_GAIN)')
+scanner_parser.add_argument('instrument', type=str, required=False, default='STK', help='Instrument type (ie STK, FUT)')
+scanner_parser.add_argument('locationCode', type=str, required=False, default='STK.US.MAJOR',
+                            help='Location to scan (ie STK.US.MAJOR)')
+scanner_parser.add_argument('numberOfRows', type=int, help='Maximum number of rows to return (TWS caps this at 50)')
+for arg in ['abovePrice', 'belowPrice', 'marketCapAbove', 'marketCapBelow', 'couponRateAbove', 'couponRateBelow']:
+    scanner_parser.add_argument(arg, type=float)
+for arg in ['aboveVolume', 'averageOptionVolumeAbove']:
+    scanner_parser.add_argument(arg, type=int)
+for arg in ['moodyRatingAbove', 'moodyRatingBelow', 'spRatingAbove', 'spRatingBelow', 'maturityDateAbove',
+            'maturityDateBelow', 'excludeConvertible', 'scannerSettingPairs', 'stockTypeFilter']:
+    scanner_parser.add_argument(arg, type=str)
+
+
+# ---------------------------------------------------------------------
+# FUNDAMENTALS PARSER
+# ---------------------------------------------------------------------
+# Query string args for GET /fundamentals, which identify the Contract and choose the response format
+fundamentals_parser = reqparse.RequestParser()
+fundamentals_parser.add_argument('secType', type=str, required=False, default='STK', help='Security Type',
+                                 location='args')
+fundamentals_parser.add_argument('exchange', type=str, required=False, default='SMART',
+                                 help='Exchange (ie NASDAQ, SMART)', location='args')
+fundamentals_parser.add_argument('currency', type=str, required=False, default='USD',
+                                 help='Currency of contract (ie USD, GBP)', location='args')
+fundamentals_parser.add_argument('conId', type=int, required=False, help='Contract ID, to skip the symbol lookup',
+                                 location='args')
+fundamentals_parser.add_argument('format', type=str, required=False, default='xml', choices=['xml', 'json'],
+                                 help='Return the report as IB XML or as JSON', location='args')
+
+
+# ---------------------------------------------------------------------
+# OPTION CHAIN PARSER
+# ---------------------------------------------------------------------
+# Query string args for GET /options/<underlying>/chain
+option_chain_parser = reqparse.RequestParser()
+option_chain_parser.add_argument('secType', type=str, required=False, default='OPT', choices=['OPT', 'FOP'],
+                                 help='Security Type of the options', location='args')
+option_chain_parser.add_argument('underlyingSecType', type=str, required=False, default='STK',
+                                 choices=['STK', 'IND', 'FUT'], help='Security Type of the underlying', location='args')
+option_chain_parser.add_argument('exchange', type=str, required=False, default='SMART',
+                                 help='Exchange (ie SMART, CBOE)', location='args')
+option_chain_parser.add_argument('currency', type=str, required=False, default='USD',
+                                 help='Currency of contract (ie USD, GBP)', location='args')
+option_chain_parser.add_argument('tradingClass', type=str, required=False, help='Trading class, to pick one of several',
+                                 location='args')
+option_chain_parser.add_argument('expiry', type=str, required=False,
+                                 help='Comma separated expiries (YYYYMMDD) to include', location='args')
+option_chain_parser.add_argument('expiries', type=int, required=False, default=2,
+                                 help='Number of nearest expiries to include when expiry is not given', location='args')
+option_chain_parser.add_argument('price', type=float, required=False,
+                                 help='Underlying price to center strikes on; requested from TWS if not given',
+                                 location='args')
+option_chain_parser.add_argument('lines', type=int, required=False,
+                                 help='Market data lines to use, up to IBREST_MARKET_DATA_LINES', location='args')
+option_chain_parser.add_argument('timeout', type=float, required=False, default=5,
+                                 help='Seconds to wait for greeks before returning what has arrived', location='args')
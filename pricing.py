@@ -0,0 +1,288 @@
+""" Local option pricing for POST /options/compute.
+
+EClientSocket.calculateImpliedVolatility and calculateOptionPrice cost a TWS round trip per option and count against
+pacing, so prices, implied volatilities and greeks are computed here instead: Black-Scholes for options on stock and
+Black-76 for options on futures, both as the generalized Black-Scholes-Merton model with cost of carry b (b = r - q for
+stock, b = 0 for futures).  Implied volatility is solved with Newton's method, falling back to bisection whenever a
+Newton step would leave the bracket, so every contract converges.
+
+With NumPy installed a whole request is computed as arrays in one pass.  Without it the same code runs per contract on
+floats, which is much slower but gives the same results.  Greeks follow TWS conventions so they can be compared with
+tickOptionComputation: vega is per volatility point and theta per calendar day.
+"""
+from datetime import datetime
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from ib.ext.TickType import TickType
+from ib.lib import Double
+
+DAYS_PER_YEAR = 365.0
+MIN_VOL = 1e-4
+MAX_VOL = 5.0
+MIN_TIME = 1 / (DAYS_PER_YEAR * 24 * 60)
+TOLERANCE = 1e-8
+MAX_ITERATIONS = 100
+MODELS = ('bs', 'black76')
+# Output names match tickOptionComputation
+OUTPUTS = ('impliedVol', 'delta', 'optPrice', 'gamma', 'vega', 'theta', 'undPrice')
+
+
+# ---------------------------------------------------------------------
+# MATH BACKENDS
+# ---------------------------------------------------------------------
+def _ncdf(x, exp, absolute, where):
+    """ Standard normal CDF to double precision (Hart's algorithm, as given by West), written once for floats and
+    arrays
+    """
+    z = absolute(x)
+    e = exp(-0.5 * z * z)
+    n = ((((((0.0352624965998911 * z + 0.700383064443688) * z + 6.37396220353165) * z + 33.912866078383) * z +
+           112.079291497871) * z + 221.213596169931) * z + 220.206867912376)
+    d = (((((((0.0883883476483184 * z + 1.75566716318264) * z + 16.064177579207) * z + 86.7807322029461) * z +
+            296.564248779674) * z + 637.333633378831) * z + 793.826512519948) * z + 440.413735824752)
+    tail = e / (z + 1 / (z + 2 / (z + 3 / (z + 4 / (z + 0.65))))) / 2.506628274631
+    c = where(z < 7.07106781186547, e * n / d, tail)
+    return where(x > 0, 1 - c, c)
+
+
+class _FloatOps(object):
+    """ Operations on single floats
+    """
+    exp = staticmethod(math.exp)
+    log = staticmethod(math.log)
+    sqrt = staticmethod(math.sqrt)
+
+    @staticmethod
+    def where(condition, a, b):
+        return a if condition else b
+
+    @staticmethod
+    def all(condition):
+        return condition
+
+    any = all
+
+    @staticmethod
+    def ncdf(x):
+        return _ncdf(x, math.exp, abs, _FloatOps.where)
+
+
+class _ArrayOps(object):
+    """ Operations on NumPy arrays
+    """
+    if numpy is not None:
+        exp = staticmethod(numpy.exp)
+        log = staticmethod(numpy.log)
+        sqrt = staticmethod(numpy.sqrt)
+        where = staticmethod(numpy.where)
+        all = staticmethod(numpy.all)
+        any = staticmethod(numpy.any)
+
+    @staticmethod
+    def ncdf(x):
+        return _ncdf(x, numpy.exp, numpy.abs, numpy.where)
+
+
+def _npdf(ops, x):
+    return ops.exp(-0.5 * x * x) / math.sqrt(2 * math.pi)
+
+
+# ---------------------------------------------------------------------
+# MODEL
+# ---------------------------------------------------------------------
+def _price(ops, S, K, T, r, b, sigma, call):
+    """ Price and vega (per unit of volatility) under generalized Black-Scholes-Merton
+    """
+    sqrt_t = ops.sqrt(T)
+    d1 = (ops.log(S / K) + (b + 0.5 * sigma * sigma) * T) / (sigma * sqrt_t)
+    d2 = d1 - sigma * sqrt_t
+    carry = ops.exp((b - r) * T)
+    disc = ops.exp(-r * T)
+    price = ops.where(call, S * carry * ops.ncdf(d1) - K * disc * ops.ncdf(d2),
+                      K * disc * ops.ncdf(-d2) - S * carry * ops.ncdf(-d1))
+    return price, S * carry * _npdf(ops, d1) * sqrt_t
+
+
+def _greeks(ops, S, K, T, r, b, sigma, call):
+    """ :return: price, delta, gamma, vega and theta, the last two in TWS units
+    """
+    sqrt_t = ops.sqrt(T)
+    d1 = (ops.log(S / K) + (b + 0.5 * sigma * sigma) * T) / (sigma * sqrt_t)
+    d2 = d1 - sigma * sqrt_t
+    carry = ops.exp((b - r) * T)
+    disc = ops.exp(-r * T)
+    n1, N1, N2 = _npdf(ops, d1), ops.ncdf(d1), ops.ncdf(d2)
+    decay = -S * carry * n1 * sigma / (2 * sqrt_t)
+    price = ops.where(call, S * carry * N1 - K * disc * N2, K * disc * (1 - N2) - S * carry * (1 - N1))
+    delta = ops.where(call, carry * N1, carry * (N1 - 1))
+    gamma = carry * n1 / (S * sigma * sqrt_t)
+    vega = S * carry * n1 * sqrt_t / 100
+    theta = ops.where(call, decay - (b - r) * S * carry * N1 - r * K * disc * N2,
+                      decay + (b - r) * S * carry * (1 - N1) + r * K * disc * (1 - N2)) / DAYS_PER_YEAR
+    return price, delta, gamma, vega, theta
+
+
+def _implied_vol(ops, price, S, K, T, r, b, call):
+    """ Newton's method kept inside a shrinking [lo, hi] bracket, bisecting when a step would leave it
+    """
+    lo, hi = MIN_VOL + 0 * price, MAX_VOL + 0 * price
+    # Brenner-Subrahmanyam starting point, which is close for near-the-money options
+    sigma = price / S * math.sqrt(2 * math.pi) / ops.sqrt(T)
+    sigma = ops.where(sigma > MIN_VOL, ops.where(sigma < MAX_VOL, sigma, MAX_VOL), MIN_VOL)
+    for _ in xrange(MAX_ITERATIONS):
+        p, vega = _price(ops, S, K, T, r, b, sigma, call)
+        diff = p - price
+        if ops.all(abs(diff) < TOLERANCE):
+            break
+        hi = ops.where(diff > 0, sigma, hi)
+        lo = ops.where(diff < 0, sigma, lo)
+        step = sigma - diff / ops.where(vega > 1e-12, vega, 1.0)
+        sigma = ops.where((step <= lo) | (step >= hi) | (vega <= 1e-12), 0.5 * (lo + hi), step)
+    # Prices outside what any volatility can produce have no implied volatility
+    p_lo, _ = _price(ops, S, K, T, r, b, MIN_VOL + 0 * price, call)
+    p_hi, _ = _price(ops, S, K, T, r, b, MAX_VOL + 0 * price, call)
+    return ops.where((price < p_lo - TOLERANCE) | (price > p_hi + TOLERANCE), float('nan'), sigma)
+
+
+def _evaluate(ops, S, K, T, r, b, call, sigma, price):
+    """ One pass for either backend.  Where price is given (not nan) volatility is implied from it first.
+    """
+    solve = price == price
+    if ops.any(solve):
+        sigma = ops.where(solve, _implied_vol(ops, ops.where(solve, price, 1.0), S, K, T, r, b, call), sigma)
+    p, delta, gamma, vega, theta = _greeks(ops, S, K, T, r, b, sigma, call)
+    return sigma, delta, p, gamma, vega, theta, S
+
+
+# ---------------------------------------------------------------------
+# REQUESTS
+# ---------------------------------------------------------------------
+def years_to_expiry(expiry, now=None):
+    """ :param expiry: YYYYMMDD, taken as the end of that day
+    :return: time to expiry in years (ACT/365)
+    """
+    now = now or datetime.now()
+    end = datetime.strptime(str(expiry)[:8], '%Y%m%d').replace(hour=23, minute=59, second=59)
+    return max((end - now).total_seconds(), 0) / (DAYS_PER_YEAR * 86400)
+
+
+def _column(data, name, n, default=None, convert=float):
+    value = data.get(name, default)
+    if value is None:
+        raise ValueError('{} is required'.format(name))
+    if isinstance(value, (list, tuple)):
+        if len(value) != n:
+            raise ValueError('{} has {} values, expected {}'.format(name, len(value), n))
+        return [default if v is None else convert(v) for v in value]
+    return [convert(value)] * n
+
+
+def prepare(data):
+    """ Validates a compute request and broadcasts scalar fields.  Every field but model may be a single value or a
+    list with one value per contract: right (C/P), strike, underPrice, time (years) or expiry (YYYYMMDD), rate,
+    dividendYield, and volatility or optionPrice (a null optionPrice falls back to that contract's volatility).
+    conId is passed through for requests which go to TWS.
+
+    :return: dict of equal length lists
+    """
+    lengths = set(len(v) for v in data.itervalues() if isinstance(v, (list, tuple)))
+    if len(lengths) > 1:
+        raise ValueError('All lists must be the same length')
+    n = lengths.pop() if lengths else 1
+    model = data.get('model', 'bs')
+    if model not in MODELS:
+        raise ValueError('model must be one of {}'.format(', '.join(MODELS)))
+    columns = dict(
+        call=_column(data, 'right', n, convert=lambda v: str(v)[:1].upper() == 'C'),
+        strike=_column(data, 'strike', n),
+        underPrice=_column(data, 'underPrice', n),
+        rate=_column(data, 'rate', n, 0.0),
+        dividendYield=_column(data, 'dividendYield', n, 0.0),
+    )
+    if 'time' in data:
+        columns['time'] = _column(data, 'time', n)
+    else:
+        columns['time'] = _column(data, 'expiry', n, convert=years_to_expiry)
+    if 'optionPrice' not in data and 'volatility' not in data:
+        raise ValueError('volatility or optionPrice is required')
+    columns['optionPrice'] = _column(data, 'optionPrice', n, float('nan'))
+    columns['volatility'] = _column(data, 'volatility', n, float('nan'))
+    columns['carry'] = [0.0] * n if model == 'black76' else [r - q for r, q in zip(columns['rate'],
+                                                                                   columns['dividendYield'])]
+    for name in ('strike', 'underPrice'):
+        if any(v <= 0 for v in columns[name]):
+            raise ValueError('{} must be positive'.format(name))
+    if any(v <= 0 for v, p in zip(columns['volatility'], columns['optionPrice']) if p != p):
+        raise ValueError('volatility must be positive where no optionPrice is given')
+    if 'conId' in data:
+        columns['conId'] = _column(data, 'conId', n, convert=int)
+    # Expired options are priced a minute before expiry, which is their intrinsic value to within rounding
+    columns['time'] = [max(t, MIN_TIME) for t in columns['time']]
+    return columns
+
+
+def evaluate(data, use_numpy=True):
+    """ Computes prices, implied volatilities and greeks for a compute request, see prepare
+
+    :param use_numpy: use NumPy arrays if NumPy is installed
+    :return: list of (name, values) pairs in OUTPUTS order, where values are the NumPy arrays computed, or lists without
+    NumPy, with NaN where there is no answer (ie a price below intrinsic value)
+    """
+    c = prepare(data)
+    args = [c[k] for k in ('underPrice', 'strike', 'time', 'rate', 'carry', 'call', 'volatility', 'optionPrice')]
+    if use_numpy and numpy is not None:
+        results = _evaluate(_ArrayOps, *[numpy.array(a) for a in args])
+    else:
+        results = zip(*[_evaluate(_FloatOps, *row) for row in zip(*args)]) or [[]] * len(OUTPUTS)
+    return zip(OUTPUTS, results)
+
+
+def compute(data, use_numpy=True):
+    """ Computes prices, implied volatilities and greeks for a compute request, see prepare
+
+    :param use_numpy: use NumPy arrays if NumPy is installed
+    :return: dict of OUTPUTS lists, with null where there is no answer (ie a price below intrinsic value)
+    """
+    columns = dict()
+    for name, values in evaluate(data, use_numpy):
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            values = values.tolist()
+        columns[name] = [None if (v != v or v in (float('inf'), float('-inf'))) else v for v in values]
+    return columns
+
+
+# ---------------------------------------------------------------------
+# TWS FALLBACK
+# ---------------------------------------------------------------------
+class TwsComputations(object):
+    """ Collects the tickOptionComputation answers to calculateImpliedVolatility/calculateOptionPrice, in the same
+    shape as compute() returns.  Cells are row numbers.
+    """
+    # tickOptionComputation argument order, see options.GREEKS
+    FIELDS = ('impliedVol', 'delta', 'optPrice', 'pvDividend', 'gamma', 'vega', 'theta', 'undPrice')
+
+    def __init__(self, n):
+        self.values = {name: [None] * n for name in OUTPUTS}
+        self.cells = range(n)
+        self.answered = set()
+        self.missing = n
+
+    def update(self, cell, field, values):
+        if field != TickType.CUST_OPTION_COMPUTATION:
+            return
+        self.answered.add(cell)
+        self.missing = len(self.cells) - len(self.answered)
+        for name, v in zip(self.FIELDS, values):
+            if name in self.values:
+                self.values[name][cell] = None if v == Double.MAX_VALUE else v
+
+    def complete(self):
+        return self.missing == 0
+
+    def to_dict(self):
+        return self.values
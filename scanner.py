@@ -0,0 +1,150 @@
+""" Market scanner support for the /scanner endpoints.
+
+TWS describes every scan it supports in the scannerParameters XML, which runs to megabytes.  It is requested once, parsed
+once into ScannerParameters, and kept for the life of the process so subscriptions can be validated and the available
+scans discovered without going back to TWS.
+
+Scan results are cached per normalized ScannerSubscription for IBREST_SCANNER_TTL seconds, so screens that re-run the
+same scan every few seconds share one TWS round trip.
+"""
+from threading import Lock
+from xml.etree import cElementTree as ElementTree
+import os
+import time
+
+from ib.ext.ScannerSubscription import ScannerSubscription
+
+# ---------------------------------------------------------------------
+# GLOBAL PARAMETERS
+# ---------------------------------------------------------------------
+# Configuration
+_ttl = float(os.getenv('IBREST_SCANNER_TTL', '60'))
+_max_cached = int(os.getenv('IBREST_SCANNER_CACHE_SIZE', '256'))
+
+# Fields which hold IB codes, compared case-insensitively
+_code_fields = {'m_instrument', 'm_locationCode', 'm_scanCode', 'm_stockTypeFilter'}
+# Fields which take decimals, although their ScannerSubscription defaults are the int MAX_VALUE
+_float_fields = {'m_abovePrice', 'm_belowPrice', 'm_marketCapAbove', 'm_marketCapBelow', 'm_couponRateAbove',
+                 'm_couponRateBelow'}
+_defaults = {k: v for k, v in vars(ScannerSubscription).iteritems() if k[:2] == 'm_'}
+
+# The parsed scannerParameters, once received
+parameters = None
+
+
+# ---------------------------------------------------------------------
+# SCANNER PARAMETERS
+# ---------------------------------------------------------------------
+class ScannerParameters(object):
+    """ Index over the scannerParameters XML: instruments, locations and scan codes, each keyed by their IB code
+    """
+
+    def __init__(self, xml):
+        root = ElementTree.fromstring(xml)
+        self.instruments = {}
+        for node in root.iterfind('InstrumentList/Instrument'):
+            self.instruments[node.findtext('type')] = dict(name=node.findtext('name'),
+                                                           secType=node.findtext('secType'))
+        self.locations = {}
+        for node in root.iter('Location'):
+            self.locations[node.findtext('locationCode')] = dict(displayName=node.findtext('displayName'),
+                                                                 instruments=_split(node.findtext('instruments')))
+        self.scan_codes = {}
+        for node in root.iterfind('ScanTypeList/ScanType'):
+            self.scan_codes[node.findtext('scanCode')] = dict(displayName=node.findtext('displayName'),
+                                                              instruments=_split(node.findtext('instruments')))
+
+    def validate(self, subscription):
+        """ Checks a subscription's codes against what TWS supports.
+
+        :return: error message, or None if TWS should accept the subscription
+        """
+        instrument = subscription.m_instrument
+        if instrument not in self.instruments:
+            return 'Unknown instrument {}'.format(instrument)
+        location = self.locations.get(subscription.m_locationCode)
+        if location is None:
+            return 'Unknown locationCode {}'.format(subscription.m_locationCode)
+        if location['instruments'] and instrument not in location['instruments']:
+            return 'locationCode {} does not support instrument {}'.format(subscription.m_locationCode, instrument)
+        scan = self.scan_codes.get(subscription.m_scanCode)
+        if scan is None:
+            return 'Unknown scanCode {}'.format(subscription.m_scanCode)
+        if scan['instruments'] and instrument not in scan['instruments']:
+            return 'scanCode {} does not support instrument {}'.format(subscription.m_scanCode, instrument)
+
+    def to_dict(self):
+        """ :return: JSON-serializable copy of the index
+        """
+        def listed(index):
+            return {k: dict(v, instruments=sorted(v['instruments'])) for k, v in index.iteritems()}
+        return dict(instruments=self.instruments, locations=listed(self.locations), scanCodes=listed(self.scan_codes))
+
+
+def _split(text):
+    return frozenset(t for t in (text or '').split(',') if t)
+
+
+# ---------------------------------------------------------------------
+# SUBSCRIPTIONS
+# ---------------------------------------------------------------------
+def create_subscription(args):
+    """ Builds a ScannerSubscription from request args, normalizing values so equivalent requests compare equal
+    """
+    subscription = ScannerSubscription()
+    for attr, default in _defaults.iteritems():
+        value = args.get(attr[2:])
+        if value is None:
+            continue
+        if isinstance(default, basestring):
+            value = str(value).strip()
+            if attr in _code_fields:
+                value = value.upper()
+        elif attr in _float_fields:
+            value = float(value)
+        else:
+            value = type(default)(value)
+        setattr(subscription, attr, value)
+    return subscription
+
+
+def subscription_key(subscription):
+    """ :return: hashable key of the fields which differ from ScannerSubscription defaults
+    """
+    return tuple(sorted((k, v) for k, v in vars(subscription).iteritems() if _defaults.get(k) != v))
+
+
+# ---------------------------------------------------------------------
+# RESULT CACHE
+# ---------------------------------------------------------------------
+class ResultCache(object):
+    """ Scan results keyed by subscription_key, each kept for ttl seconds
+    """
+
+    def __init__(self, ttl=_ttl, max_entries=_max_cached):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry[1]
+
+    def put(self, key, results):
+        now = time.time()
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                # Drop expired results first, then the oldest ones
+                for k in [k for k, e in self._entries.iteritems() if e[0] < now]:
+                    del self._entries[k]
+                excess = len(self._entries) - self.max_entries + 1
+                for k, e in sorted(self._entries.iteritems(), key=lambda i: i[1][0])[:max(excess, 0)]:
+                    del self._entries[k]
+            self._entries[key] = (now + self.ttl, results)
+
+
+results = ResultCache()
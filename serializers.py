@@ -0,0 +1,289 @@
+""" JSON, MessagePack and Arrow for IbPy objects and API responses.
+
+IbPy's Contract, Order, OrderState and the like hold every IB API field as an m_ prefixed attribute, most of them left
+at their defaults (Order alone has over a hundred, a third of them Double.MAX_VALUE for "unset").  Each class gets a
+Schema, built once from a fresh instance, listing its fields with their un-prefixed names and defaults.  to_dict reads
+an object's fields in one itemgetter call on its __dict__ (EReader assigns them all), or one attrgetter call for the
+__slots__ of ib.opt.slotted's equivalents, and keeps only those differing from their defaults (and from the MAX_VALUE
+standing for unset values), recursing into nested IbPy objects (ie ContractDetails' summary, or an Order's
+algoParams), so an open order comes out as the dozen fields TWS actually set, named as in the IB API documentation:
+
+    {"orderId": 7, "action": "BUY", "totalQuantity": 100, "orderType": "LMT", "lmtPrice": 101.5, ...}
+
+dumps renders responses with ujson when it is installed (and IBREST_JSON is not 'json'), falling back to the standard
+library for anything ujson can't encode.  With msgpack installed, packb renders the same data as MessagePack.  With
+pyarrow installed, arrow_stream renders tabular responses as an Arrow IPC stream of one table: Columns (whose NumPy
+arrays become Arrow columns without being copied), a dict of equal length lists, or the list of rows in a response
+such as positions, with nested dicts flattened into dotted column names (contract.symbol) and the response's other
+keys kept as JSON in the schema's metadata.
+"""
+from itertools import izip
+from operator import attrgetter, itemgetter
+import json
+import os
+import sys
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+from ib.ext.ComboLeg import ComboLeg
+from ib.ext.CommissionReport import CommissionReport
+from ib.ext.Contract import Contract
+from ib.ext.ContractDetails import ContractDetails
+from ib.ext.Execution import Execution
+from ib.ext.Order import Order
+from ib.ext.OrderComboLeg import OrderComboLeg
+from ib.ext.OrderState import OrderState
+from ib.ext.TagValue import TagValue
+from ib.ext.UnderComp import UnderComp
+from ib.lib import Double
+from ib.opt import slotted
+
+# ---------------------------------------------------------------------
+# GLOBAL PARAMETERS
+# ---------------------------------------------------------------------
+# Configuration
+# 'ujson' (the default, when installed) or 'json' for the standard library
+_backend = os.getenv('IBREST_JSON', 'ujson' if ujson is not None else 'json')
+
+# Values of unset numeric fields: IbPy's MAX_VALUE (Integer.MAX_VALUE is the same), and Java's Double.MAX_VALUE which
+# TWS sends itself, ie for an OrderState's commission before the order fills
+_unset = (Double.MAX_VALUE, sys.float_info.max)
+
+# Schemas keyed by IbPy class
+_schemas = dict()
+
+# Media types
+MSGPACK = 'application/msgpack'
+ARROW_STREAM = 'application/vnd.apache.arrow.stream'
+
+
+# ---------------------------------------------------------------------
+# SCHEMAS
+# ---------------------------------------------------------------------
+class Schema(object):
+    """ Fields of an IbPy class: their keys (attribute names without m_) and defaults, in attribute order, and the keys
+    of those which can hold other IbPy objects or lists of them
+    """
+
+    def __init__(self, cls):
+        instance = cls()
+        attributes = sorted(set(a for a in dir(cls) if a.startswith('m_')) |
+                            set(a for a in getattr(instance, '__dict__', ()) if a.startswith('m_')))
+        self.cls = cls
+        self.keys = tuple(a[2:] for a in attributes)
+        self.defaults = tuple(getattr(instance, a) for a in attributes)
+        self.nested = tuple(key for key, default in izip(self.keys, self.defaults)
+                            if default is None or isinstance(default, list) or type(default) in _schemas)
+        self.items = _getter(itemgetter, attributes)
+        self.attributes = _getter(attrgetter, attributes)
+
+    def to_dict(self, obj):
+        """ :return: dict of obj's fields which differ from their defaults and are set, keyed without the m_ prefix
+        """
+        try:
+            values = self.items(obj.__dict__)
+        except (AttributeError, KeyError):
+            # Fields left at their class' default, or no __dict__ at all
+            values = self.attributes(obj)
+        d = {key: value for key, default, value in izip(self.keys, self.defaults, values)
+             if value != default and value not in _unset}
+        for key in self.nested:
+            if key in d:
+                d[key] = encode(d[key])
+        return d
+
+
+def _getter(factory, names):
+    """ :return: factory(*names), returning a tuple even for one name
+    """
+    getter = factory(*names)
+    return getter if len(names) > 1 else lambda obj: (getter(obj), )
+
+
+def register(cls):
+    """ Builds the Schema of an IbPy class, so that to_dict and encode handle its instances
+
+    :return: Schema
+    """
+    schema = _schemas[cls] = Schema(cls)
+    return schema
+
+
+def to_dict(obj):
+    """ :return: dict of an IbPy object's set, non-default fields, keyed without the m_ prefix
+    """
+    return _schemas[type(obj)].to_dict(obj)
+
+
+def encode(value):
+    """ Converts IbPy objects, and lists of them, to dicts.  Anything else is returned as is.
+    """
+    schema = _schemas.get(type(value))
+    if schema is not None:
+        return schema.to_dict(value)
+    if isinstance(value, (list, tuple)):
+        return [encode(v) for v in value]
+    return value
+
+
+# Leaves first, so that the classes holding them see them as nested, and ib.opt.slotted's equivalents of each
+for _cls in (ComboLeg, OrderComboLeg, TagValue, UnderComp, Contract, ContractDetails, Order, OrderState, Execution,
+             CommissionReport):
+    register(_cls)
+for _cls in slotted.extTypes:
+    register(slotted.types[_cls.__name__])
+
+
+class Columns(object):
+    """ Equal length columns of a computation, as NumPy arrays or lists, keyed by name in order.  JSON and MessagePack
+    get them as lists, with null for NaN and infinities; Arrow gets the arrays themselves.
+    """
+
+    def __init__(self, columns):
+        """ :param columns: list of (name, values) pairs
+        """
+        self.columns = list(columns)
+
+    def to_dict(self):
+        d = dict()
+        for name, values in self.columns:
+            if numpy is not None and isinstance(values, numpy.ndarray):
+                values = values.tolist()
+            d[name] = [None if (v != v or v in (float('inf'), float('-inf'))) else v for v in values]
+        return d
+
+
+# ---------------------------------------------------------------------
+# JSON
+# ---------------------------------------------------------------------
+def _default(obj):
+    """ json.dumps and msgpack.packb hook for values they can't encode themselves
+    """
+    if type(obj) in _schemas:
+        return to_dict(obj)
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+
+def dumps(data, indent=None, sort_keys=False):
+    """ Renders data as JSON, with ujson if it is the backend and can encode data, else with the standard library, which
+    encodes any IbPy objects left in data with to_dict
+
+    :return: str
+    """
+    if isinstance(data, Columns):
+        data = data.to_dict()
+    if _backend == 'ujson':
+        try:
+            return ujson.dumps(data, escape_forward_slashes=False, indent=indent or 0, sort_keys=sort_keys)
+        except (TypeError, OverflowError):
+            # Objects ujson doesn't know, or NaN and infinite floats, which the standard library writes as NaN and
+            # Infinity
+            pass
+    return json.dumps(data, indent=indent, sort_keys=sort_keys, default=_default)
+
+
+# ---------------------------------------------------------------------
+# MESSAGEPACK
+# ---------------------------------------------------------------------
+def packb(data):
+    """ Renders data as MessagePack.  str is packed as a string rather than binary, as it is text throughout IbPy.
+
+    :return: str
+    """
+    return msgpack.packb(data, use_bin_type=False, default=_default)
+
+
+# ---------------------------------------------------------------------
+# ARROW
+# ---------------------------------------------------------------------
+def _array(values):
+    """ :return: pyarrow.Array of a column; NumPy arrays are not copied, and NaN (or None) becomes null
+    """
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return pyarrow.array(values, from_pandas=True)
+    values = [v.decode('utf-8', 'replace') if isinstance(v, str) else v for v in values]
+    try:
+        return pyarrow.array(values, from_pandas=True)
+    except (pyarrow.ArrowException, TypeError, ValueError):
+        # Mixed types, ie a value TWS sends as a number or a string
+        return pyarrow.array([None if v is None else unicode(v) for v in values], type=pyarrow.string())
+
+
+def _flatten(row, prefix=''):
+    """ :return: row with nested dicts merged in under dotted keys, ie {'contract.symbol': 'IBM'}
+    """
+    flat = dict()
+    for key, value in row.iteritems():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def _is_rows(value):
+    return isinstance(value, list) and all(isinstance(v, dict) for v in value)
+
+
+def _rows_table(rows):
+    rows = [_flatten(row) for row in rows]
+    names = sorted(set(name for row in rows for name in row))
+    return pyarrow.Table.from_arrays([_array([row.get(name) for row in rows]) for name in names], names=names)
+
+
+def table(data):
+    """ Lays data out as a table, see the module docstring
+
+    :return: pyarrow.Table, or None if data has no tabular shape (ie several lists of rows)
+    """
+    if isinstance(data, Columns):
+        return pyarrow.Table.from_arrays([_array(v) for _, v in data.columns], names=[n for n, _ in data.columns])
+    if _is_rows(data):
+        return _rows_table(data)
+    if not isinstance(data, dict):
+        return None
+    lists = sorted(k for k, v in data.iteritems() if isinstance(v, (list, tuple)))
+    rows = [k for k in lists if _is_rows(data[k])]
+    if lists and len(lists) == len(data) and len(set(len(data[k]) for k in lists)) == 1 and \
+            not any(data[k] for k in rows):
+        # Columns, ie TWS option computations
+        return pyarrow.Table.from_arrays([_array(data[name]) for name in lists], names=lists)
+    if len(rows) == 1:
+        metadata = dict((k, dumps(v)) for k, v in data.iteritems() if k != rows[0])
+        return _rows_table(data[rows[0]]).replace_schema_metadata(metadata)
+    if not lists:
+        # A single record, ie an error
+        return _rows_table([data])
+    return None
+
+
+def arrow_stream(data):
+    """ Renders data as an Arrow IPC stream
+
+    :return: str, or None if data has no tabular shape
+    """
+    t = table(data)
+    if t is None:
+        return None
+    sink = pyarrow.BufferOutputStream()
+    writer = pyarrow.RecordBatchStreamWriter(sink, t.schema)
+    writer.write_table(t)
+    writer.close()
+    return sink.getvalue().to_pybytes()
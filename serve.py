@@ -0,0 +1,308 @@
+#!/usr/bin/python
+""" Non-blocking HTTP front end for the IBREST API, as an alternative to app.py's Flask server:
+
+    python serve.py
+
+app.run() serves each request on its own thread, which then sits idle until TWS answers.  Here a single thread runs an
+asyncore event loop that accepts connections, parses requests and calls the same Flask-RESTful resources.  The coroutines
+in sync return Tasks on this thread (see tasks.py), so a request waiting on TWS holds only its socket and a Future; the
+message handlers complete the Future from the EReader thread and the response is written once the Task is done.  One
+process can so keep thousands of requests pending, limited by open files rather than threads.
+
+Connecting to TWS is still a blocking socket connect, made on the loop thread, which is quick for a local TWS.  Local
+work such as /options/compute also runs on the loop thread.
+"""
+from collections import deque
+from itertools import count
+from cStringIO import StringIO
+from urllib import unquote
+import asynchat
+import asyncore
+import fcntl
+import heapq
+import logging
+import os
+import socket
+import sys
+import time
+
+from flask import Response, g
+from flask_restful import unpack
+from werkzeug.exceptions import HTTPException
+from werkzeug.wrappers import BaseResponse
+# IBREST imports; sync has to be imported before app
+import sync
+import tasks
+from app import app, api, output_json
+
+# ---------------------------------------------------------------------
+# GLOBAL PARAMETERS
+# ---------------------------------------------------------------------
+# Configuration
+_host = os.getenv('IBREST_HOST', '127.0.0.1')
+_port = int(os.getenv('IBREST_PORT', '5000'))
+_backlog = int(os.getenv('IBREST_LISTEN_BACKLOG', '1024'))
+MAX_HEADER_SIZE = 64 * 1024
+
+log = logging.getLogger(__name__)
+
+
+# ---------------------------------------------------------------------
+# EVENT LOOP
+# ---------------------------------------------------------------------
+class Waker(asyncore.file_dispatcher):
+    """ Pipe which interrupts the loop's poll when callbacks are scheduled from other threads
+    """
+
+    def __init__(self, map):
+        read_fd, self._write_fd = os.pipe()
+        # Never block the loop thread on its own wakeup; a full pipe wakes it anyway
+        fcntl.fcntl(self._write_fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        asyncore.file_dispatcher.__init__(self, read_fd, map=map)
+        os.close(read_fd)  # file_dispatcher keeps a dup
+
+    def wake(self):
+        try:
+            os.write(self._write_fd, 'x')
+        except OSError:
+            pass  # pipe full, so the loop is waking anyway
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except socket.error:
+            pass
+
+
+class EventLoop(object):
+    """ asyncore loop with the call_soon_threadsafe and call_later that tasks.Task needs
+    """
+
+    def __init__(self):
+        self.map = dict()
+        self._ready = deque()
+        self._timers = []
+        self._sequence = count()
+        self._waker = Waker(self.map)
+
+    def call_soon_threadsafe(self, callback, *args):
+        self._ready.append((callback, args))
+        self._waker.wake()
+
+    def call_later(self, delay, callback, *args):
+        """ Only to be called on the loop thread
+        """
+        heapq.heappush(self._timers, (time.time() + delay, next(self._sequence), callback, args))
+
+    def run_forever(self):
+        tasks.set_loop(self)
+        while True:
+            if self._ready:
+                timeout = 0
+            elif self._timers:
+                timeout = max(0, self._timers[0][0] - time.time())
+            else:
+                timeout = 30.0
+            # poll() rather than select(), which cannot watch more than 1024 sockets
+            asyncore.loop(timeout, use_poll=True, map=self.map, count=1)
+            now = time.time()
+            while self._timers and self._timers[0][0] <= now:
+                self._ready.append(heapq.heappop(self._timers)[2:])
+            for _ in xrange(len(self._ready)):
+                callback, args = self._ready.popleft()
+                try:
+                    callback(*args)
+                except Exception:
+                    log.exception('Exception in event loop callback {}'.format(callback))
+
+
+# ---------------------------------------------------------------------
+# HTTP
+# ---------------------------------------------------------------------
+def pending(representation):
+    """ Wraps one of app's representations to let a resource return a Task: it is passed on to the server in an empty
+    Response, and rendered by representation once it is done
+    """
+    def output_pending(data, code, headers=None):
+        if isinstance(data, tasks.Future):
+            resp = Response(status=code)
+            resp.pending = data
+            return resp
+        return representation(data, code, headers)
+    output_pending.representation = representation
+    return output_pending
+
+
+class ResponseProducer(object):
+    """ asynchat producer over a WSGI response body, so streamed bodies are sent as the socket drains
+    """
+
+    def __init__(self, app_iter):
+        self.app_iter = app_iter
+        self.chunks = iter(app_iter)
+
+    def more(self):
+        for chunk in self.chunks:
+            if chunk:
+                return chunk
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+        return ''
+
+
+class HttpChannel(asynchat.async_chat):
+    """ One client connection: reads a request, hands it to the server and writes the response.  Responses close the
+    connection, so there is no keep-alive or pipelining to track.
+    """
+
+    def __init__(self, sock, address, server):
+        asynchat.async_chat.__init__(self, sock, map=server.loop.map)
+        self.server = server
+        self.address = address
+        self.environ = None
+        self.trace = None
+        self.incoming = []
+        self.received = 0
+        self.set_terminator('\r\n\r\n')
+
+    def collect_incoming_data(self, data):
+        self.received += len(data)
+        if self.environ is None and self.received > MAX_HEADER_SIZE:
+            self.send_error('431 Request Header Fields Too Large')
+            return
+        self.incoming.append(data)
+
+    def found_terminator(self):
+        data, self.incoming = ''.join(self.incoming), []
+        if self.environ is None:
+            try:
+                self.environ = self.server.make_environ(data, self.address)
+            except ValueError:
+                self.send_error('400 Bad Request')
+                return
+            length = int(self.environ.get('CONTENT_LENGTH') or 0)
+            if length > 0:
+                self.set_terminator(length)
+                return
+            data = ''
+        self.set_terminator(None)  # anything more from the client is ignored
+        self.environ['wsgi.input'] = StringIO(data)
+        self.server.handle_request(self)
+
+    def send_response(self, response):
+        app_iter, status, headers = response.get_wsgi_response(self.environ)
+        head = ['HTTP/1.1 {}'.format(status)]
+        head.extend('{}: {}'.format(k, v) for k, v in headers if k.lower() != 'connection')
+        head.extend(['Connection: close', '', ''])
+        self.push('\r\n'.join(head))
+        self.push_with_producer(ResponseProducer(app_iter))
+        self.close_when_done()
+
+    def send_error(self, status):
+        self.set_terminator(None)
+        self.push('HTTP/1.1 {}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'.format(status))
+        self.close_when_done()
+
+    def handle_error(self):
+        log.exception('Error on connection from {}'.format(self.address))
+        self.close()
+
+
+class HttpServer(asyncore.dispatcher):
+    """ Listening socket which serves app on an EventLoop
+    """
+
+    def __init__(self, host=_host, port=_port, loop=None):
+        self.loop = loop or EventLoop()
+        asyncore.dispatcher.__init__(self, map=self.loop.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(_backlog)
+        self.host, self.port = self.socket.getsockname()
+        for mediatype, representation in api.representations.items():
+            api.representations[mediatype] = pending(getattr(representation, 'representation', representation))
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            HttpChannel(pair[0], pair[1], self)
+
+    def make_environ(self, head, address):
+        lines = head.split('\r\n')
+        method, target, protocol = lines[0].split(' ', 2)
+        path, _, query = target.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': protocol,
+            'REMOTE_ADDR': address[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            name, value = name.strip().upper().replace('-', '_'), value.strip()
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[name] = value
+            else:
+                key = 'HTTP_' + name
+                environ[key] = environ[key] + ',' + value if key in environ else value
+        return environ
+
+    def handle_request(self, channel):
+        """ Dispatches to app on the loop thread.  A resource which returned a Task is answered once it completes.
+        """
+        try:
+            with app.request_context(channel.environ):
+                response = app.full_dispatch_request()
+                channel.trace = getattr(g, 'trace', None)
+        except Exception:
+            log.exception('Unhandled error serving {}'.format(channel.environ['PATH_INFO']))
+            channel.send_error('500 Internal Server Error')
+            return
+        future = getattr(response, 'pending', None)
+        if future is None:
+            channel.send_response(response)
+            return
+        future.add_done_callback(lambda f: self.loop.call_soon_threadsafe(self.finish_request, channel, f))
+
+    def finish_request(self, channel, future):
+        with app.request_context(channel.environ):
+            # The request's Trace, so its serialize phase and Server-Timing are recorded by app's handlers
+            g.trace = channel.trace
+            tasks.set_context(channel.trace)
+            try:
+                value = future.result()
+                if isinstance(value, BaseResponse):
+                    response = value
+                else:
+                    data, code, headers = unpack(value)
+                    response = api.make_response(data, code, headers=headers)
+            except HTTPException as e:
+                # As Flask-RESTful answers them when raised by a resource, ie a 503 from sync.get_client
+                response = api.handle_error(e)
+            except Exception:
+                log.exception('Unhandled error serving {}'.format(channel.environ['PATH_INFO']))
+                response = output_json({'message': 'Internal Server Error'}, 500)
+            response = app.process_response(response)
+        if channel.connected:
+            channel.send_response(response)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    server = HttpServer()
+    log.info('Serving IBREST on http://{}:{}/'.format(server.host, server.port))
+    server.loop.run_forever()
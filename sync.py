@@ -2,13 +2,32 @@
 This module contains all IB client handling, even if connection will be used for a feed
 """
 from ib.opt import ibConnection
+from ib.opt import metrics
+from ib.opt import slotted
+from ib.opt.contractkey import contractKey
+from ib.opt.conflator import Conflator
+from ib.opt.messagelog import MessageLog
+from ib.opt.pacer import pace
+from ib.opt.pool import DispatchPool
+from ib.opt.transport import loopConnection
 from ib.ext.Contract import Contract
 from ib.ext.Order import Order
-from ib.ext.OrderState import OrderState
+from ib.ext.TickType import TickType
 from flask import current_app
-import time
+from werkzeug.exceptions import ServiceUnavailable
+from functools import partial
+from itertools import count
 from app import app
 from feeds import market_handler
+from orderid import allocator
+import scanner
+import serializers
+import fundamentals
+import gateways
+import options
+import pricing
+import tasks
+import tracing
 import os
 
 __author__ = 'Jason Haury'
@@ -18,14 +37,25 @@ __author__ = 'Jason Haury'
 # GLOBAL PARAMETERS
 # ---------------------------------------------------------------------
 # Configuration
-# Use environment variables
-_ibgw_host = os.getenv('IBGW_HOST', '127.0.0.1')
-_ibgw_port = int(os.getenv('IBGW_PORT', '4001'))  # Use 7496 for TWS
+# Use environment variables; gateways and their clientId pools are configured in gateways.py
+# 'thread' for an EReader thread per connection, or 'loop' to serve all connections from one thread (ib/opt/transport.py)
+_transport = os.getenv('IBREST_TRANSPORT', 'thread')
+# Seconds between passing the latest ticks on to feed handlers, which have no use for every tick; 0 passes each one
+_conflate_interval = float(os.getenv('IBREST_CONFLATE_INTERVAL', '0.1'))
+# Debug logging of every message runs on its own thread rather than the one reading TWS; one worker keeps the log in order
+_debug_pool = DispatchPool(workers=1, name='DebugLog')
+# Record per message counts, bytes, decode and listener times for GET /metrics (ib/opt/metrics.py)
+metrics.enable(os.getenv('IBREST_MESSAGE_METRICS', '0') == '1')
+# Decode contracts, orders, executions and the like into __slots__ objects rather than ib.ext's (ib/opt/slotted.py)
+slotted.enable(os.getenv('IBREST_SLOTTED', '0') == '1')
+# Directory to log every message of every connection to in binary (ib/opt/messagelog.py), in segments of
+# IBREST_MESSAGE_LOG_SEGMENT_MB, keeping the newest IBREST_MESSAGE_LOG_SEGMENTS (0 keeps all).  Unset logs nothing.
+_message_log_dir = os.getenv('IBREST_MESSAGE_LOG')
+_message_log = MessageLog(_message_log_dir, int(os.getenv('IBREST_MESSAGE_LOG_SEGMENT_MB', '64')) << 20,
+                          int(os.getenv('IBREST_MESSAGE_LOG_SEGMENTS', '0'))) if _message_log_dir else None
 
 # Mutables
 _managedAccounts = []
-_clientId_pool = {0, 1, 2, 3, 4, 5, 6, 7}
-_orderId = 0
 
 # Responses.  Global dicts to use for our responses as updated by Message handlers, keyed by clientId
 _portfolio_positions_resp = {c: dict() for c in xrange(8)}
@@ -35,6 +65,26 @@ _error_resp = dict()
 _order_resp = dict(openOrderEnd=False, openOrder=[], orderStatus=[])
 # When placing/deleting orders, we care about what orderId is used.  Key off orderId.
 _order_resp_by_order = dict()
+# Gateway each order was placed on, keyed by orderId, so it is cancelled there too
+_order_gateways = dict()
+# Request ids (tickerIds/reqIds) for everything but orders.  These start well above any orderId since _error_resp is
+# keyed by both.  next() on a count is atomic, so no lock is needed.
+_request_ids = count(1 << 30)
+# Scanner results keyed by tickerId
+_scanner_resp = dict()
+# Contract details keyed by reqId
+_contract_details_resp = dict()
+# Fundamental data reports keyed by reqId
+_fundamentals_resp = dict()
+# Snapshot tickPrices keyed by tickerId, then tick type
+_snapshot_resp = dict()
+# Option chain subscriptions: tickerId -> (ChainGrid, cell)
+_option_cells = dict()
+# Futures waiting on a message, keyed like _error_resp by orderId/tickerId/reqId, or by message name for messages
+# without one (ie positionEnd).  Each is completed by the handler of the awaited message, or an error for its id.
+_pending = dict()
+# Futures waiting on each client connection, so that a disconnect wakes them
+_client_waits = dict()
 
 # Logging shortcut
 log = app.logger
@@ -43,16 +93,19 @@ log = app.logger
 # ---------------------------------------------------------------------
 # MESSAGE HANDLERS
 # ---------------------------------------------------------------------
-def connection_handler(msg):
-    """ Handles messages from when we connect to TWS
+def connection_handler(gateway, msg):
+    """ Handles messages from when we connect to TWS.  There is one orderId allocator for all gateways: seeding only
+    moves it forward, so once every gateway has seeded it, its IDs are valid on each of them.
     """
     if msg.typeName == 'nextValidId':
-        global _orderId
-        _orderId = int(msg.orderId)
-        log.info('Updated orderID: {}'.format(_orderId))
+        allocator.seed(msg.orderId)
+        gateway.seeded = True
+        resolve((gateway, 'nextValidId'))
+        log.info('Updated orderID: {}'.format(msg.orderId))
     elif msg.typeName == 'managedAccounts':
         global _managedAccounts
-        _managedAccounts = msg.accountsList.split(',')
+        gateway.accounts.update(filter(None, msg.accountsList.split(',')))
+        _managedAccounts = gateways.router.accounts()
         log.info('Updated managed accounts: {}'.format(_managedAccounts))
 
 
@@ -61,15 +114,12 @@ def portfolio_positions_handler(msg):
     """
 
     if msg.typeName == 'position':
-        position = dict()
-        for i in msg.items():
-            if isinstance(i[1], Contract):
-                position[i[0]] = i[1].__dict__
-            else:
-                position[i[0]] = i[1]
-        _portfolio_positions_resp['positions'].append(position.copy())
+        position = dict(msg.items())
+        position['contract'] = serializers.to_dict(msg.contract)
+        _portfolio_positions_resp['positions'].append(position)
     elif msg.typeName == 'positionEnd':
         _portfolio_positions_resp['positionEnd'] = True
+        resolve('positionEnd')
     log.debug('POSITION: {})'.format(msg))
 
 
@@ -78,16 +128,19 @@ def order_handler(msg):
     """
     global _order_resp, _order_resp_by_order
     if msg.typeName in ['orderStatus', 'openOrder']:
-        d = dict()
-        for i in msg.items():
-            if isinstance(i[1], (Contract, Order, OrderState)):
-                d[i[0]] = i[1].__dict__
-            else:
-                d[i[0]] = i[1]
-        _order_resp[msg.typeName].append(d.copy())
-        _order_resp_by_order.get(d['orderId'], dict(openOrder=[], orderStatus=[]))[msg.typeName].append(d.copy())
+        # Nothing changes d later, so both responses can share it
+        d = dict(msg.items())
+        if msg.typeName == 'openOrder':
+            d['contract'] = serializers.to_dict(msg.contract)
+            d['order'] = serializers.to_dict(msg.order)
+            d['orderState'] = serializers.to_dict(msg.orderState)
+        _order_resp[msg.typeName].append(d)
+        _order_resp_by_order.get(d['orderId'], dict(openOrder=[], orderStatus=[]))[msg.typeName].append(d)
+        if msg.typeName == 'orderStatus':
+            resolve(d['orderId'])
     elif msg.typeName == 'openOrderEnd':
         _order_resp['openOrderEnd'] = True
+        resolve('openOrderEnd')
     log.debug('ORDER: {})'.format(msg))
 
 
@@ -100,9 +153,79 @@ def error_handler(msg):
     """
     global _error_resp
     _error_resp[int(msg.id)] = {i[0]: i[1] for i in msg.items()}
+    resolve(int(msg.id))
     log.error('ERROR: {}'.format(msg))
 
 
+def scanner_handler(msg):
+    """ Index scanner parameters once they arrive, and collect scan results by tickerId
+    """
+    if msg.typeName == 'scannerParameters':
+        scanner.parameters = scanner.ScannerParameters(msg.xml)
+        resolve('scannerParameters')
+        log.info('Indexed scanner parameters: {} scan codes'.format(len(scanner.parameters.scan_codes)))
+    elif msg.typeName == 'scannerData':
+        # EReader reuses one ContractDetails for every row of a scan, so convert it now
+        row = {i[0]: i[1] for i in msg.items()}
+        row['contractDetails'] = serializers.to_dict(msg.contractDetails)
+        _scanner_resp.get(msg.reqId, dict(scannerData=[]))['scannerData'].append(row)
+    elif msg.typeName == 'scannerDataEnd':
+        _scanner_resp.get(msg.reqId, dict())['scannerDataEnd'] = True
+        resolve(msg.reqId)
+    log.debug('SCANNER: {})'.format(msg))
+
+
+def contract_details_handler(msg):
+    """ Collect contractDetails by reqId
+    """
+    if msg.typeName == 'contractDetails':
+        _contract_details_resp.get(msg.reqId, dict(contractDetails=[]))['contractDetails'].append(msg.contractDetails)
+    elif msg.typeName == 'contractDetailsEnd':
+        _contract_details_resp.get(msg.reqId, dict())['contractDetailsEnd'] = True
+        resolve(msg.reqId)
+    log.debug('CONTRACT DETAILS: {})'.format(msg))
+
+
+def fundamentals_handler(msg):
+    """ Keep fundamentalData reports by reqId
+    """
+    _fundamentals_resp[msg.reqId] = msg.data
+    resolve(msg.reqId)
+    log.debug('FUNDAMENTALS: {} bytes for reqId {})'.format(len(msg.data or ''), msg.reqId))
+
+
+def snapshot_handler(msg):
+    """ Collect tickPrice for snapshot market data requests by tickerId
+    """
+    if msg.typeName == 'tickPrice':
+        _snapshot_resp.get(msg.tickerId, dict())[msg.field] = msg.price
+    elif msg.typeName == 'tickSnapshotEnd':
+        _snapshot_resp.get(msg.reqId, dict())['tickSnapshotEnd'] = True
+        resolve(msg.reqId)
+
+
+def option_handler(msg):
+    """ Write tickOptionComputation values straight into their tickerId's cell of an option chain grid, or of the
+    results of a TWS option calculation
+    """
+    subscription = _option_cells.get(msg.tickerId)
+    if subscription is not None:
+        grid, cell = subscription
+        grid.update(cell, msg.field, [getattr(msg, g) for g in options.GREEKS])
+        if grid.complete():
+            resolve(grid)
+
+
+def disconnect_handler(client, msg):
+    """ Wake everything waiting on a client once its connection closes.  A leased client losing its connection counts
+    against its gateway's health.
+    """
+    if client.leased:
+        client.gateway.record_failure('Connection closed')
+    for future in _client_waits.get(client, ()):
+        future.set_result()
+
+
 def generic_handler(msg):
     log.debug('MESSAGE: {}, {})'.format(msg, msg.keys))
 
@@ -110,77 +233,189 @@ def generic_handler(msg):
 # ---------------------------------------------------------------------
 # SHARED FUNCTIONS
 # ---------------------------------------------------------------------
-def get_client(client_id=None):
-    """ Creates a client connection to be used with orders
+def expect(client, key, timeout=None):
+    """ Creates a Future to wait on a message with.  Call this before sending the request, so that the answer cannot
+    arrive before anything is waiting for it.
+
+    :param key: orderId/tickerId/reqId of the request, or message name, as passed to resolve() by its handler.  An
+    error message for the id completes the Future too.
+    :param timeout: seconds to wait at most
+    :return: Future completed by the message, an error for key, the client disconnecting or the timeout; already
+    completed if the client is not connected, since no message will come then
     """
-    if client_id is None:
-        # Get client ID from our pool list in memory
-        while len(_clientId_pool) == 0:
-            time.sleep(0.5)
-        try:
-            client_id = _clientId_pool.pop()
-        except KeyError:
-            client_id = None
-    if client_id is None:
-        return
-    log.info('Attempting connection with client_id {}'.format(client_id))
-    client = ibConnection(_ibgw_host, _ibgw_port, client_id)
+    future = tasks.Future(timeout, phase='tws')
+    future.key = key
+    if not client.isConnected():
+        future.set_result()
+        return future
+    _pending.setdefault(key, []).append(future)
+    _client_waits.setdefault(client, []).append(future)
+    return future
+
+
+def resolve(key):
+    """ Completes the Futures waiting on key.  Called by message handlers, on the EReader thread.
+    """
+    for future in _pending.pop(key, ()):
+        future.set_result()
+
+
+def debug_pool_metrics():
+    """ :return: the debug logging pool's queue depths and listener times in Prometheus' text format, for GET /metrics
+    """
+    return _debug_pool.render()
+
+
+@tasks.coroutine
+def get_client(client_id=None, kind=None, account=None, gateway=None):
+    """ Creates a client connection to be used with orders, on the gateway chosen by gateways.router.  If its pool is
+    empty, waits for close_client to hand over a clientId: orders first, then portfolio requests, then the rest, first
+    come first served within each.  If connecting fails, the gateway is marked down and the next one the router picks
+    is tried, until none are left.
+
+    :param client_id: clientId to connect with instead of leasing one
+    :param kind: kind of request (ie order, scanner), for IBREST_GATEWAY_ROUTES and the lease priority
+    :param account: account the request is for, to use the gateway managing it
+    :param gateway: Gateway to use rather than routing, ie the one an order was placed on
+    :return: client, which is not connected if no gateway could be reached
+    :raises ServiceUnavailable: if no clientId was free within IBREST_LEASE_TIMEOUT, which is answered with a 503
+    """
+    pinned = gateway is not None
+    tried = []
+    while True:
+        if not pinned:
+            gateway = gateways.router.choose(kind, account, exclude=tried)
+        tried.append(gateway)
+        leased = client_id is None
+        connect_id = gateway.lease(gateways.priority(kind)) if leased else client_id
+        if isinstance(connect_id, tasks.Future):
+            lease = connect_id
+            connect_id = yield lease
+            if connect_id is None:
+                gateway.cancel(lease)
+                log.warning('No client_id free on {} within {}s'.format(gateway.name, lease.timeout))
+                raise ServiceUnavailable('All TWS connections are busy', retry_after=gateway.retry_after())
+        log.info('Attempting connection to {} with client_id {}'.format(gateway.name, connect_id))
+        with tracing.span('connect'):
+            client = connect(gateway, connect_id)
+        if client.isConnected():
+            gateway.record_success()
+            client.leased = leased
+            raise tasks.Return(client)
+        gateway.record_failure('Could not connect with client_id {}'.format(connect_id))
+        if leased:
+            gateway.release(connect_id)
+        if pinned or gateways.router.choose(kind, account, exclude=tried) is None:
+            raise tasks.Return(client)
+
+
+def connect(gateway, client_id):
+    """ Connects to gateway with our message handlers registered
+
+    :return: client, connected unless the connection or handshake failed
+    """
+    connection = loopConnection if _transport == 'loop' else ibConnection
+    client = connection(gateway.host, gateway.port, client_id)
+    client.gateway = gateway
+    client.leased = False
 
     # Add synchronous response handlers
-    client.register(connection_handler, 'ManagedAccounts', 'NextValidId')
+    client.register(partial(connection_handler, gateway), 'ManagedAccounts', 'NextValidId')
     client.register(order_handler, 'OpenOrder', 'OrderStatus', 'OpenOrderEnd')
     client.register(portfolio_positions_handler, 'Position', 'PositionEnd')
     client.register(error_handler, 'Error')
-    # Add handlers for feeds
-    client.register(market_handler, 'TickSize', 'TickPrice')
+    client.register(scanner_handler, 'ScannerParameters', 'ScannerData', 'ScannerDataEnd')
+    client.register(contract_details_handler, 'ContractDetails', 'ContractDetailsEnd')
+    client.register(fundamentals_handler, 'FundamentalData')
+    client.register(snapshot_handler, 'TickPrice', 'TickSnapshotEnd')
+    client.register(option_handler, 'TickOptionComputation')
+    client.register(partial(disconnect_handler, client), 'ConnectionClosed')
+    # Add handlers for feeds, conflated to the latest tick per tickerId and field
+    feed = Conflator(market_handler, _conflate_interval) if _conflate_interval > 0 else None
+    if feed is not None:
+        client.register(feed, 'TickSize', 'TickPrice')
+        client.register(feed.close, 'ConnectionClosed')
+    else:
+        client.register(market_handler, 'TickSize', 'TickPrice')
     # Enable logging if we're in debug mode
-    if current_app.debug is True:
-        client.registerAll(generic_handler)
-        client.enableLogging()
+    if app.debug is True:
+        client.registerAll(_debug_pool.wrap(generic_handler))
+        client.registerAll(_debug_pool.wrap(client.logMessage))
+    if _message_log is not None:
+        client.setTap(_message_log.tap('{} {}:{} clientId {}'.format(gateway.name, gateway.host, gateway.port,
+                                                                       client_id)))
+    # connect() returns once the handshake with TWS has completed or failed, so there is nothing to wait for here
     client.connect()
-
-    # Wait a bit to ensure we got messages back confirming we're connected and _order_id is updated.
-    timeout = 10  # 2.5 secs
-    while client.isConnected() is False and timeout > 0:
-        time.sleep(0.25)
-        timeout -= 1
+    if client.isConnected():
+        # Keep within TWS' message rate; see gateways.py
+        pace(client.sender.client, gateway.buckets(), gateway.pacing)
     return client
 
 
 def close_client(client):
-    """ Put clientId back into pool and close connection
+    """ Close connection and put clientId back into its gateway's pool, or hand it to the longest waiting get_client
     """
     client_id = client.clientId
-    # Add our client_id back into our pool
-    _clientId_pool.add(client_id)
-
-    # Now close our actual client
+    leased, client.leased = client.leased, False
+    # Close our actual client first, so its disconnect cannot wake the next user of this clientId
     client.close()
+    for future in _client_waits.pop(client, ()):
+        waiting = _pending.get(future.key)
+        if waiting is not None and future in waiting:
+            waiting.remove(future)
+            if not waiting:
+                _pending.pop(future.key, None)
+
+    # Add our client_id back into our pool
+    if leased:
+        client.gateway.release(client_id)
     return client_id
 
 
+@tasks.coroutine
+def get_contract_details(contract, client):
+    """ Uses reqContractDetails to get all ContractDetails matching contract, on an already connected client
+
+    :return: list of ContractDetails, or error dict
+    """
+    reqId = next(_request_ids)
+    _error_resp[reqId] = None
+    _contract_details_resp[reqId] = dict(contractDetailsEnd=False, contractDetails=[])
+    done = expect(client, reqId)
+    client.reqContractDetails(reqId, contract)
+    log.info("Waiting for contract details on client {}...".format(client.clientId))
+    yield done
+    if _error_resp[reqId] is not None:
+        _contract_details_resp.pop(reqId)
+        raise tasks.Return(_error_resp.pop(reqId))
+    _error_resp.pop(reqId, None)
+    raise tasks.Return(_contract_details_resp.pop(reqId)['contractDetails'])
+
+
 # ---------------------------------------------------------------------
 # ORDER FUNCTIONS
 # ---------------------------------------------------------------------
+@tasks.coroutine
 def get_open_orders():
-    """ Uses reqAllOpenOrders to get all open orders from 
+    """ Uses reqAllOpenOrders to get all open orders from each gateway in turn
     """
     global _order_resp
-    client = get_client()
-    if client is None or client.isConnected() is False:
-        global _error_resp
-        return _error_resp[-1]
-
     # Reset our order resp to prepare for new data
     _order_resp = dict(openOrderEnd=False, openOrder=[], orderStatus=[])
-    client.reqAllOpenOrders()
-    while _order_resp['openOrderEnd'] is False and client.isConnected() is True:
-        log.info("Waiting for responses on client {}...".format(client.clientId))
-        time.sleep(0.25)
-    close_client(client)
-    return _order_resp
-
-
+    for gateway in gateways.router.gateways:
+        client = yield get_client(kind='order', gateway=gateway)
+        if client is None or client.isConnected() is False:
+            global _error_resp
+            raise tasks.Return(_error_resp[-1])
+        done = expect(client, 'openOrderEnd')
+        client.reqAllOpenOrders()
+        log.info("Waiting for responses on client {} of {}...".format(client.clientId, gateway.name))
+        yield done
+        close_client(client)
+    raise tasks.Return(_order_resp)
+
+
+@tasks.coroutine
 def cancel_order(orderId):
     """ Uses cancelOrder to cancel an order.  The only response is what comes back right away (no EWrapper messages)
     """
@@ -188,29 +423,36 @@ def cancel_order(orderId):
     global _error_resp
     _error_resp[orderId] = None  # Reset our error for later
 
-    client = get_client()
+    client = yield get_client(kind='order', gateway=_order_gateways.get(orderId))
+    if client is None or client.isConnected() is False:
+        raise tasks.Return(_error_resp[-1])
     log.info('Cancelling order {}'.format(orderId))
     # Reset our order resp to prepare for new data
     _order_resp_by_order[orderId] = dict(openOrderEnd=False, openOrder=[], orderStatus=[])
+    done = expect(client, orderId)
     client.cancelOrder(int(orderId))
-    while len(_order_resp_by_order[orderId]['orderStatus']) == 0 and client.isConnected() is True:
-        log.info("Waiting for responses on client {}...".format(client.clientId))
-        if _error_resp[orderId] is not None:
-            close_client(client)
-            return _error_resp[_orderId]
-        time.sleep(0.25)
+    log.info("Waiting for responses on client {}...".format(client.clientId))
+    yield done
+    if len(_order_resp_by_order[orderId]['orderStatus']) == 0 and _error_resp[orderId] is not None:
+        close_client(client)
+        raise tasks.Return(_error_resp[orderId])
     close_client(client)
     resp = _order_resp.copy()
     # Cancelling an order also produces an error, we'll capture that here too
-    resp['error'] = _error_resp[_orderId]
-    return resp
+    resp['error'] = _error_resp[orderId]
+    raise tasks.Return(resp)
 
 
+@tasks.coroutine
 def place_order(args):
     """ Auto-detects which args should be assigned to a new Contract or Order, then use to place order.
-    Makes use of globals to set initial values, but allows args to override (ie clientId)
+    Makes use of globals to set initial values, but allows args to override (ie clientId).  Orders for an account are
+    placed on the gateway managing it.
     """
-    client = get_client()
+    client = yield get_client(kind='order', account=args.get('account'))
+    if client is None or client.isConnected() is False:
+        global _error_resp
+        raise tasks.Return(_error_resp[-1])
 
     # Populate contract with appropriate
     contract = Contract()
@@ -225,37 +467,307 @@ def place_order(args):
         if attr[:2] == 'm_' and attr[2:] in args:
             setattr(order, attr, args[attr[2:]])
 
-    log.debug('Placing order')
-    global _orderId
+    # Only the very first connection to each gateway has to wait for nextValidId; after that IDs come straight from the
+    # allocator
+    gateway = client.gateway
+    if not gateway.seeded:
+        seeded = expect(client, (gateway, 'nextValidId'), timeout=2.5)
+        if not gateway.seeded:
+            yield seeded
+        if not gateway.seeded:
+            close_client(client)
+            raise tasks.Return({'error': 'No valid orderId received from TWS'})
+    order_id = allocator.next_id(client)
+
+    log.debug('Placing order {}'.format(order_id))
     global _order_resp_by_order
-    global _error_resp
-    _error_resp[_orderId] = None
+    _error_resp[order_id] = None
     # Reset our order resp to prepare for new data
-    _order_resp_by_order[_orderId] = dict(openOrderEnd=False, openOrder=[], orderStatus=[])
-    client.placeOrder(_orderId, contract, order)
-    while len(_order_resp_by_order[_orderId]['orderStatus']) == 0 and client.isConnected() is True:
-        log.info("Waiting for responses on client {}...".format(client.clientId))
-        if _error_resp[_orderId] is not None:
-            close_client(client)
-            return _error_resp[_orderId]
-        time.sleep(0.25)
-    resp = _order_resp_by_order[_orderId].copy()
+    _order_resp_by_order[order_id] = dict(openOrderEnd=False, openOrder=[], orderStatus=[])
+    _order_gateways[order_id] = gateway
+    done = expect(client, order_id)
+    client.placeOrder(order_id, contract, order)
+    log.info("Waiting for responses on client {}...".format(client.clientId))
+    yield done
+    if len(_order_resp_by_order[order_id]['orderStatus']) == 0 and _error_resp[order_id] is not None:
+        close_client(client)
+        raise tasks.Return(_error_resp[order_id])
+    resp = _order_resp_by_order[order_id].copy()
     close_client(client)
-    return resp
+    raise tasks.Return(resp)
 
 
 # ---------------------------------------------------------------------
 # PORTFOLIO FUNCTIONS
 # ---------------------------------------------------------------------
+@tasks.coroutine
 def get_portfolio():
-    log.info('Getting client')
-    client = get_client()
-    log.info('Got client, getting portfolio')
+    """ Uses reqPositions to get the positions of each gateway in turn
+    """
     global _portfolio_positions_resp
     _portfolio_positions_resp = dict(positionEnd=False, positions=[])
-    client.reqPositions()
-    while _portfolio_positions_resp['positionEnd'] is False and client.isConnected() is True:
-        log.info("Waiting for responses on client {}...".format(client.clientId))
-        time.sleep(0.25)
+    for gateway in gateways.router.gateways:
+        log.info('Getting client')
+        client = yield get_client(kind='portfolio', gateway=gateway)
+        if client is None or client.isConnected() is False:
+            raise tasks.Return(_error_resp[-1])
+        log.info('Got client, getting portfolio')
+        done = expect(client, 'positionEnd')
+        client.reqPositions()
+        log.info("Waiting for responses on client {} of {}...".format(client.clientId, gateway.name))
+        yield done
+        close_client(client)
+    raise tasks.Return(_portfolio_positions_resp)
+
+
+# ---------------------------------------------------------------------
+# SCANNER FUNCTIONS
+# ---------------------------------------------------------------------
+@tasks.coroutine
+def get_scanner_parameters(client=None):
+    """ Returns the scanner parameters index, requesting it from TWS the first time
+    """
+    if scanner.parameters is not None:
+        raise tasks.Return(scanner.parameters)
+    own_client = client is None
+    if own_client:
+        client = yield get_client(kind='scanner')
+    done = expect(client, 'scannerParameters', timeout=30)  # the XML is large
+    client.reqScannerParameters()
+    log.info("Waiting for scanner parameters on client {}...".format(client.clientId))
+    yield done
+    if own_client:
+        close_client(client)
+    raise tasks.Return(scanner.parameters)
+
+
+@tasks.coroutine
+def run_scanner(args):
+    """ Runs a scanner subscription until scannerDataEnd, and returns the results ordered by rank.  Results are cached
+    per normalized subscription, see scanner.py
+    """
+    subscription = scanner.create_subscription(args)
+    key = scanner.subscription_key(subscription)
+    resp = scanner.results.get(key)
+    if resp is not None:
+        raise tasks.Return(resp)
+
+    client = yield get_client(kind='scanner')
+    if client is None or client.isConnected() is False:
+        raise tasks.Return(_error_resp[-1])
+    parameters = yield get_scanner_parameters(client)
+    if parameters is None:
+        close_client(client)
+        raise tasks.Return({'error': 'No scanner parameters received from TWS'})
+    error = parameters.validate(subscription)
+    if error is not None:
+        close_client(client)
+        raise tasks.Return({'error': error})
+
+    tickerId = next(_request_ids)
+    _error_resp[tickerId] = None
+    _scanner_resp[tickerId] = dict(scannerDataEnd=False, scannerData=[])
+    done = expect(client, tickerId)
+    client.reqScannerSubscription(tickerId, subscription)
+    log.info("Waiting for responses on client {}...".format(client.clientId))
+    yield done
+    if _scanner_resp[tickerId]['scannerDataEnd'] is False and _error_resp[tickerId] is not None:
+        close_client(client)
+        _scanner_resp.pop(tickerId)
+        raise tasks.Return(_error_resp.pop(tickerId))
+    client.cancelScannerSubscription(tickerId)
+    close_client(client)
+    _error_resp.pop(tickerId, None)
+    resp = _scanner_resp.pop(tickerId)
+    resp['scannerData'].sort(key=lambda row: row['rank'])
+    if resp['scannerDataEnd'] is True:
+        scanner.results.put(key, resp)
+    raise tasks.Return(resp)
+
+
+# ---------------------------------------------------------------------
+# FUNDAMENTALS FUNCTIONS
+# ---------------------------------------------------------------------
+@tasks.coroutine
+def get_fundamentals(symbol, reportType, args):
+    """ Returns the path of today's reportType report for symbol, using reqFundamentalData only if it is not already
+    cached (see fundamentals.py).  The symbol's conId is looked up with reqContractDetails the first time.
+
+    :return: path of gzipped report in args['format'], or error dict
+    """
+    contract = Contract()
+    contract.m_symbol = str(symbol)
+    contract.m_secType = args['secType']
+    contract.m_exchange = args['exchange']
+    contract.m_currency = args['currency']
+    key = contractKey(contract)
+    date = fundamentals.today()
+    fmt = args['format']
+    conId = args.get('conId') or fundamentals.con_ids.get(key)
+    if conId is not None:
+        path = fundamentals.cache.get(conId, reportType, date, fmt)
+        if path is not None:
+            raise tasks.Return(path)
+
+    client = yield get_client(kind='fundamentals')
+    if client is None or client.isConnected() is False:
+        raise tasks.Return(_error_resp[-1])
+    if conId is None:
+        details = yield get_contract_details(contract, client)
+        if isinstance(details, dict) or len(details) == 0:
+            close_client(client)
+            raise tasks.Return(details or {'error': 'No contract found for {}'.format(symbol)})
+        conId = fundamentals.con_ids[key] = details[0].m_summary.m_conId
+        path = fundamentals.cache.get(conId, reportType, date, fmt)
+        if path is not None:
+            close_client(client)
+            raise tasks.Return(path)
+    contract.m_conId = conId
+
+    reqId = next(_request_ids)
+    _error_resp[reqId] = None
+    _fundamentals_resp[reqId] = None
+    done = expect(client, reqId)
+    client.reqFundamentalData(reqId, contract, str(reportType))
+    log.info("Waiting for fundamental data on client {}...".format(client.clientId))
+    yield done
+    if _fundamentals_resp[reqId] is None and _error_resp[reqId] is not None:
+        client.cancelFundamentalData(reqId)
+        close_client(client)
+        _fundamentals_resp.pop(reqId)
+        raise tasks.Return(_error_resp.pop(reqId))
+    close_client(client)
+    error = _error_resp.pop(reqId, None)
+    data = _fundamentals_resp.pop(reqId)
+    if data is None:
+        raise tasks.Return(error or {'error': 'Disconnected before fundamental data was received'})
+    fundamentals.cache.put(conId, reportType, data, date)
+    raise tasks.Return(fundamentals.cache.get(conId, reportType, date, fmt))
+
+
+# ---------------------------------------------------------------------
+# OPTIONS FUNCTIONS
+# ---------------------------------------------------------------------
+@tasks.coroutine
+def get_snapshot_price(contract, client, timeout=5):
+    """ Uses a snapshot reqMktData to price contract: the last trade, else the bid/ask midpoint, else the close
+
+    :return: price, or None if TWS has none
+    """
+    tickerId = next(_request_ids)
+    _snapshot_resp[tickerId] = dict(tickSnapshotEnd=False)
+    done = expect(client, tickerId, timeout)
+    client.reqMktData(tickerId, contract, '', True)
+    yield done
+    prices = {k: v for k, v in _snapshot_resp.pop(tickerId).iteritems() if isinstance(k, int) and v > 0}
+    if TickType.LAST in prices:
+        raise tasks.Return(prices[TickType.LAST])
+    if TickType.BID in prices and TickType.ASK in prices:
+        raise tasks.Return((prices[TickType.BID] + prices[TickType.ASK]) / 2)
+    raise tasks.Return(prices.get(TickType.CLOSE))
+
+
+@tasks.coroutine
+def get_option_chain(underlying, args):
+    """ Resolves the option chain of underlying with reqContractDetails, subscribes to the strikes nearest the money
+    that fit the market data line budget, and collects their tickOptionComputation greeks into a strike x expiry grid.
+    See options.py
+
+    :return: grid dict, or error dict
+    """
+    client = yield get_client(kind='options')
+    if client is None or client.isConnected() is False:
+        raise tasks.Return(_error_resp[-1])
+
+    chain = Contract()
+    chain.m_symbol = str(underlying)
+    chain.m_secType = args['secType']
+    chain.m_exchange = args['exchange']
+    chain.m_currency = args['currency']
+    expiries = args['expiry'].split(',') if args['expiry'] else None
+    if expiries is not None and len(expiries) == 1:
+        chain.m_expiry = expiries[0]
+    if args['tradingClass']:
+        chain.m_tradingClass = args['tradingClass']
+    details = yield get_contract_details(chain, client)
+    if isinstance(details, dict) or len(details) == 0:
+        close_client(client)
+        raise tasks.Return(details or {'error': 'No options found for {}'.format(underlying)})
+
+    price = args['price']
+    if price is None:
+        stock = Contract()
+        stock.m_symbol = str(underlying)
+        stock.m_secType = args['underlyingSecType']
+        stock.m_exchange = args['exchange']
+        stock.m_currency = args['currency']
+        price = yield get_snapshot_price(stock, client)
+        if price is None:
+            close_client(client)
+            raise tasks.Return({'error': 'No price for {}; pass price to choose strikes'.format(underlying)})
+
+    budget = min(args['lines'] or options._line_budget, options._line_budget) - 1
+    contracts = options.select_window(details, price, expiries, args['expiries'], budget)
+    grid = options.ChainGrid(contracts)
+    done = expect(client, grid, args['timeout'])
+    tickerIds = []
+    for contract, cell in zip(contracts, grid.cells):
+        tickerId = next(_request_ids)
+        _option_cells[tickerId] = (grid, cell)
+        tickerIds.append(tickerId)
+        client.reqMktData(tickerId, contract, '', False)
+    log.info("Waiting for {} option computations on client {}...".format(grid.missing, client.clientId))
+    if not grid.complete():
+        yield done
+    for tickerId in tickerIds:
+        client.cancelMktData(tickerId)
+        _option_cells.pop(tickerId, None)
+    close_client(client)
+    resp = grid.to_dict()
+    resp['underPrice'] = price
+    raise tasks.Return(resp)
+
+
+@tasks.coroutine
+def calculate_with_tws(data):
+    """ Computes a /options/compute request with TWS' calculateImpliedVolatility (where optionPrice is given) or
+    calculateOptionPrice, one round trip per contract.  Contracts are identified by conId.
+
+    :return: dict of pricing.OUTPUTS lists, like pricing.compute, or error dict
+    """
+    try:
+        c = pricing.prepare(data)
+    except ValueError as e:
+        raise tasks.Return({'error': str(e)})
+    conIds = c.get('conId')
+    if conIds is None:
+        raise tasks.Return({'error': 'conId is required to calculate with TWS'})
+    client = yield get_client(kind='options')
+    if client is None or client.isConnected() is False:
+        raise tasks.Return(_error_resp[-1])
+    results = pricing.TwsComputations(len(conIds))
+    done = expect(client, results, float(data.get('timeout', 10)))
+    reqIds = []
+    for cell, conId in zip(results.cells, conIds):
+        contract = Contract()
+        contract.m_conId = conId
+        contract.m_exchange = str(data.get('exchange', 'SMART'))
+        reqId = next(_request_ids)
+        _option_cells[reqId] = (results, cell)
+        reqIds.append(reqId)
+        price = c['optionPrice'][cell]
+        if price == price:
+            client.calculateImpliedVolatility(reqId, contract, price, c['underPrice'][cell])
+        else:
+            client.calculateOptionPrice(reqId, contract, c['volatility'][cell], c['underPrice'][cell])
+    log.info("Waiting for {} TWS option calculations on client {}...".format(results.missing, client.clientId))
+    if not results.complete():
+        yield done
+    for cell, reqId in zip(results.cells, reqIds):
+        if c['optionPrice'][cell] == c['optionPrice'][cell]:
+            client.cancelCalculateImpliedVolatility(reqId)
+        else:
+            client.cancelCalculateOptionPrice(reqId)
+        _option_cells.pop(reqId, None)
     close_client(client)
-    return _portfolio_positions_resp
\ No newline at end of file
+    raise tasks.Return(results.to_dict())
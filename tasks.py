@@ -0,0 +1,232 @@
+""" Futures and generator coroutines, so one body of request code can either block a Flask worker thread or be suspended
+on serve.py's event loop.
+
+Functions in sync are written as generators decorated with @coroutine which yield a Future wherever they wait on TWS.
+The Future is completed by a message handler (on an EReader thread) once the awaited message arrives.  Called from a
+plain thread, a coroutine runs to completion and returns its value, blocking on each Future in turn.  Called on a thread
+running an EventLoop, it returns a Task instead: a Future which steps the generator on the loop each time what it is
+waiting on completes, so no thread is held while TWS answers.
+
+Coroutines hand back their value with raise Return(value), and wait on other coroutines with value = yield other().
+
+Each thread has a context, the Trace of the request it is serving (see tracing.py), and each Task keeps the context it
+was created in while it runs, so the request's phases are timed wherever its coroutines resume.  A Future may name the
+phase a coroutine is in while waiting on it, and the wait is added to that phase.
+"""
+from threading import Condition, local
+import sys
+import time
+
+# ---------------------------------------------------------------------
+# GLOBAL PARAMETERS
+# ---------------------------------------------------------------------
+# EventLoop of the current thread, if it is running one
+_thread = local()
+
+
+def get_loop():
+    return getattr(_thread, 'loop', None)
+
+
+def set_loop(loop):
+    _thread.loop = loop
+
+
+def get_context():
+    """ :return: context of the request being served on this thread, or None
+    """
+    return getattr(_thread, 'context', None)
+
+
+def set_context(context):
+    """ Sets the context of the request being served on this thread
+
+    :return: the previous context
+    """
+    previous = getattr(_thread, 'context', None)
+    _thread.context = context
+    return previous
+
+
+def _waited(future, started):
+    """ Adds the time since started to the phase future names, in the current context
+    """
+    context = get_context()
+    if future.phase is not None and context is not None:
+        context.add(future.phase, time.time() - started)
+
+
+class Return(Exception):
+    """ Raised by a coroutine to return value, as generators cannot use return with a value in Python 2
+    """
+
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+# ---------------------------------------------------------------------
+# FUTURES
+# ---------------------------------------------------------------------
+class Future(object):
+    """ Result of an operation which completes on another thread.  Safe to complete and wait on from any thread.
+    """
+
+    def __init__(self, timeout=None, phase=None):
+        """
+        :param timeout: seconds after which a waiting coroutine stops waiting and the Future completes with None
+        :param phase: phase of the request while a coroutine waits on it, ie 'tws'; see tracing.py
+        """
+        self.timeout = timeout
+        self.phase = phase
+        self._condition = Condition()
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def set_result(self, result=None):
+        """ Completes the Future, unless it is already done (whichever of a message and a timeout comes first wins)
+
+        :return: True if this call completed it
+        """
+        return self._complete(result, None)
+
+    def set_exc_info(self, exc_info):
+        return self._complete(None, exc_info)
+
+    def _complete(self, result, exc_info):
+        with self._condition:
+            if self._done:
+                return False
+            self._result, self._exc_info, self._done = result, exc_info, True
+            callbacks, self._callbacks = self._callbacks, []
+            self._condition.notify_all()
+        for callback in callbacks:
+            callback(self)
+        return True
+
+    def add_done_callback(self, callback):
+        """ Calls callback(future) once done, on the completing thread, or right away if already done
+        """
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None):
+        """ Blocks until done or timeout.  Only for plain threads; never call this on an event loop.
+
+        :return: True if done
+        """
+        with self._condition:
+            if not self._done:
+                self._condition.wait(timeout)
+            return self._done
+
+    def result(self):
+        """ :return: result of a done Future, re-raising its exception if it failed
+        """
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+# ---------------------------------------------------------------------
+# COROUTINES
+# ---------------------------------------------------------------------
+def coroutine(func):
+    """ Decorates a generator function as a coroutine: on an event loop thread calls return a Task, anywhere else they
+    block and return the generator's value
+    """
+    def wrapper(*args, **kwargs):
+        gen = func(*args, **kwargs)
+        loop = get_loop()
+        if loop is None:
+            return run(gen)
+        return Task(gen, loop)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+def run(gen):
+    """ Runs a coroutine's generator to completion on this thread
+
+    :return: its value
+    """
+    value, exc_info = None, None
+    while True:
+        try:
+            yielded = gen.throw(*exc_info) if exc_info else gen.send(value)
+        except StopIteration:
+            return None
+        except Return as r:
+            return r.value
+        value, exc_info = yielded, None
+        if isinstance(yielded, Future):
+            started = time.time()
+            if not yielded.wait(yielded.timeout):
+                yielded.set_result(None)
+            _waited(yielded, started)
+            try:
+                value = yielded.result()
+            except Exception:
+                exc_info = sys.exc_info()
+
+
+class Task(Future):
+    """ Steps a coroutine's generator on an EventLoop, resuming it when each Future it yields completes.  The Task
+    itself completes with the coroutine's value.
+    """
+
+    def __init__(self, gen, loop):
+        Future.__init__(self)
+        self._gen = gen
+        self._loop = loop
+        self._context = get_context()
+        self._waiting = None
+        self._step(None, None)
+
+    def _step(self, value, exc_info):
+        previous = set_context(self._context)
+        try:
+            if self._waiting is not None:
+                _waited(*self._waiting)
+                self._waiting = None
+            self._run(value, exc_info)
+        finally:
+            set_context(previous)
+
+    def _run(self, value, exc_info):
+        while True:
+            try:
+                yielded = self._gen.throw(*exc_info) if exc_info else self._gen.send(value)
+            except StopIteration:
+                self.set_result(None)
+                return
+            except Return as r:
+                self.set_result(r.value)
+                return
+            except Exception:
+                self.set_exc_info(sys.exc_info())
+                return
+            if not isinstance(yielded, Future):
+                value, exc_info = yielded, None
+                continue
+            if yielded.done():
+                value, exc_info = yielded._result, yielded._exc_info
+                continue
+            if yielded.timeout is not None:
+                self._loop.call_later(yielded.timeout, yielded.set_result, None)
+            self._waiting = (yielded, time.time())
+            yielded.add_done_callback(self._resume)
+            return
+
+    def _resume(self, future):
+        # Runs on whichever thread completed future; the generator is only ever stepped on the loop
+        self._loop.call_soon_threadsafe(self._step, future._result, future._exc_info)
@@ -0,0 +1,136 @@
+""" Where the time of each REST request goes, phase by phase.
+
+Every request gets a Trace, which tasks.py keeps as the context of the request's coroutines, so that it follows the
+request across threads and serve.py's event loop.  Phases are timed where they happen:
+
+    lease      waiting in sync.get_client for a free clientId
+    connect    connecting to TWS, including the handshake
+    tws        waiting on TWS' answers (the Futures made by sync.expect)
+    serialize  rendering the response body as JSON
+
+Each response gets a Server-Timing header listing the phases and the total, ie
+
+    Server-Timing: lease;dur=0.1, connect;dur=2.3, tws;dur=41.5, serialize;dur=0.2, total;dur=45.0
+
+and GET /metrics has a histogram of each endpoint's total and phase times.  Requests taking longer than
+IBREST_SLOW_REQUEST_MS (0, the default, logs none) are logged with their breakdown.
+"""
+from contextlib import contextmanager
+from threading import Lock
+import logging
+import os
+import time
+
+from ib.opt.metrics import Histogram
+import tasks
+
+log = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------
+# GLOBAL PARAMETERS
+# ---------------------------------------------------------------------
+# Configuration
+_slow_request_ms = float(os.getenv('IBREST_SLOW_REQUEST_MS', '0'))
+
+# Request and phase time histograms keyed by (endpoint, phase), where the phase of the whole request is 'total'
+_histograms = dict()
+_lock = Lock()
+
+
+# ---------------------------------------------------------------------
+# TRACES
+# ---------------------------------------------------------------------
+class Trace(object):
+    """ Phase times of one request, in seconds, in the order each phase first occurred
+    """
+
+    def __init__(self, method, path, endpoint):
+        self.method = method
+        self.path = path
+        self.endpoint = endpoint or 'unknown'
+        self.start = time.time()
+        self.phases = []
+        self.times = dict()
+        self.total = None
+
+    def add(self, phase, seconds):
+        """ Adds seconds to phase.  Called from any thread the request's coroutines run on.
+        """
+        if phase not in self.times:
+            self.phases.append(phase)
+            self.times[phase] = 0.0
+        self.times[phase] += seconds
+
+    def finish(self):
+        """ Ends the trace, recording it to the histograms and the slow request log
+
+        :return: total seconds
+        """
+        if self.total is None:
+            self.total = time.time() - self.start
+            record(self)
+        return self.total
+
+    def server_timing(self):
+        """ :return: Server-Timing header value
+        """
+        timings = [(phase, self.times[phase]) for phase in self.phases] + [('total', self.finish())]
+        return ', '.join('{};dur={:.1f}'.format(phase, seconds * 1000) for phase, seconds in timings)
+
+
+def start(method, path, endpoint):
+    """ Starts a Trace for a request, as the context of the code handling it on this thread
+
+    :return: Trace
+    """
+    trace = Trace(method, path, endpoint)
+    tasks.set_context(trace)
+    return trace
+
+
+def current():
+    """ :return: Trace of the request being handled on this thread, or None
+    """
+    context = tasks.get_context()
+    return context if isinstance(context, Trace) else None
+
+
+@contextmanager
+def span(phase):
+    """ Times the with block as phase of the current request, if there is one
+    """
+    trace = current()
+    started = time.time()
+    try:
+        yield
+    finally:
+        if trace is not None:
+            trace.add(phase, time.time() - started)
+
+
+# ---------------------------------------------------------------------
+# METRICS
+# ---------------------------------------------------------------------
+def record(trace):
+    with _lock:
+        for phase, seconds in [('total', trace.total)] + [(p, trace.times[p]) for p in trace.phases]:
+            key = (trace.endpoint, phase)
+            histogram = _histograms.get(key)
+            if histogram is None:
+                histogram = _histograms[key] = Histogram()
+            histogram.observe(seconds)
+    if _slow_request_ms and trace.total * 1000 >= _slow_request_ms:
+        log.warning('Slow request {} {} took {:.1f}ms: {}'.format(
+            trace.method, trace.path, trace.total * 1000,
+            ', '.join('{}={:.1f}ms'.format(p, trace.times[p] * 1000) for p in trace.phases) or 'no phases'))
+
+
+def render():
+    """ :return: request histograms in the Prometheus text exposition format
+    """
+    lines = ['# HELP ibrest_request_seconds Time serving REST requests, by endpoint and phase (total for all of it).',
+             '# TYPE ibrest_request_seconds histogram']
+    with _lock:
+        for (endpoint, phase), histogram in sorted(_histograms.items()):
+            lines.extend(histogram.lines('ibrest_request_seconds', 'endpoint="{}",phase="{}"'.format(endpoint, phase)))
+    return '\n'.join(lines) + '\n'